@@ -1,10 +1,24 @@
-"""Инициализация бота и регистрация всех обработчиков."""
+"""Инициализация бота и регистрация всех обработчиков.
 
+Импорт модуля ничего не запускает и не проверяет настройки: бот создается,
+а сервисы подключаются к кэшу в main().
+"""
+
+import signal
+import time
 import telebot
 import threading
-from config import BOT_TOKEN
-from services.user_storage import load_all_users_from_storage
-from services.notifications import check_weather_notifications
+from config import BOT_TOKEN, settings, WARM_START, WARM_START_SNAPSHOT_INTERVAL, check_bot_settings
+from services.user_storage import (
+    load_all_users_from_storage, start_storage_flusher, stop_storage_flusher
+)
+from services.notifications import check_weather_notifications, start_event_notifications
+from services.weather_api import start_cache_compactor
+from services.warm_start import load_snapshot, start_snapshot_writer, stop_snapshot_writer
+from services.history import init_history, start_history_writer, stop_history_writer
+from utils.render_cache import init_render_cache
+from utils.metrics import metrics
+from utils import tracing
 from handlers.commands import register_command_handlers
 from handlers.weather import register_weather_handlers
 from handlers.location import register_location_handlers
@@ -12,43 +26,132 @@ from handlers.callbacks import register_callback_handlers
 from handlers.comparisons import register_comparison_handlers
 from handlers.notifications import register_notification_handlers
 from handlers.inline import register_inline_handlers
+from handlers.admin import register_admin_handlers
+from app.router import Router
+
+
+# Маршрутизатор сообщений и callback-запросов
+router = Router()
 
 
-# Создаем экземпляр бота
-bot = telebot.TeleBot(BOT_TOKEN)
+def create_bot() -> telebot.TeleBot:
+    """Проверяет настройки и создает экземпляр бота."""
+    # Без токенов бот не запускается; сервисы при этом можно импортировать и без них
+    check_bot_settings()
+    
+    # Состояние пользователей защищено блокировками (services/user_state.py),
+    # поэтому обработчики могут работать в нескольких потоках
+    bot = telebot.TeleBot(BOT_TOKEN, num_threads=settings.bot_num_threads)
+    if tracing.ENABLED:
+        # Вызовы Bot API — отрезки трассы обновления (telegram.<метод>)
+        tracing.instrument_bot(bot)
+    return bot
+
 
+def init_services():
+    """Подключает к обновлениям кэша историю погоды и удаление устаревших текстов.
+    События для уведомлений подключаются при запуске их доставки (start_notification_thread)."""
+    init_history()
+    init_render_cache()
 
-def register_all_handlers():
+
+def register_all_handlers(bot):
     """Регистрирует все обработчики бота."""
-    register_command_handlers(bot)
-    register_weather_handlers(bot)
-    register_location_handlers(bot)
-    register_callback_handlers(bot)
-    register_comparison_handlers(bot)
-    register_notification_handlers(bot)
-    register_inline_handlers(bot)
+    register_command_handlers(bot, router)
+    register_weather_handlers(bot, router)
+    register_location_handlers(bot, router)
+    register_callback_handlers(bot, router)
+    register_comparison_handlers(bot, router)
+    register_notification_handlers(bot, router)
+    register_inline_handlers(bot, router)
+    register_admin_handlers(bot, router)
+    
+    # Один обработчик telebot на все сообщения и callback-и, дальше — табличный поиск
+    router.install(bot)
 
 
-def start_notification_thread():
-    """Запускает поток для проверки уведомлений."""
+def start_notification_thread(bot):
+    """Запускает поток обновления данных подписчиков и доставку событий уведомлений."""
+    start_event_notifications(bot)
     notification_thread = threading.Thread(target=check_weather_notifications, args=(bot,), daemon=True)
     notification_thread.start()
 
 
-def main():
-    """Основная функция запуска бота."""
+def install_shutdown_handlers(bot):
+    """Останавливает polling по SIGTERM, чтобы main() успел сохранить данные."""
+    def handle_stop(signum, frame):
+        bot.stop_polling()
+    
+    signal.signal(signal.SIGTERM, handle_stop)
+
+
+def report_first_minute_requests():
+    """Через минуту после старта печатает, сколько запросов ушло в OWM,
+    чтобы сравнить теплый и холодный старт."""
+    def report():
+        time.sleep(60)
+        attempts = sum(metrics.counters('owm.attempt.').values())
+        mode = "теплый" if WARM_START else "холодный"
+        print(f"Запросов к OWM за первую минуту ({mode} старт): {attempts}")
+    
+    threading.Thread(target=report, daemon=True).start()
+
+
+def main(profile_startup: bool = False):
+    """Основная функция запуска бота.
+    profile_startup — напечатать время импортов и время до первого обработанного обновления."""
+    started = time.perf_counter()
+    bot = create_bot()
+    init_services()
+    
+    if profile_startup:
+        from utils.startup_profile import import_report, profile_dispatch
+        print(import_report())
+        router.dispatch_message = profile_dispatch(router.dispatch_message)
+        router.dispatch_callback = profile_dispatch(router.dispatch_callback)
+    
     # Загружаем данные всех пользователей при старте
-    load_all_users_from_storage()
+    load_timings = load_all_users_from_storage()
+    
+    # Восстанавливаем горячие данные кэша из снимка
+    warm = load_snapshot() if WARM_START else {'entries': 0, 'renders': 0, 'time': 0.0}
     
     # Регистрируем все обработчики
-    register_all_handlers()
+    phase_start = time.perf_counter()
+    register_all_handlers(bot)
+    handlers_time = time.perf_counter() - phase_start
+    
+    # Запускаем фоновую запись данных пользователей и поток уведомлений
+    phase_start = time.perf_counter()
+    start_storage_flusher()
+    start_history_writer()
+    start_cache_compactor()
+    start_notification_thread(bot)
+    if WARM_START:
+        start_snapshot_writer(WARM_START_SNAPSHOT_INTERVAL)
+    install_shutdown_handlers(bot)
+    threads_time = time.perf_counter() - phase_start
     
-    # Запускаем поток уведомлений
-    start_notification_thread()
+    print(
+        f"Пользователи: {load_timings['users']} "
+        f"(загружено {load_timings['hydrated']}, отложено {load_timings['deferred']})\n"
+        f"Старт: чтение {load_timings['read']:.3f} с, разбор {load_timings['parse']:.3f} с, "
+        f"заполнение {load_timings['hydrate']:.3f} с, снимок кэша {warm['time']:.3f} с "
+        f"({warm['entries']} записей, {warm['renders']} текстов), обработчики {handlers_time:.3f} с, "
+        f"потоки {threads_time:.3f} с, всего {time.perf_counter() - started:.3f} с"
+    )
     
     # Запускаем бота
     print("Бот запущен!")
-    bot.infinity_polling()
+    report_first_minute_requests()
+    try:
+        bot.infinity_polling()
+    finally:
+        # При остановке сохраняем все несохраненные изменения
+        stop_storage_flusher()
+        stop_history_writer()
+        if WARM_START:
+            stop_snapshot_writer()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+"""Маршрутизатор обновлений.
+
+Вместо перебора предикатов telebot для каждого сообщения маршруты хранятся
+в таблицах: команды, точные тексты кнопок, пары (состояние, тип контента),
+маршруты по умолчанию для типа контента, а также точные значения
+и префиксы callback_data. Поиск маршрута не зависит от числа обработчиков
+и от порядка их регистрации.
+
+Маршрут может принадлежать классу контроля допуска (services/admission.py):
+тогда перед вызовом обработчика проверяются лимиты пользователя и общие
+лимиты, а недопущенный запрос передается обработчику деградации класса.
+"""
+
+import time
+from typing import Callable, Optional
+from services.admission import admission
+from services.user_storage import users, user_data, ensure_user_loaded
+from utils.metrics import metrics
+from utils.tracing import span, trace_update
+
+
+# Состояния диалога
+STATE_MAIN = 'main'
+STATE_WAITING_CITY = 'waiting_city'
+STATE_WAITING_FORECAST_CITY = 'waiting_forecast_city'
+STATE_WAITING_EXTENDED = 'waiting_extended'
+STATE_WAITING_CITY1 = 'waiting_city1'
+STATE_WAITING_CITY2 = 'waiting_city2'
+STATE_WAITING_NOTIF_INTERVAL = 'waiting_notif_interval'
+
+# Состояния, в которые можно перейти из любого состояния (кнопки меню и callback-и)
+ENTRY_STATES = frozenset({
+    STATE_MAIN,
+    STATE_WAITING_CITY,
+    STATE_WAITING_FORECAST_CITY,
+    STATE_WAITING_EXTENDED,
+    STATE_WAITING_CITY1,
+    STATE_WAITING_NOTIF_INTERVAL,
+})
+
+# Переходы, допустимые только из определенного состояния
+TRANSITIONS = {
+    STATE_WAITING_CITY1: frozenset({STATE_WAITING_CITY2}),
+}
+
+
+# Задержки всех обработчиков вместе (по маршрутам — route.<имя>)
+_all_handlers = metrics.latency('handlers')
+
+
+class Route:
+    """Зарегистрированный маршрут: обработчик и его счетчики задержек."""
+
+    __slots__ = ('name', 'handler', 'stats', 'admission', 'span_name')
+
+    def __init__(self, name: str, handler: Callable, admission: Optional[str] = None):
+        self.name = name
+        self.handler = handler
+        self.stats = metrics.latency(f"route.{name}")
+        self.admission = admission  # Класс контроля допуска или None
+        self.span_name = f"handler.{name}"
+
+    def __call__(self, update):
+        start = time.perf_counter()
+        failed = False
+        try:
+            with span(self.span_name):
+                return self.handler(update)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stats.observe(elapsed, error=failed)
+            _all_handlers.observe(elapsed, error=failed)
+
+
+class Router:
+    """Табличный маршрутизатор сообщений и callback-запросов."""
+
+    def __init__(self):
+        self._commands = {}  # {command: Route}
+        self._texts = {}  # {text: Route}
+        self._states = {}  # {(state, content_type): Route}
+        self._defaults = {}  # {content_type: Route}
+        self._callbacks = {}  # {callback_data: Route}
+        self._callback_prefixes = {}  # {prefix: Route}
+        self._prefix_lengths = ()  # длины префиксов по убыванию
+        self._degraded = {}  # {класс допуска: handler(update, retry_after)}
+        self._unmatched = metrics.counter('route.unmatched')
+
+    # --- Регистрация маршрутов ---
+    # admission — класс контроля допуска для дорогих обработчиков (см. services/admission.py)
+
+    def _add(self, table: dict, key, handler: Callable, name: str, admission: Optional[str] = None):
+        if key in table:
+            raise ValueError(f"Маршрут {key!r} уже зарегистрирован")
+        table[key] = Route(name, handler, admission)
+
+    def command(self, *commands: str, admission: Optional[str] = None):
+        """Регистрирует обработчик команд (/start, /help)."""
+        def decorator(handler):
+            for command in commands:
+                self._add(self._commands, command, handler, handler.__name__, admission)
+            return handler
+        return decorator
+
+    def text(self, *texts: str, admission: Optional[str] = None):
+        """Регистрирует обработчик точного текста кнопки reply-клавиатуры."""
+        def decorator(handler):
+            for text in texts:
+                self._add(self._texts, text, handler, handler.__name__, admission)
+            return handler
+        return decorator
+
+    def state(self, state: str, content_types: tuple = ('text',), admission: Optional[str] = None):
+        """Регистрирует обработчик сообщения в заданном состоянии диалога."""
+        def decorator(handler):
+            for content_type in content_types:
+                self._add(self._states, (state, content_type), handler, handler.__name__, admission)
+            return handler
+        return decorator
+
+    def default(self, *content_types: str, admission: Optional[str] = None):
+        """Регистрирует обработчик по умолчанию для типа контента."""
+        def decorator(handler):
+            for content_type in content_types:
+                self._add(self._defaults, content_type, handler, handler.__name__, admission)
+            return handler
+        return decorator
+
+    def callback(self, *data: str, admission: Optional[str] = None):
+        """Регистрирует обработчик точного значения callback_data."""
+        def decorator(handler):
+            for value in data:
+                self._add(self._callbacks, value, handler, handler.__name__, admission)
+            return handler
+        return decorator
+
+    def callback_prefix(self, prefix: str, admission: Optional[str] = None):
+        """Регистрирует обработчик callback_data с заданным префиксом."""
+        def decorator(handler):
+            self._add(self._callback_prefixes, prefix, handler, handler.__name__, admission)
+            self._prefix_lengths = tuple(sorted({len(p) for p in self._callback_prefixes}, reverse=True))
+            return handler
+        return decorator
+
+    def degraded(self, admission_class: str):
+        """Регистрирует обработчик handler(update, retry_after) для запросов класса,
+        не допущенных контролем допуска: ответ из кэша или просьба повторить позже."""
+        def decorator(handler):
+            if admission_class in self._degraded:
+                raise ValueError(f"Обработчик деградации {admission_class!r} уже зарегистрирован")
+            self._degraded[admission_class] = handler
+            return handler
+        return decorator
+
+    # --- Состояния ---
+
+    @staticmethod
+    def get_state(user_id: int) -> str:
+        """Возвращает текущее состояние пользователя."""
+        return user_data.get(user_id, {}).get('state') or STATE_MAIN
+
+    def transition(self, user_id: int, new_state: str):
+        """Переводит пользователя в новое состояние, проверяя допустимость перехода."""
+        with users.lock(user_id):
+            old_state = self.get_state(user_id)
+            if new_state not in ENTRY_STATES and new_state not in TRANSITIONS.get(old_state, ()):
+                raise ValueError(f"Недопустимый переход состояния: {old_state} -> {new_state}")
+            user_data[user_id]['state'] = new_state
+        metrics.counter(f"transition.{old_state}->{new_state}").inc()
+
+    # --- Диспетчеризация ---
+
+    def resolve_message(self, message) -> Optional[Route]:
+        """Находит маршрут для сообщения."""
+        content_type = message.content_type
+        text = message.text if content_type == 'text' else None
+
+        if text:
+            if text.startswith('/'):
+                command = text[1:].split(maxsplit=1)[0].split('@', 1)[0] if len(text) > 1 else ''
+                route = self._commands.get(command)
+                if route is not None:
+                    return route
+            route = self._texts.get(text)
+            if route is not None:
+                return route
+
+        state = self.get_state(message.from_user.id)
+        route = self._states.get((state, content_type))
+        if route is not None:
+            return route
+        return self._defaults.get(content_type)
+
+    def resolve_callback(self, data: str) -> Optional[Route]:
+        """Находит маршрут для callback_data."""
+        if not data:
+            return None
+        route = self._callbacks.get(data)
+        if route is not None:
+            return route
+        for length in self._prefix_lengths:
+            route = self._callback_prefixes.get(data[:length])
+            if route is not None:
+                return route
+        return None
+
+    def _run(self, route: Route, update):
+        """Вызывает обработчик маршрута, проверяя контроль допуска."""
+        if route.admission is None:
+            return route(update)
+        user_id = update.from_user.id
+        retry_after = admission.try_admit(route.admission, user_id)
+        if retry_after:
+            degraded = self._degraded.get(route.admission)
+            if degraded is None:
+                return None
+            with span('handler.degraded', admission=route.admission, retry_after=retry_after):
+                return degraded(update, retry_after)
+        try:
+            return route(update)
+        finally:
+            admission.release(route.admission, user_id)
+
+    def dispatch_message(self, message):
+        """Передает сообщение найденному обработчику. Обработка — одна трасса (utils/tracing.py)."""
+        with trace_update('message', user_id=message.from_user.id, content_type=message.content_type):
+            ensure_user_loaded(message.from_user.id)
+            route = self.resolve_message(message)
+            if route is None:
+                self._unmatched.inc()
+                return None
+            return self._run(route, message)
+
+    def dispatch_callback(self, callback):
+        """Передает callback-запрос найденному обработчику. Обработка — одна трасса."""
+        with trace_update('callback', user_id=callback.from_user.id):
+            ensure_user_loaded(callback.from_user.id)
+            route = self.resolve_callback(callback.data)
+            if route is None:
+                self._unmatched.inc()
+                return None
+            return self._run(route, callback)
+
+    def content_types(self) -> list:
+        """Возвращает типы контента, для которых есть маршруты."""
+        types_ = {'text'} if self._commands or self._texts else set()
+        types_.update(content_type for _, content_type in self._states)
+        types_.update(self._defaults)
+        return sorted(types_)
+
+    def install(self, bot):
+        """Регистрирует в telebot по одному обработчику на сообщения и callback-и."""
+        bot.message_handler(content_types=self.content_types(), func=lambda m: True)(self.dispatch_message)
+        bot.callback_query_handler(func=lambda c: True)(self.dispatch_callback)
+
+    def stats(self) -> dict:
+        """Возвращает сводку задержек по маршрутам."""
+        return metrics.latencies('route.')
@@ -1,16 +1,150 @@
-"""Конфигурация бота."""
+"""Конфигурация бота.
+
+Переменные окружения (и файл .env) читаются один раз при первом импорте
+в объект settings; модули берут настройки из него. Импорт конфигурации
+не требует токенов, поэтому сервисы можно использовать из утилит командной
+строки; обязательные для бота значения проверяет check_bot_settings().
+"""
 
 import os
-from dotenv import load_dotenv
+from typing import NamedTuple, Optional
+
+
+class Settings(NamedTuple):
+    """Все настройки бота и сервисов."""
+    bot_token: Optional[str]
+    ow_api_key: Optional[str]
+    # Пользователи Telegram, которым доступны служебные команды (/stats)
+    admin_user_ids: frozenset
+    # Потоки telebot, выполняющие обработчики обновлений
+    bot_num_threads: int
+
+    # Отложенная запись данных пользователей: интервал сброса (сек) и порог числа измененных пользователей
+    storage_flush_interval: float
+    storage_flush_threshold: int
+    # Ленивая загрузка пользователей без уведомлений: данные применяются при первом обновлении от пользователя
+    startup_lazy_hydration: bool
+
+    # Восстановление расписания уведомлений после перезапуска: просроченные проверки
+    # распределяются случайно по окну (сек), а не выполняются все сразу
+    notification_recovery_window: float
+    # Не больше стольких уведомлений в секунду (лимит Telegram — около 30 сообщений в секунду)
+    notification_send_rate: float
+
+    # Теплый старт: снимок горячих данных кэша загружается при запуске и сохраняется
+    # при остановке и каждые warm_start_snapshot_interval секунд
+    warm_start: bool
+    warm_start_snapshot_interval: float
+
+    # История наблюдаемой погоды по ячейкам: сколько дней хранить
+    history_retention_days: float
+
+    # Трассировка обновлений: доля трасс в выборке, порог медленного обновления (мс),
+    # которое сохраняется всегда, каталог и размер файла до ротации (байт)
+    trace_sample_rate: float
+    trace_slow_ms: float
+    trace_dir: str
+    trace_max_bytes: int
+
+    # Кэш ответов OWM
+    cache_dir: str
+    cache_stale_ttl: int  # Сколько хранить устаревшие данные для отказа OWM
+    geocode_ttl: int  # Координаты городов почти не меняются: 30 дней
+    # Границы срока свежести записей по эндпоинтам, сек (см. services/cache_expiry.py)
+    cache_ttl_weather_min: float
+    cache_ttl_weather_max: float
+    cache_ttl_forecast_min: float
+    cache_ttl_forecast_max: float
+    cache_ttl_air_min: float
+    cache_ttl_air_max: float
+    cache_backend: str  # sqlite (один файл) или files (файл на ключ)
+    cache_compress: bool
+    cache_memory_entries: int
+    cache_compact_interval: int
+
+    # Квоты тарифа OWM (Free: 60 запросов в минуту, 1 000 000 в месяц)
+    owm_calls_per_minute: int
+    owm_calls_per_day: int
+    owm_breaker_window: int
+    owm_breaker_min_calls: int
+    owm_breaker_error_rate: float
+    owm_breaker_open_seconds: float
+    # Бюджет времени на один вызов OWM с учетом всех повторов (секунды)
+    owm_budget_interactive: float
+    owm_budget_background: float
+    owm_hedge: bool
+    owm_pool_size: int
+    owm_bundle_pool_size: int
+    owm_group_radius_km: float  # Ответ /group по центру города делится только с ячейками ближе этого
+
+
+def load_settings() -> Settings:
+    """Читает настройки из окружения и файла .env."""
+    from dotenv import load_dotenv
+    load_dotenv()
+    env = os.getenv
+    return Settings(
+        bot_token=env("BOT_TOKEN"),
+        ow_api_key=env("OW_API_KEY"),
+        admin_user_ids=frozenset(int(value) for value in env("ADMIN_USER_IDS", "").replace(' ', '').split(',') if value),
+        bot_num_threads=int(env("BOT_NUM_THREADS", "8")),
+        storage_flush_interval=float(env("STORAGE_FLUSH_INTERVAL", "5")),
+        storage_flush_threshold=int(env("STORAGE_FLUSH_THRESHOLD", "50")),
+        startup_lazy_hydration=env("STARTUP_LAZY_HYDRATION", "1") == "1",
+        notification_recovery_window=float(env("NOTIFICATION_RECOVERY_WINDOW", "900")),
+        notification_send_rate=float(env("NOTIFICATION_SEND_RATE", "20")),
+        warm_start=env("WARM_START", "1") == "1",
+        warm_start_snapshot_interval=float(env("WARM_START_SNAPSHOT_INTERVAL", "300")),
+        history_retention_days=float(env("HISTORY_RETENTION_DAYS", "8")),
+        trace_sample_rate=float(env("TRACE_SAMPLE_RATE", "0.01")),
+        trace_slow_ms=float(env("TRACE_SLOW_MS", "2000")),
+        trace_dir=env("TRACE_DIR", "traces"),
+        trace_max_bytes=int(env("TRACE_MAX_BYTES", str(10 * 2 ** 20))),
+        cache_dir=env("CACHE_DIR", ".cache"),
+        cache_stale_ttl=int(env("CACHE_STALE_TTL", "21600")),
+        geocode_ttl=int(env("GEOCODE_TTL", "2592000")),
+        cache_ttl_weather_min=float(env("CACHE_TTL_WEATHER_MIN", "120")),
+        cache_ttl_weather_max=float(env("CACHE_TTL_WEATHER_MAX", "600")),
+        cache_ttl_forecast_min=float(env("CACHE_TTL_FORECAST_MIN", "600")),
+        cache_ttl_forecast_max=float(env("CACHE_TTL_FORECAST_MAX", "10800")),
+        cache_ttl_air_min=float(env("CACHE_TTL_AIR_MIN", "600")),
+        cache_ttl_air_max=float(env("CACHE_TTL_AIR_MAX", "3600")),
+        cache_backend=env("CACHE_BACKEND", "sqlite"),
+        cache_compress=env("CACHE_COMPRESS", "0") == "1",
+        cache_memory_entries=int(env("CACHE_MEMORY_ENTRIES", "512")),
+        cache_compact_interval=int(env("CACHE_COMPACT_INTERVAL", "3600")),
+        owm_calls_per_minute=int(env("OWM_CALLS_PER_MINUTE", "60")),
+        owm_calls_per_day=int(env("OWM_CALLS_PER_DAY", "33000")),
+        owm_breaker_window=int(env("OWM_BREAKER_WINDOW", "20")),
+        owm_breaker_min_calls=int(env("OWM_BREAKER_MIN_CALLS", "10")),
+        owm_breaker_error_rate=float(env("OWM_BREAKER_ERROR_RATE", "0.5")),
+        owm_breaker_open_seconds=float(env("OWM_BREAKER_OPEN_SECONDS", "30")),
+        owm_budget_interactive=float(env("OWM_BUDGET_INTERACTIVE", "3")),
+        owm_budget_background=float(env("OWM_BUDGET_BACKGROUND", "30")),
+        owm_hedge=env("OWM_HEDGE", "0") == "1",
+        owm_pool_size=int(env("OWM_POOL_SIZE", "8")),
+        owm_bundle_pool_size=int(env("OWM_BUNDLE_POOL_SIZE", "16")),
+        owm_group_radius_km=float(env("OWM_GROUP_RADIUS_KM", "10")),
+    )
+
 
-load_dotenv()
+def check_bot_settings():
+    """Проверяет настройки, без которых бот не может работать."""
+    if not settings.bot_token:
+        raise ValueError("Переменная окружения BOT_TOKEN не установлена")
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-OW_API_KEY = os.getenv("OW_API_KEY")
+    if not settings.ow_api_key:
+        raise ValueError("Переменная окружения OW_API_KEY не установлена")
 
-if not BOT_TOKEN:
-    raise ValueError("Переменная окружения BOT_TOKEN не установлена")
 
-if not OW_API_KEY:
-    raise ValueError("Переменная окружения OW_API_KEY не установлена")
+settings = load_settings()
 
+BOT_TOKEN = settings.bot_token
+OW_API_KEY = settings.ow_api_key
+STORAGE_FLUSH_INTERVAL = settings.storage_flush_interval
+STORAGE_FLUSH_THRESHOLD = settings.storage_flush_threshold
+STARTUP_LAZY_HYDRATION = settings.startup_lazy_hydration
+NOTIFICATION_RECOVERY_WINDOW = settings.notification_recovery_window
+NOTIFICATION_SEND_RATE = settings.notification_send_rate
+WARM_START = settings.warm_start
+WARM_START_SNAPSHOT_INTERVAL = settings.warm_start_snapshot_interval
@@ -0,0 +1,18 @@
+"""Служебные команды для администраторов бота."""
+
+from config import settings
+from services.stats import collect_stats
+from utils.formatters import format_stats
+
+
+def register_admin_handlers(bot, router):
+    """Регистрирует служебные команды."""
+    
+    @router.command('stats')
+    def stats_handler(message):
+        """Обработчик команды /stats: текущие показатели работы бота.
+        Доступна только пользователям из ADMIN_USER_IDS, остальным бот не отвечает."""
+        if message.from_user.id not in settings.admin_user_ids:
+            return
+        
+        bot.reply_to(message, format_stats(collect_stats()))
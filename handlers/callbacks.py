@@ -1,39 +1,65 @@
 """Обработчики callback-запросов."""
 
-from datetime import datetime
+import io
 from utils.formatters import format_day_details, format_forecast_5days
-from keyboards.inline import create_forecast_days_keyboard, create_back_to_forecast_keyboard
-from services.user_storage import user_data, user_locations
+from keyboards.inline import (
+    create_forecast_days_keyboard, create_back_to_forecast_keyboard, parse_forecast_callback,
+    FORECAST_DAY, FORECAST_BACK, FORECAST_CHART, CALLBACK_VERSION
+)
+from services.weather_api import get_cell_forecast, get_cell_record
+from services.projection import ForecastRecord
+from services.admission import CLASS_FORECAST
+from utils.chart import render_forecast_chart, chart_file_id, remember_chart_file_id, forget_chart_file_id
+from utils.metrics import metrics
 
 
-def register_callback_handlers(bot):
+def register_callback_handlers(bot, router):
     """Регистрирует обработчики callback-запросов."""
     
-    @bot.callback_query_handler(func=lambda c: c.data.startswith('day_'))
+    def show_forecast_days(callback, forecast: ForecastRecord):
+        """Показывает в сообщении список дней прогноза."""
+        text, day_details = format_forecast_5days(forecast)
+        
+        # Создаем inline-клавиатуру с кнопками
+        markup = create_forecast_days_keyboard(day_details)
+        
+        bot.edit_message_text(
+            text,
+            callback.message.chat.id,
+            callback.message.message_id,
+            reply_markup=markup
+        )
+    
+    @router.callback_prefix(FORECAST_DAY + CALLBACK_VERSION + ':')
     def day_details_callback(callback):
         """Обработчик нажатия на день в прогнозе."""
-        user_id = callback.from_user.id
-        
         try:
-            # Извлекаем дату из callback_data
-            day_str = callback.data.split('_', 1)[1]
-            day_key = datetime.strptime(day_str, '%Y-%m-%d').date()
+            # Ячейка и дата закодированы в callback_data, прогноз берем только из общего кэша:
+            # навигация не проходит контроль допуска, поэтому в OWM не обращается
+            parsed = parse_forecast_callback(callback.data)
+            if parsed is None:
+                bot.answer_callback_query(callback.id, "❌ Ошибка: неверные данные")
+                return
+            _, cell, day_key = parsed
             
-            if 'forecast_data' not in user_data[user_id]:
+            forecast = get_cell_record(cell, 'forecast')
+            if forecast is None:
                 bot.answer_callback_query(callback.id, "❌ Данные устарели. Запросите прогноз заново.")
                 return
             
-            day_details = user_data[user_id]['forecast_data']
+            _, day_details = format_forecast_5days(forecast)
             
             if day_key not in day_details:
-                bot.answer_callback_query(callback.id, "❌ День не найден.")
+                # Прогноз обновился и этого дня в нем уже нет — показываем актуальные дни
+                show_forecast_days(callback, forecast)
+                bot.answer_callback_query(callback.id, "❌ День не найден. Прогноз обновлен.")
                 return
             
             day_data = day_details[day_key]
             text = format_day_details(day_data, day_key)
             
             # Кнопка "Назад"
-            markup = create_back_to_forecast_keyboard()
+            markup = create_back_to_forecast_keyboard(cell)
             
             # Редактируем сообщение
             bot.edit_message_text(
@@ -46,33 +72,68 @@ def register_callback_handlers(bot):
         except Exception as e:
             bot.answer_callback_query(callback.id, f"❌ Ошибка: {str(e)}")
     
-    @bot.callback_query_handler(func=lambda c: c.data == "back_to_forecast")
+    @router.callback_prefix(FORECAST_BACK + CALLBACK_VERSION + ':')
     def back_to_forecast_callback(callback):
         """Обработчик возврата к списку дней."""
-        user_id = callback.from_user.id
-        
-        if 'forecast_data' not in user_data[user_id]:
-            bot.answer_callback_query(callback.id, "❌ Данные устарели.")
+        parsed = parse_forecast_callback(callback.data)
+        if parsed is None:
+            bot.answer_callback_query(callback.id, "❌ Ошибка: неверные данные")
             return
         
-        day_details = user_data[user_id]['forecast_data']
-        
-        # Получаем название города из сохраненных данных
-        city_name = "вашем городе"
-        if user_id in user_locations:
-            city_name = user_locations[user_id][2]
-        
-        # Формируем простой текст без деталей
-        text = f"📅 Прогноз погоды на 5 дней в {city_name}\n\nВыберите день для подробного прогноза:"
-        
-        # Создаем inline-клавиатуру с кнопками
-        markup = create_forecast_days_keyboard(day_details)
+        # Как и выбор дня, возврат к списку не обращается в OWM
+        forecast = get_cell_record(parsed[1], 'forecast')
+        if forecast is None:
+            bot.answer_callback_query(callback.id, "❌ Данные устарели. Запросите прогноз заново.")
+            return
         
-        bot.edit_message_text(
-            text,
-            callback.message.chat.id,
-            callback.message.message_id,
-            reply_markup=markup
-        )
+        show_forecast_days(callback, forecast)
         bot.answer_callback_query(callback.id)
-
+    
+    @router.callback_prefix(FORECAST_CHART + CALLBACK_VERSION + ':', admission=CLASS_FORECAST)
+    def forecast_chart_callback(callback):
+        """Обработчик кнопки графика прогноза."""
+        try:
+            parsed = parse_forecast_callback(callback.data)
+            if parsed is None:
+                bot.answer_callback_query(callback.id, "❌ Ошибка: неверные данные")
+                return
+            
+            forecast = get_cell_forecast(parsed[1])
+            if forecast is None:
+                bot.answer_callback_query(callback.id, "❌ Не удалось получить прогноз")
+                return
+            
+            caption = f"📈 Прогноз на 5 дней в {forecast.city_name}: температура и вероятность осадков"
+            chat_id = callback.message.chat.id
+            
+            # График этой версии прогноза уже загружен в Telegram — отправляем по file_id
+            file_id = chart_file_id(forecast)
+            if file_id is not None:
+                try:
+                    bot.send_photo(chat_id, file_id, caption=caption)
+                    metrics.counter('chart.sent.file_id').inc()
+                    bot.answer_callback_query(callback.id)
+                    return
+                except Exception as e:
+                    # 400 — Telegram не принимает file_id: забываем его и загружаем график заново
+                    if getattr(e, 'error_code', None) != 400:
+                        raise
+                    forget_chart_file_id(forecast, file_id)
+                    metrics.counter('chart.file_id.rejected').inc()
+            
+            photo = io.BytesIO(render_forecast_chart(forecast))
+            photo.name = 'forecast.png'
+            msg = bot.send_photo(chat_id, photo, caption=caption)
+            metrics.counter('chart.sent.upload').inc()
+            if msg is not None and msg.photo:
+                # Самый большой размер фото
+                remember_chart_file_id(forecast, msg.photo[-1].file_id)
+            bot.answer_callback_query(callback.id)
+        except Exception as e:
+            bot.answer_callback_query(callback.id, f"❌ Ошибка: {str(e)}")
+    
+    @router.callback_prefix('day_')
+    @router.callback("back_to_forecast")
+    def legacy_forecast_callback(callback):
+        """Кнопки сообщений, отправленных до перехода на callback_data без состояния."""
+        bot.answer_callback_query(callback.id, "❌ Данные устарели. Запросите прогноз заново.")
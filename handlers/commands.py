@@ -1,20 +1,20 @@
 """Обработчики команд бота."""
 
 from keyboards.reply import create_main_menu
-from services.user_storage import load_user_from_storage, user_data
+from services.user_storage import ensure_user_loaded, user_data
 
 
-def register_command_handlers(bot):
+def register_command_handlers(bot, router):
     """Регистрирует обработчики команд."""
     
-    @bot.message_handler(commands=['start'])
+    @router.command('start')
     def start_handler(message):
         """Обработчик команды /start."""
         user_id = message.from_user.id
         user_data[user_id] = {'state': 'main'}
         
-        # Загружаем данные пользователя из хранилища
-        load_user_from_storage(user_id)
+        # Применяем сохраненные данные пользователя, если они отложены при старте
+        ensure_user_loaded(user_id)
         
         welcome_text = (
             "👋 Добро пожаловать в бота погоды!\n\n"
@@ -28,7 +28,7 @@ def register_command_handlers(bot):
         )
         bot.reply_to(message, welcome_text, reply_markup=create_main_menu())
     
-    @bot.message_handler(commands=['help'])
+    @router.command('help')
     def help_handler(message):
         """Обработчик команды /help."""
         help_text = (
@@ -1,47 +1,71 @@
 """Обработчики для сравнения городов."""
 
-from services.weather_api import get_current_weather, get_coordinates
-from utils.formatters import format_cities_comparison
+from services.weather_api import resolve_city, fetch_bundle, PART_CURRENT, PART_AIR
+from services.admission import CLASS_COMPARE
+from utils.formatters import format_cities_comparison, format_cities_ranking, format_retry_after
 from keyboards.reply import create_main_menu
 from services.user_storage import user_data
+from app.router import STATE_MAIN, STATE_WAITING_CITY1, STATE_WAITING_CITY2
 
 
-def register_comparison_handlers(bot):
+MAX_COMPARE_CITIES = 10  # Сколько городов можно сравнить одним сообщением
+
+
+def parse_cities(text: str) -> list[str]:
+    """Разбирает список городов через запятую или точку с запятой, без повторов."""
+    cities = []
+    seen = set()
+    for city in text.replace(';', ',').split(','):
+        city = city.strip()
+        if city and city.lower() not in seen:
+            seen.add(city.lower())
+            cities.append(city)
+    return cities
+
+
+def register_comparison_handlers(bot, router):
     """Регистрирует обработчики сравнения городов."""
     
-    @bot.message_handler(func=lambda m: m.text == "⚖️ Сравнение городов")
+    @router.text("⚖️ Сравнение городов")
     def compare_cities_handler(message):
         """Обработчик сравнения городов."""
         user_id = message.from_user.id
-        user_data[user_id]['state'] = 'waiting_city1'
-        bot.reply_to(message, "Введите название первого города:", reply_markup=create_main_menu())
+        router.transition(user_id, STATE_WAITING_CITY1)
+        bot.reply_to(
+            message,
+            f"Введите название первого города или до {MAX_COMPARE_CITIES} городов через запятую:",
+            reply_markup=create_main_menu()
+        )
     
-    @bot.message_handler(func=lambda m: user_data.get(m.from_user.id, {}).get('state') == 'waiting_city1')
+    @router.state(STATE_WAITING_CITY1, admission=CLASS_COMPARE)
     def process_city1(message):
         """Обрабатывает первый город для сравнения."""
         user_id = message.from_user.id
-        city1 = message.text.strip()
+        cities = parse_cities(message.text)
         
-        if not city1:
+        if not cities:
             bot.reply_to(message, "❌ Пожалуйста, введите название города.", reply_markup=create_main_menu())
             return
         
-        coords1 = get_coordinates(city1)
-        if coords1 is None:
-            bot.reply_to(message, "❌ Город не найден. Попробуйте еще раз.", reply_markup=create_main_menu())
+        if len(cities) > 1:
+            compare_many(message, cities)
             return
         
-        lat1, lon1 = coords1
-        weather1 = get_current_weather(lat1, lon1)
-        if weather1 is None:
-            bot.reply_to(message, "❌ Не удалось получить данные о погоде для первого города. Попробуйте позже.", reply_markup=create_main_menu())
+        city1 = cities[0]
+        coords1, not_found = resolve_city(city1)
+        if not_found:
+            bot.reply_to(message, "❌ Город не найден. Попробуйте еще раз.", reply_markup=create_main_menu())
+            return
+        if coords1 is None:
+            bot.reply_to(message, "❌ Не удалось определить координаты города. Попробуйте позже.", reply_markup=create_main_menu())
             return
         
-        user_data[user_id]['compare_city1'] = (city1, weather1)
-        user_data[user_id]['state'] = 'waiting_city2'
+        # Погода запрашивается после ввода второго города, для обоих сразу
+        user_data[user_id]['compare_city1'] = (city1, coords1)
+        router.transition(user_id, STATE_WAITING_CITY2)
         bot.reply_to(message, f"✅ Первый город: {city1}\nВведите название второго города:", reply_markup=create_main_menu())
     
-    @bot.message_handler(func=lambda m: user_data.get(m.from_user.id, {}).get('state') == 'waiting_city2')
+    @router.state(STATE_WAITING_CITY2, admission=CLASS_COMPARE)
     def process_city2(message):
         """Обрабатывает второй город для сравнения."""
         user_id = message.from_user.id
@@ -51,29 +75,67 @@ def register_comparison_handlers(bot):
             bot.reply_to(message, "❌ Пожалуйста, введите название города.", reply_markup=create_main_menu())
             return
         
-        coords2 = get_coordinates(city2)
-        if coords2 is None:
+        if 'compare_city1' not in user_data[user_id]:
+            bot.reply_to(message, "❌ Ошибка: данные о первом городе не найдены. Начните заново.", reply_markup=create_main_menu())
+            router.transition(user_id, STATE_MAIN)
+            return
+        
+        city1, coords1 = user_data[user_id]['compare_city1']
+        bundle1, bundle2 = fetch_bundle([coords1, city2], (PART_CURRENT,))
+        if bundle2.not_found:
             bot.reply_to(message, "❌ Город не найден. Попробуйте еще раз.", reply_markup=create_main_menu())
             return
+        if bundle2.coords is None:
+            bot.reply_to(message, "❌ Не удалось определить координаты второго города. Попробуйте позже.", reply_markup=create_main_menu())
+            return
         
-        lat2, lon2 = coords2
-        weather2 = get_current_weather(lat2, lon2)
+        weather1, weather2 = bundle1.current, bundle2.current
+        if weather1 is None:
+            bot.reply_to(message, "❌ Не удалось получить данные о погоде для первого города. Попробуйте позже.", reply_markup=create_main_menu())
+            return
         if weather2 is None:
             bot.reply_to(message, "❌ Не удалось получить данные о погоде для второго города. Попробуйте позже.", reply_markup=create_main_menu())
             return
         
-        if 'compare_city1' not in user_data[user_id]:
-            bot.reply_to(message, "❌ Ошибка: данные о первом городе не найдены. Начните заново.", reply_markup=create_main_menu())
-            user_data[user_id]['state'] = 'main'
-            return
-        
-        city1, weather1 = user_data[user_id]['compare_city1']
-        
         comparison_text = format_cities_comparison(city1, weather1, city2, weather2)
         bot.reply_to(message, comparison_text, reply_markup=create_main_menu())
         
         # Очищаем состояние
-        user_data[user_id]['state'] = 'main'
+        router.transition(user_id, STATE_MAIN)
         if 'compare_city1' in user_data[user_id]:
             del user_data[user_id]['compare_city1']
 
+    
+    def compare_many(message, cities: list[str]):
+        """Сравнивает несколько городов из одного сообщения: все данные запрашиваются параллельно."""
+        user_id = message.from_user.id
+        if len(cities) > MAX_COMPARE_CITIES:
+            bot.reply_to(
+                message,
+                f"❌ Можно сравнить не более {MAX_COMPARE_CITIES} городов. Попробуйте еще раз.",
+                reply_markup=create_main_menu()
+            )
+            return
+        
+        bot.reply_to(message, "🔍 Загрузка данных...", reply_markup=create_main_menu())
+        results, not_found, failed = [], [], []
+        for bundle in fetch_bundle(cities, (PART_CURRENT, PART_AIR)):
+            if bundle.not_found:
+                not_found.append(bundle.location)
+            elif bundle.coords is None or bundle.current is None:
+                # Координаты или погода не получены к сроку — это сбой, а не отсутствие города
+                failed.append(bundle.location)
+            else:
+                results.append((bundle.location, bundle.current, bundle.air))
+        
+        if not results:
+            bot.reply_to(message, "❌ Не удалось получить данные о погоде ни для одного города. Попробуйте еще раз.", reply_markup=create_main_menu())
+            return
+        
+        bot.reply_to(message, format_cities_ranking(results, not_found, failed), reply_markup=create_main_menu())
+        router.transition(user_id, STATE_MAIN)
+    
+    @router.degraded(CLASS_COMPARE)
+    def compare_degraded(message, retry_after):
+        """Сравнение не допущено: просим повторить позже, состояние диалога сохраняется."""
+        bot.reply_to(message, format_retry_after(retry_after), reply_markup=create_main_menu())
@@ -7,16 +7,24 @@
 
 import hashlib
 from telebot import types
-from services.weather_api import get_current_weather, get_coordinates, get_forecast_5d3h
-from utils.formatters import format_current_weather, format_forecast_5days
-from keyboards.inline import create_forecast_days_keyboard
-from services.user_storage import user_data
+from services.weather_api import (
+    get_current_weather, get_coordinates, get_cell_forecast, cached_bundle, location_cell, PART_CURRENT
+)
+from services.governor import PRIORITY_INLINE
+from services.admission import admission, CLASS_INLINE, CLASS_FORECAST
+from utils.tracing import traced_update
+from utils.formatters import format_current_weather, format_forecast_5days, format_retry_after
+from keyboards.inline import (
+    create_forecast_days_keyboard, forecast_callback, parse_forecast_callback,
+    FORECAST_LIST, CALLBACK_VERSION
+)
 
 
-def register_inline_handlers(bot):
+def register_inline_handlers(bot, router):
     """Регистрирует обработчики inline-режима."""
     
     @bot.inline_handler(func=lambda query: len(query.query) > 0)
+    @traced_update('inline_query')
     def query_text(inline_query):
         """Обработчик inline-запросов для поиска городов."""
         query = inline_query.query.strip()
@@ -24,20 +32,41 @@ def register_inline_handlers(bot):
         if not query or len(query) < 2:
             return
         
-        # Получаем координаты города
-        coords = get_coordinates(query)
-        if coords is None:
-            return  # Город не найден, просто игнорируем
+        # Inline-запросы приходят на каждое нажатие клавиши, поэтому проходят контроль допуска
+        user_id = inline_query.from_user.id
+        retry_after = admission.try_admit(CLASS_INLINE, user_id)
+        if retry_after:
+            # Не допущен: отвечаем из кэша или просим повторить позже
+            bundle = cached_bundle([query], (PART_CURRENT,))[0]
+            if bundle.current is None:
+                bot.answer_inline_query(
+                    inline_query.id, [], cache_time=1, is_personal=True,
+                    switch_pm_text=format_retry_after(retry_after), switch_pm_parameter='start'
+                )
+                return
+            answer_weather(inline_query, query, bundle.coords, bundle.current)
+            return
+        try:
+            # Получаем координаты города
+            coords = get_coordinates(query, priority=PRIORITY_INLINE)
+            if coords is None:
+                return  # Город не найден, просто игнорируем
+            
+            weather = get_current_weather(coords[0], coords[1], priority=PRIORITY_INLINE)
+            if weather is None:
+                return  # Не удалось получить погоду, игнорируем
+        finally:
+            admission.release(CLASS_INLINE, user_id)
         
+        answer_weather(inline_query, query, coords, weather)
+    
+    def answer_weather(inline_query, query: str, coords: tuple, weather):
+        """Отвечает на inline-запрос карточкой погоды."""
         lat, lon = coords
-        weather = get_current_weather(lat, lon)
-        if weather is None:
-            return  # Не удалось получить погоду, игнорируем
-        
-        temp = weather['main']['temp']
-        feels_like = weather['main']['feels_like']
-        description = weather['weather'][0]['description'].capitalize()
-        city_name = weather.get('name', query)
+        temp = weather.temp
+        feels_like = weather.feels_like
+        description = weather.description.capitalize()
+        city_name = weather.name or query
         
         # Формируем текст результата
         result_text = f"🌤️ Погода в {city_name}\n\n"
@@ -58,37 +87,37 @@ def register_inline_handlers(bot):
             reply_markup=types.InlineKeyboardMarkup().add(
                 types.InlineKeyboardButton(
                     text="📅 Прогноз на 5 дней",
-                    callback_data=f"inline_forecast_{lat}_{lon}"
+                    callback_data=forecast_callback(FORECAST_LIST, location_cell(lat, lon))
                 )
             )
         )
         
         bot.answer_inline_query(inline_query.id, [result], cache_time=300)
     
-    @bot.callback_query_handler(func=lambda c: c.data.startswith('inline_forecast_'))
+    @router.callback_prefix(FORECAST_LIST + CALLBACK_VERSION + ':', admission=CLASS_FORECAST)
+    @router.callback_prefix('inline_forecast_', admission=CLASS_FORECAST)
     def inline_forecast_callback(callback):
         """Обработчик inline-кнопки для прогноза на 5 дней."""
-        user_id = callback.from_user.id
+        # Извлекаем ячейку местоположения из callback_data
+        parsed = parse_forecast_callback(callback.data)
+        if parsed is not None:
+            cell = parsed[1]
+        else:
+            # Кнопки, отправленные до перехода на компактный формат: inline_forecast_{lat}_{lon}
+            try:
+                parts = callback.data.split('_')
+                cell = location_cell(float(parts[2]), float(parts[3]))
+            except (ValueError, IndexError):
+                bot.answer_callback_query(callback.id, "❌ Ошибка: неверные данные")
+                return
         
-        # Извлекаем координаты из callback_data
-        try:
-            parts = callback.data.split('_')
-            lat = float(parts[2])
-            lon = float(parts[3])
-        except (ValueError, IndexError):
-            bot.answer_callback_query(callback.id, "❌ Ошибка: неверные данные")
-            return
-        
-        forecast = get_forecast_5d3h(lat, lon)
+        forecast = get_cell_forecast(cell, cached_first=False)
         if forecast is None:
             bot.answer_callback_query(callback.id, "❌ Не удалось получить прогноз")
             return
         
         text, day_details = format_forecast_5days(forecast)
         
-        # Сохраняем данные для навигации
-        user_data[user_id]['forecast_data'] = day_details
-        
         # Создаем inline-клавиатуру с днями
         markup = create_forecast_days_keyboard(day_details)
         
@@ -1,17 +1,20 @@
 """Обработчики для работы с геолокацией."""
 
 from services.weather_api import get_current_weather
+from services.history import observation_time
+from services.admission import CLASS_WEATHER
 from utils.formatters import format_current_weather
 from keyboards.reply import create_main_menu
 from services.user_storage import (
-    user_data, user_locations, save_user_to_storage, last_weather
+    user_locations, user_city_ids, save_user_to_storage, last_observed,
+    update_subscription
 )
 
 
-def register_location_handlers(bot):
+def register_location_handlers(bot, router):
     """Регистрирует обработчики геолокации."""
     
-    @bot.message_handler(content_types=['location'], func=lambda m: user_data.get(m.from_user.id, {}).get('state') not in ['waiting_extended', 'waiting_forecast_city'])
+    @router.default('location', admission=CLASS_WEATHER)
     def location_handler(message):
         """Обработчик получения местоположения."""
         user_id = message.from_user.id
@@ -29,13 +32,19 @@ def register_location_handlers(bot):
             bot.reply_to(message, "❌ Не удалось получить данные о погоде. Попробуйте позже.", reply_markup=create_main_menu())
             return
         
-        city_name = weather.get('name', 'Неизвестно')
+        city_name = weather.name or 'Неизвестно'
         
         # Сохраняем местоположение
         user_locations[user_id] = (lat, lon, city_name)
-        
-        # Сохраняем текущую погоду для уведомлений
-        last_weather[user_id] = weather
+        # Город OWM нужен для пакетных запросов при рассылке уведомлений
+        if weather.city_id:
+            user_city_ids[user_id] = weather.city_id
+        else:
+            user_city_ids.pop(user_id, None)
+        update_subscription(user_id)
+        
+        # Сохраняем текущую температуру для уведомлений
+        last_observed[user_id] = observation_time(weather)
         
         # Сохраняем в хранилище
         save_user_to_storage(user_id)
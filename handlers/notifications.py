@@ -1,28 +1,30 @@
 """Обработчики для работы с уведомлениями."""
 
 from services.weather_api import get_current_weather
+from services.history import observation_time
 from keyboards.reply import create_main_menu
-from keyboards.inline import create_notifications_menu_keyboard
+from keyboards.inline import create_notifications_menu_keyboard, create_notification_rules_keyboard
+from services.notification_rules import RULE_TYPES, user_rules, next_threshold
 from services.user_storage import (
-    user_data, user_locations, notifications_enabled, notification_intervals,
-    save_user_to_storage, last_weather, last_notification_check
+    users, user_locations, notifications_enabled, notification_intervals,
+    notification_rules, notification_alerts, save_user_to_storage, last_observed, last_notification_check,
+    notification_next_due, last_notification_sent, update_subscription
 )
+from services.notifications import schedule_next_check
+from app.router import STATE_MAIN, STATE_WAITING_NOTIF_INTERVAL
 
 
-def register_notification_handlers(bot):
+def register_notification_handlers(bot, router):
     """Регистрирует обработчики уведомлений."""
     
-    @bot.message_handler(func=lambda m: m.text == "🔔 Погодные уведомления")
+    @router.text("🔔 Погодные уведомления")
     def notifications_handler(message):
         """Обработчик управления уведомлениями."""
         user_id = message.from_user.id
         
-        if user_id not in notifications_enabled:
-            notifications_enabled[user_id] = False
-        if user_id not in notification_intervals:
-            notification_intervals[user_id] = 2
+        notification_intervals.setdefault(user_id, 2)
         
-        if notifications_enabled[user_id]:
+        if notifications_enabled.setdefault(user_id, False):
             # Показываем меню управления уведомлениями
             interval = notification_intervals.get(user_id, 2)
             markup = create_notifications_menu_keyboard(interval)
@@ -33,29 +35,31 @@ def register_notification_handlers(bot):
                 return
             
             notifications_enabled[user_id] = True
-            if user_id not in notification_intervals:
-                notification_intervals[user_id] = 2
             
             # Сохраняем текущую погоду для отслеживания изменений
             lat, lon, city_name = user_locations[user_id]
             weather = get_current_weather(lat, lon)
             if weather:
-                last_weather[user_id] = weather
+                last_observed[user_id] = observation_time(weather)
             
+            update_subscription(user_id)
             save_user_to_storage(user_id)  # Сохраняем изменения
-            interval = notification_intervals[user_id]
+            interval = notification_intervals.get(user_id, 2)
             bot.reply_to(message, f"🔔 Уведомления включены. Бот будет проверять погоду каждые {interval} часов.", reply_markup=create_main_menu())
     
-    @bot.callback_query_handler(func=lambda c: c.data == "notif_off")
+    @router.callback("notif_off")
     def notifications_off_callback(callback):
         """Обработчик отключения уведомлений."""
         user_id = callback.from_user.id
-        notifications_enabled[user_id] = False
-        # Очищаем данные о погоде и времени проверки при отключении
-        if user_id in last_weather:
-            del last_weather[user_id]
-        if user_id in last_notification_check:
-            del last_notification_check[user_id]
+        with users.lock(user_id):
+            notifications_enabled[user_id] = False
+            # Очищаем данные о погоде и времени проверки при отключении
+            last_observed.pop(user_id, None)
+            last_notification_check.pop(user_id, None)
+            notification_next_due.pop(user_id, None)
+            last_notification_sent.pop(user_id, None)
+            notification_alerts.pop(user_id, None)
+        update_subscription(user_id)
         save_user_to_storage(user_id)
         bot.answer_callback_query(callback.id, "🔕 Уведомления отключены")
         bot.edit_message_text(
@@ -64,11 +68,66 @@ def register_notification_handlers(bot):
             callback.message.message_id
         )
     
-    @bot.callback_query_handler(func=lambda c: c.data == "notif_interval")
+    @router.callback("notif_menu")
+    def notifications_menu_callback(callback):
+        """Обработчик возврата в меню уведомлений."""
+        user_id = callback.from_user.id
+        interval = notification_intervals.get(user_id, 2)
+        bot.answer_callback_query(callback.id)
+        bot.edit_message_text(
+            f"🔔 Уведомления включены (интервал: {interval}ч)\n\nВыберите действие:",
+            callback.message.chat.id,
+            callback.message.message_id,
+            reply_markup=create_notifications_menu_keyboard(interval)
+        )
+    
+    @router.callback("notif_rules")
+    def notification_rules_callback(callback):
+        """Обработчик открытия меню правил уведомлений."""
+        user_id = callback.from_user.id
+        rules = user_rules(notification_rules.get(user_id))
+        bot.answer_callback_query(callback.id)
+        bot.edit_message_text(
+            "⚙️ Правила уведомлений\n\nНажмите на правило, чтобы изменить порог или выключить его:",
+            callback.message.chat.id,
+            callback.message.message_id,
+            reply_markup=create_notification_rules_keyboard(tuple(sorted(rules.items())))
+        )
+    
+    @router.callback_prefix("rule_")
+    def notification_rule_toggle_callback(callback):
+        """Обработчик переключения порога правила уведомлений."""
+        user_id = callback.from_user.id
+        rule_type = callback.data.split('_', 1)[1]
+        if rule_type not in RULE_TYPES:
+            bot.answer_callback_query(callback.id, "❌ Неизвестное правило.")
+            return
+        
+        def toggle(stored):
+            rules = dict(user_rules(stored))
+            threshold = next_threshold(rule_type, rules.get(rule_type))
+            if threshold is None:
+                rules.pop(rule_type, None)
+            else:
+                rules[rule_type] = threshold
+            return rules
+        
+        # Два быстрых нажатия из разных потоков не должны потерять одно из изменений
+        rules = notification_rules.apply(user_id, toggle)
+        save_user_to_storage(user_id)
+        
+        bot.answer_callback_query(callback.id)
+        bot.edit_message_reply_markup(
+            callback.message.chat.id,
+            callback.message.message_id,
+            reply_markup=create_notification_rules_keyboard(tuple(sorted(rules.items())))
+        )
+    
+    @router.callback("notif_interval")
     def notifications_interval_callback(callback):
         """Обработчик настройки интервала уведомлений."""
         user_id = callback.from_user.id
-        user_data[user_id]['state'] = 'waiting_notif_interval'
+        router.transition(user_id, STATE_WAITING_NOTIF_INTERVAL)
         bot.answer_callback_query(callback.id)
         bot.edit_message_text(
             "⏰ Введите интервал уведомлений в часах (от 1 до 24):",
@@ -76,7 +135,7 @@ def register_notification_handlers(bot):
             callback.message.message_id
         )
     
-    @bot.message_handler(func=lambda m: user_data.get(m.from_user.id, {}).get('state') == 'waiting_notif_interval')
+    @router.state(STATE_WAITING_NOTIF_INTERVAL)
     def process_notification_interval(message):
         """Обрабатывает введенный интервал уведомлений."""
         user_id = message.from_user.id
@@ -87,9 +146,9 @@ def register_notification_handlers(bot):
                 return
             
             notification_intervals[user_id] = interval
-            save_user_to_storage(user_id)
+            schedule_next_check(user_id)
             bot.reply_to(message, f"✅ Интервал уведомлений установлен: {interval} часов.", reply_markup=create_main_menu())
-            user_data[user_id]['state'] = 'main'
+            router.transition(user_id, STATE_MAIN)
         except ValueError:
             bot.reply_to(message, "❌ Пожалуйста, введите число от 1 до 24.", reply_markup=create_main_menu())
 
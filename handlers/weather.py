@@ -1,23 +1,33 @@
 """Обработчики для работы с погодой."""
 
-from services.weather_api import get_current_weather, get_coordinates, get_forecast_5d3h
-from utils.formatters import format_current_weather, format_forecast_5days, format_extended_weather
+from services.weather_api import (
+    get_current_weather, get_coordinates, get_forecast_5d3h, fetch_bundle, cached_bundle,
+    PART_CURRENT, PART_FORECAST, PART_AIR
+)
+from services.admission import CLASS_WEATHER, CLASS_FORECAST, CLASS_EXTENDED
+from utils.formatters import (
+    format_current_weather, format_forecast_5days, format_extended_weather,
+    format_retry_after, format_cached_notice
+)
 from keyboards.reply import create_main_menu
 from keyboards.inline import create_forecast_days_keyboard
-from services.user_storage import user_data, user_locations, save_user_to_storage, last_weather
+from services.user_storage import user_data, user_locations, save_user_to_storage
+from app.router import (
+    STATE_MAIN, STATE_WAITING_CITY, STATE_WAITING_FORECAST_CITY, STATE_WAITING_EXTENDED
+)
 
 
-def register_weather_handlers(bot):
+def register_weather_handlers(bot, router):
     """Регистрирует обработчики погоды."""
     
-    @bot.message_handler(func=lambda m: m.text == "🌤️ Прогноз по городу")
+    @router.text("🌤️ Прогноз по городу")
     def weather_by_city_handler(message):
         """Обработчик запроса прогноза по городу."""
         user_id = message.from_user.id
-        user_data[user_id]['state'] = 'waiting_city'
+        router.transition(user_id, STATE_WAITING_CITY)
         bot.reply_to(message, "Введите название города:", reply_markup=create_main_menu())
     
-    @bot.message_handler(func=lambda m: user_data.get(m.from_user.id, {}).get('state') == 'waiting_city')
+    @router.state(STATE_WAITING_CITY, admission=CLASS_WEATHER)
     def process_city(message):
         """Обрабатывает введенное название города."""
         user_id = message.from_user.id
@@ -41,9 +51,9 @@ def register_weather_handlers(bot):
         
         response_text = format_current_weather(weather, city)
         bot.reply_to(message, response_text, reply_markup=create_main_menu())
-        user_data[user_id]['state'] = 'main'
+        router.transition(user_id, STATE_MAIN)
     
-    @bot.message_handler(func=lambda m: m.text == "📅 Прогноз на 5 дней")
+    @router.text("📅 Прогноз на 5 дней", admission=CLASS_FORECAST)
     def forecast_5days_handler(message):
         """Обработчик прогноза на 5 дней."""
         user_id = message.from_user.id
@@ -60,9 +70,6 @@ def register_weather_handlers(bot):
             
             text, day_details = format_forecast_5days(forecast)
             
-            # Сохраняем данные для навигации
-            user_data[user_id]['forecast_data'] = day_details
-            
             # Создаем inline-клавиатуру с днями
             markup = create_forecast_days_keyboard(day_details)
             
@@ -70,43 +77,40 @@ def register_weather_handlers(bot):
             user_data[user_id]['forecast_message_id'] = msg.message_id
         else:
             # Просим ввести город или отправить местоположение
-            user_data[user_id]['state'] = 'waiting_forecast_city'
+            router.transition(user_id, STATE_WAITING_FORECAST_CITY)
             bot.reply_to(message, "Введите название города или отправьте местоположение:", reply_markup=create_main_menu())
     
-    @bot.message_handler(content_types=['location'], func=lambda m: user_data.get(m.from_user.id, {}).get('state') == 'waiting_forecast_city')
+    @router.state(STATE_WAITING_FORECAST_CITY, content_types=('location',), admission=CLASS_FORECAST)
     def process_forecast_location(message):
         """Обрабатывает геолокацию для прогноза на 5 дней."""
         user_id = message.from_user.id
         lat = message.location.latitude
         lon = message.location.longitude
         
-        # Получаем название города по координатам
-        weather = get_current_weather(lat, lon)
+        # Текущая погода нужна для названия города; запрашиваем ее вместе с прогнозом
+        bot.reply_to(message, "🔍 Загрузка прогноза...", reply_markup=create_main_menu())
+        bundle = fetch_bundle([(lat, lon)], (PART_CURRENT, PART_FORECAST))[0]
+        weather, forecast = bundle.current, bundle.forecast
         if weather is None:
             bot.reply_to(message, "❌ Не удалось получить данные о погоде. Попробуйте позже.", reply_markup=create_main_menu())
             return
         
-        city_name = weather.get('name', 'Неизвестно')
+        city_name = weather.name or 'Неизвестно'
         
-        bot.reply_to(message, "🔍 Загрузка прогноза...", reply_markup=create_main_menu())
-        forecast = get_forecast_5d3h(lat, lon)
         if forecast is None:
             bot.reply_to(message, "❌ Не удалось получить прогноз погоды. Попробуйте позже.", reply_markup=create_main_menu())
             return
         
         text, day_details = format_forecast_5days(forecast)
         
-        # Сохраняем данные для навигации
-        user_data[user_id]['forecast_data'] = day_details
-        
         # Создаем inline-клавиатуру с днями
         markup = create_forecast_days_keyboard(day_details)
         
         msg = bot.reply_to(message, text, reply_markup=markup)
         user_data[user_id]['forecast_message_id'] = msg.message_id
-        user_data[user_id]['state'] = 'main'
+        router.transition(user_id, STATE_MAIN)
     
-    @bot.message_handler(func=lambda m: user_data.get(m.from_user.id, {}).get('state') == 'waiting_forecast_city' and m.content_type == 'text')
+    @router.state(STATE_WAITING_FORECAST_CITY, admission=CLASS_FORECAST)
     def process_forecast_city(message):
         """Обрабатывает введенный город для прогноза на 5 дней."""
         user_id = message.from_user.id
@@ -133,24 +137,21 @@ def register_weather_handlers(bot):
         
         text, day_details = format_forecast_5days(forecast)
         
-        # Сохраняем данные для навигации
-        user_data[user_id]['forecast_data'] = day_details
-        
         # Создаем inline-клавиатуру с днями
         markup = create_forecast_days_keyboard(day_details)
         
         msg = bot.reply_to(message, text, reply_markup=markup)
         user_data[user_id]['forecast_message_id'] = msg.message_id
-        user_data[user_id]['state'] = 'main'
+        router.transition(user_id, STATE_MAIN)
     
-    @bot.message_handler(func=lambda m: m.text == "📊 Расширенные данные")
+    @router.text("📊 Расширенные данные")
     def extended_data_handler(message):
         """Обработчик расширенных данных."""
         user_id = message.from_user.id
-        user_data[user_id]['state'] = 'waiting_extended'
+        router.transition(user_id, STATE_WAITING_EXTENDED)
         bot.reply_to(message, "Введите название города или отправьте местоположение:", reply_markup=create_main_menu())
     
-    @bot.message_handler(func=lambda m: user_data.get(m.from_user.id, {}).get('state') == 'waiting_extended' and m.content_type == 'text')
+    @router.state(STATE_WAITING_EXTENDED, admission=CLASS_EXTENDED)
     def process_extended_text(message):
         """Обрабатывает запрос расширенных данных по тексту (город)."""
         user_id = message.from_user.id
@@ -160,26 +161,27 @@ def register_weather_handlers(bot):
             bot.reply_to(message, "❌ Пожалуйста, введите название города или отправьте местоположение.", reply_markup=create_main_menu())
             return
         
-        coords = get_coordinates(city)
-        if coords is None:
+        bot.reply_to(message, "🔍 Загрузка расширенных данных...", reply_markup=create_main_menu())
+        # Координаты, затем погода и воздух параллельно в одном бюджете времени
+        bundle = fetch_bundle([city], (PART_CURRENT, PART_AIR))[0]
+        if bundle.not_found:
             bot.reply_to(message, "❌ Город не найден. Попробуйте еще раз.", reply_markup=create_main_menu())
             return
         
-        lat, lon = coords
-        city_name = city
+        if bundle.coords is None:
+            bot.reply_to(message, "❌ Не удалось определить координаты города. Попробуйте позже.", reply_markup=create_main_menu())
+            return
         
-        bot.reply_to(message, "🔍 Загрузка расширенных данных...", reply_markup=create_main_menu())
-        weather = get_current_weather(lat, lon)
-        if weather is None:
+        if bundle.current is None:
             bot.reply_to(message, "❌ Не удалось получить данные о погоде. Попробуйте позже.", reply_markup=create_main_menu())
             return
         
-        extended_text = format_extended_weather(weather, city_name, lat, lon)
+        extended_text = format_extended_weather(bundle.current, city, bundle.air)
         bot.reply_to(message, extended_text, reply_markup=create_main_menu())
         
-        user_data[user_id]['state'] = 'main'
+        router.transition(user_id, STATE_MAIN)
     
-    @bot.message_handler(content_types=['location'], func=lambda m: user_data.get(m.from_user.id, {}).get('state') == 'waiting_extended')
+    @router.state(STATE_WAITING_EXTENDED, content_types=('location',), admission=CLASS_EXTENDED)
     def process_extended_location(message):
         """Обрабатывает запрос расширенных данных по геолокации."""
         user_id = message.from_user.id
@@ -187,15 +189,53 @@ def register_weather_handlers(bot):
         lon = message.location.longitude
         
         bot.reply_to(message, "🔍 Загрузка расширенных данных...", reply_markup=create_main_menu())
-        weather = get_current_weather(lat, lon)
+        bundle = fetch_bundle([(lat, lon)], (PART_CURRENT, PART_AIR))[0]
+        weather = bundle.current
         if weather is None:
             bot.reply_to(message, "❌ Не удалось получить данные о погоде. Попробуйте позже.", reply_markup=create_main_menu())
             return
         
-        city_name = weather.get('name', 'Неизвестно')
+        city_name = weather.name or 'Неизвестно'
         
-        extended_text = format_extended_weather(weather, city_name, lat, lon)
+        extended_text = format_extended_weather(weather, city_name, bundle.air)
         bot.reply_to(message, extended_text, reply_markup=create_main_menu())
         
-        user_data[user_id]['state'] = 'main'
-
+        router.transition(user_id, STATE_MAIN)
+    
+    def requested_location(message):
+        """Местоположение из сообщения: (lat, lon) или название города."""
+        if message.content_type == 'location':
+            return message.location.latitude, message.location.longitude
+        return (message.text or '').strip()
+    
+    @router.degraded(CLASS_WEATHER)
+    def weather_degraded(message, retry_after):
+        """Погода не допущена: отвечаем сохраненными данными, если они есть."""
+        location = requested_location(message)
+        weather = cached_bundle([location], (PART_CURRENT,))[0].current
+        if weather is None:
+            bot.reply_to(message, format_retry_after(retry_after), reply_markup=create_main_menu())
+            return
+        city_name = location if isinstance(location, str) else weather.name or 'Неизвестно'
+        text = format_current_weather(weather, city_name) + format_cached_notice(retry_after)
+        bot.reply_to(message, text, reply_markup=create_main_menu())
+    
+    @router.degraded(CLASS_EXTENDED)
+    def extended_degraded(message, retry_after):
+        """Расширенные данные не допущены: отвечаем сохраненными данными, если они есть."""
+        location = requested_location(message)
+        bundle = cached_bundle([location], (PART_CURRENT, PART_AIR))[0]
+        if bundle.current is None:
+            bot.reply_to(message, format_retry_after(retry_after), reply_markup=create_main_menu())
+            return
+        city_name = location if isinstance(location, str) else bundle.current.name or 'Неизвестно'
+        text = format_extended_weather(bundle.current, city_name, bundle.air) + format_cached_notice(retry_after)
+        bot.reply_to(message, text, reply_markup=create_main_menu())
+    
+    @router.degraded(CLASS_FORECAST)
+    def forecast_degraded(update, retry_after):
+        """Прогноз не допущен: просим повторить позже."""
+        if hasattr(update, 'content_type'):
+            bot.reply_to(update, format_retry_after(retry_after), reply_markup=create_main_menu())
+        else:
+            bot.answer_callback_query(update.id, format_retry_after(retry_after))
@@ -1,16 +1,86 @@
 """Inline клавиатуры."""
 
+from functools import lru_cache
+from typing import Optional
 from telebot import types
-from datetime import datetime
+from datetime import date, timedelta
 from utils.icons import get_weather_icon
+from utils.render_cache import cached_render
+from services.notification_rules import RULE_TYPES, describe_rule
+from services.weather_api import location_cell
 
 
-def create_forecast_days_keyboard(day_details: dict) -> types.InlineKeyboardMarkup:
-    """Создает inline-клавиатуру с днями прогноза."""
+# Навигация по прогнозу не хранит состояние в памяти: callback_data содержит
+# версию формата, ячейку местоположения и день, а прогноз берется из общего кэша.
+# "fd1:55.75,37.62:fuog:2" — день (ячейка, первый день прогноза в base36, номер дня),
+# "fb1:55.75,37.62" — назад к списку дней, "fl1:55.75,37.62" — список дней из inline-режима,
+# "fg1:55.75,37.62" — график прогноза.
+# Первый день прогноза задает начало отсчета номера дня, поэтому кнопка указывает на ту же
+# дату и после обновления прогноза в кэше. Длина не превышает 64 байт — лимита Telegram.
+CALLBACK_VERSION = '1'
+FORECAST_DAY = 'fd'
+FORECAST_BACK = 'fb'
+FORECAST_LIST = 'fl'
+FORECAST_CHART = 'fg'
+FORECAST_CALLBACK_PREFIXES = tuple(
+    kind + CALLBACK_VERSION + ':' for kind in (FORECAST_DAY, FORECAST_BACK, FORECAST_LIST, FORECAST_CHART)
+)
+
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _to_base36(value: int) -> str:
+    digits = ''
+    while True:
+        value, digit = divmod(value, 36)
+        digits = _BASE36[digit] + digits
+        if not value:
+            return digits
+
+
+def forecast_callback(kind: str, cell: str, first_day: Optional[date] = None, index: int = 0) -> str:
+    """Кодирует callback_data навигации по прогнозу ячейки."""
+    data = f"{kind}{CALLBACK_VERSION}:{cell}"
+    if kind == FORECAST_DAY:
+        data += f":{_to_base36(first_day.toordinal())}:{index}"
+    return data
+
+
+def parse_forecast_callback(data: str) -> Optional[tuple]:
+    """Разбирает callback_data навигации по прогнозу.
+    Возвращает (вид, ячейка, дата дня или None) или None для некорректных данных."""
+    parts = (data or '').split(':')
+    if len(parts) < 2 or parts[0][2:] != CALLBACK_VERSION:
+        return None
+    kind = parts[0][:2]
+    try:
+        lat, lon = (float(value) for value in parts[1].split(','))
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return None
+        cell = location_cell(lat, lon)
+        if kind == FORECAST_DAY and len(parts) == 4:
+            return kind, cell, date.fromordinal(int(parts[2], 36)) + timedelta(days=int(parts[3]))
+    except (ValueError, OverflowError):
+        return None
+    if kind in (FORECAST_BACK, FORECAST_LIST, FORECAST_CHART) and len(parts) == 2:
+        return kind, cell, None
+    return None
+
+
+def _forecast_version(day_details: dict):
+    """Ключ кэша клавиатуры: версия прогноза, из которого построены дни."""
+    for day_info in day_details.values():
+        return day_info.get('version')
+    return None
+
+
+@cached_render('days_keyboard', _forecast_version)
+def create_forecast_days_keyboard(day_details: dict) -> str:
+    """Создает inline-клавиатуру с днями прогноза (сериализованную разметку)."""
     markup = types.InlineKeyboardMarkup()
     sorted_days = sorted(day_details.keys())[:5]
     
-    for day in sorted_days:
+    for index, day in enumerate(sorted_days):
         day_info = day_details[day]
         day_name = day_info['name']
         date_str = day_info['date']
@@ -19,23 +89,44 @@ def create_forecast_days_keyboard(day_details: dict) -> types.InlineKeyboardMark
         
         # Формат кнопки: "☀️ 25.09 - Четверг (10.6°С)"
         btn_text = f"{weather_icon} {date_str} - {day_name} ({avg_temp:.1f}°С)"
-        callback_data = f"day_{day.strftime('%Y-%m-%d')}"
+        cell = day_info['version'][0]
+        callback_data = forecast_callback(FORECAST_DAY, cell, sorted_days[0], index)
         markup.add(types.InlineKeyboardButton(btn_text, callback_data=callback_data))
     
-    return markup
+    if sorted_days:
+        cell = day_details[sorted_days[0]]['version'][0]
+        markup.add(types.InlineKeyboardButton("📈 График на 5 дней", callback_data=forecast_callback(FORECAST_CHART, cell)))
+    
+    return markup.to_json()
 
 
-def create_back_to_forecast_keyboard() -> types.InlineKeyboardMarkup:
-    """Создает кнопку 'Назад' для возврата к прогнозу."""
+@lru_cache(maxsize=1024)
+def create_back_to_forecast_keyboard(cell: str) -> str:
+    """Создает кнопку 'Назад' для возврата к прогнозу ячейки."""
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("◀️ Назад к прогнозу", callback_data="back_to_forecast"))
-    return markup
+    markup.add(types.InlineKeyboardButton("◀️ Назад к прогнозу", callback_data=forecast_callback(FORECAST_BACK, cell)))
+    return markup.to_json()
 
 
-def create_notifications_menu_keyboard(interval: int) -> types.InlineKeyboardMarkup:
+@lru_cache(maxsize=32)
+def create_notifications_menu_keyboard(interval: int) -> str:
     """Создает меню управления уведомлениями."""
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("🔕 Отключить уведомления", callback_data="notif_off"))
     markup.add(types.InlineKeyboardButton(f"⏰ Интервал: {interval}ч", callback_data="notif_interval"))
-    return markup
+    markup.add(types.InlineKeyboardButton("⚙️ Правила уведомлений", callback_data="notif_rules"))
+    return markup.to_json()
+
+
+@lru_cache(maxsize=256)
+def create_notification_rules_keyboard(rules: tuple) -> str:
+    """Создает меню правил уведомлений. rules — кортеж пар (тип правила, порог).
+    Нажатие на правило переключает его порог."""
+    thresholds = dict(rules)
+    markup = types.InlineKeyboardMarkup()
+    for rule_type in RULE_TYPES:
+        text = describe_rule(rule_type, thresholds.get(rule_type))
+        markup.add(types.InlineKeyboardButton(text, callback_data=f"rule_{rule_type}"))
+    markup.add(types.InlineKeyboardButton("◀️ Назад", callback_data="notif_menu"))
+    return markup.to_json()
 
@@ -1,10 +1,13 @@
 """Reply клавиатуры."""
 
+from functools import lru_cache
 from telebot import types
 
 
-def create_main_menu():
-    """Создает главное меню с кнопками."""
+@lru_cache(maxsize=None)
+def create_main_menu() -> str:
+    """Создает главное меню с кнопками.
+    Меню не меняется, поэтому разметка сериализуется один раз и переиспользуется."""
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
     btn1 = types.KeyboardButton("🌤️ Прогноз по городу")
     btn2 = types.KeyboardButton("📅 Прогноз на 5 дней")
@@ -15,5 +18,4 @@ def create_main_menu():
     markup.add(btn1, btn2)
     markup.add(btn3, btn4)
     markup.add(btn5, btn6)
-    return markup
-
+    return markup.to_json()
@@ -1,7 +1,17 @@
-"""Точка входа в приложение."""
+"""Точка входа в приложение.
 
-from app.bot import main
+python main.py --profile-startup — запуск с отчетом о времени импортов
+и времени до первого обработанного обновления.
+"""
 
-if __name__ == "__main__":
-    main()
+import sys
 
+if __name__ == "__main__":
+    profile_startup = '--profile-startup' in sys.argv[1:]
+    if profile_startup:
+        # Измерение импортов должно начаться до импорта модулей бота
+        from utils.startup_profile import install_import_timer
+        install_import_timer()
+    
+    from app.bot import main
+    main(profile_startup)
@@ -0,0 +1,103 @@
+"""Контроль допуска к дорогим обработчикам.
+
+Каждый класс обработчиков (расширенные данные, прогноз, сравнение, inline)
+ограничен тремя способами: корзиной токенов на пользователя, общей корзиной
+на всех пользователей и числом одновременно выполняемых запросов одного
+пользователя. Отклоненный запрос не уходит в OWM — обработчик отвечает
+данными из кэша или просьбой повторить через несколько секунд.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+from services.governor import TokenBucket
+from utils.metrics import metrics
+
+
+# Классы обработчиков
+CLASS_WEATHER = 'weather'  # Погода по городу
+CLASS_FORECAST = 'forecast'  # Прогноз на 5 дней
+CLASS_EXTENDED = 'extended'  # Расширенные данные: погода и качество воздуха
+CLASS_COMPARE = 'compare'  # Сравнение городов: до MAX_COMPARE_CITIES наборов запросов
+CLASS_INLINE = 'inline'  # Inline-запросы: приходят на каждое нажатие клавиши
+
+
+class AdmissionClass(NamedTuple):
+    """Ограничения класса обработчиков."""
+    user_rate: float  # Запросов в секунду на пользователя
+    user_burst: float  # Сколько запросов пользователь может сделать подряд
+    global_rate: float  # Запросов в секунду на всех пользователей
+    global_burst: float
+    max_in_flight: int  # Сколько запросов пользователя может выполняться одновременно
+
+
+ADMISSION_CLASSES = {
+    CLASS_WEATHER: AdmissionClass(user_rate=0.5, user_burst=5, global_rate=20, global_burst=60, max_in_flight=2),
+    CLASS_FORECAST: AdmissionClass(user_rate=0.2, user_burst=3, global_rate=10, global_burst=30, max_in_flight=1),
+    CLASS_EXTENDED: AdmissionClass(user_rate=0.1, user_burst=3, global_rate=5, global_burst=20, max_in_flight=1),
+    CLASS_COMPARE: AdmissionClass(user_rate=0.05, user_burst=4, global_rate=2, global_burst=6, max_in_flight=1),
+    CLASS_INLINE: AdmissionClass(user_rate=1.0, user_burst=5, global_rate=20, global_burst=60, max_in_flight=2),
+}
+
+MAX_TRACKED_USERS = 10000  # Корзины давно не обращавшихся пользователей вытесняются
+IN_FLIGHT_RETRY_AFTER = 3.0  # Через сколько предлагать повторить, если предыдущий запрос еще выполняется
+
+
+class AdmissionController:
+    """Корзины токенов и счетчики выполняемых запросов по классам обработчиков."""
+
+    def __init__(self, classes: dict, max_users: int = MAX_TRACKED_USERS):
+        self.classes = classes
+        self.max_users = max_users
+        self._global = {name: TokenBucket(c.global_burst, c.global_rate) for name, c in classes.items()}
+        self._users = OrderedDict()  # {(класс, user_id): TokenBucket}
+        self._in_flight = {}  # {(класс, user_id): число выполняемых запросов}
+        self._lock = threading.Lock()
+
+    def _user_bucket(self, key: tuple, limits: AdmissionClass) -> TokenBucket:
+        bucket = self._users.get(key)
+        if bucket is None:
+            bucket = self._users[key] = TokenBucket(limits.user_burst, limits.user_rate)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(key)
+        return bucket
+
+    def _reject(self, class_name: str, reason: str, retry_after: float) -> float:
+        metrics.counter(f"admission.rejected.{class_name}.{reason}").inc()
+        return max(1.0, retry_after)
+
+    def try_admit(self, class_name: str, user_id: int) -> float:
+        """Пытается допустить запрос пользователя. Возвращает 0, если запрос допущен
+        (после выполнения нужно вызвать release), иначе — через сколько секунд повторить."""
+        limits = self.classes[class_name]
+        key = (class_name, user_id)
+        with self._lock:
+            if self._in_flight.get(key, 0) >= limits.max_in_flight:
+                return self._reject(class_name, 'in_flight', IN_FLIGHT_RETRY_AFTER)
+            user_bucket = self._user_bucket(key, limits)
+            wait = user_bucket.try_take()
+            if wait > 0:
+                return self._reject(class_name, 'user', wait)
+            wait = self._global[class_name].try_take()
+            if wait > 0:
+                # Общая перегрузка — не вина пользователя, его токен возвращается
+                user_bucket.refund()
+                return self._reject(class_name, 'global', wait)
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        metrics.counter(f"admission.admitted.{class_name}").inc()
+        return 0.0
+
+    def release(self, class_name: str, user_id: int):
+        """Отмечает завершение допущенного запроса."""
+        key = (class_name, user_id)
+        with self._lock:
+            count = self._in_flight.get(key, 0) - 1
+            if count > 0:
+                self._in_flight[key] = count
+            else:
+                self._in_flight.pop(key, None)
+
+
+admission = AdmissionController(ADMISSION_CLASSES)
@@ -0,0 +1,64 @@
+"""Срок свежести записей кэша OWM по эндпоинтам.
+
+Срок отсчитывается не от момента получения, а от времени данных в ответе:
+OWM обновляет каждый эндпоинт с известной периодичностью, поэтому по полю dt
+можно вычислить, когда ответ изменится. Текущая погода и загрязнение воздуха
+обновляются с периодом cadence, отсчитанным от времени данных dt: следующее
+обновление — первый момент dt + k * cadence после получения. Прогноз меняется,
+когда наступает его ближайший интервал (он выпадает из ответа).
+Срок ограничивается снизу и сверху настройками CACHE_TTL_<ЭНДПОИНТ>_MIN/_MAX:
+нижняя граница не дает опрашивать OWM в цикле, если данные запаздывают,
+верхняя — не дает отдавать слишком старые данные.
+"""
+
+import math
+from typing import NamedTuple, Optional
+from config import settings
+from services.projection import ForecastRecord
+
+
+class ExpiryPolicy(NamedTuple):
+    """Периодичность обновления данных эндпоинта в OWM и границы срока свежести, сек."""
+    cadence: float
+    floor: float
+    ceiling: float
+
+
+POLICIES = {
+    'weather': ExpiryPolicy(600, settings.cache_ttl_weather_min, settings.cache_ttl_weather_max),
+    'forecast': ExpiryPolicy(10800, settings.cache_ttl_forecast_min, settings.cache_ttl_forecast_max),
+    'air_pollution': ExpiryPolicy(3600, settings.cache_ttl_air_min, settings.cache_ttl_air_max),
+}
+
+
+def next_change(endpoint: str, record, fetched_at: Optional[float] = None) -> float:
+    """Момент (unix time), когда OWM отдаст для записи новые данные.
+    fetched_at — момент получения (по умолчанию record.fetched_at)."""
+    cadence = POLICIES[endpoint].cadence
+    if fetched_at is None:
+        fetched_at = record.fetched_at
+    if isinstance(record, ForecastRecord):
+        for item in record.items:
+            if item.dt > fetched_at:
+                return item.dt
+        return fetched_at + cadence
+    # Без времени данных в ответе срок считается от момента получения
+    observed = record.dt or fetched_at
+    periods = max(1, math.floor((fetched_at - observed) / cadence) + 1)
+    return observed + periods * cadence
+
+
+def record_ttl(endpoint: str, record, fetched_at: Optional[float] = None) -> float:
+    """Срок свежести записи от момента получения, сек. Запись, повторно полученная
+    с теми же данными, хранит время первого получения, поэтому кэш передает
+    в fetched_at время своей записи."""
+    if fetched_at is None:
+        fetched_at = record.fetched_at
+    policy = POLICIES[endpoint]
+    ttl = next_change(endpoint, record, fetched_at) - fetched_at
+    return min(max(ttl, policy.floor), policy.ceiling)
+
+
+def same_data(previous, record) -> bool:
+    """Совпадают ли данные двух записей одной ячейки (без учета времени получения)."""
+    return previous._replace(fetched_at=record.fetched_at) == record
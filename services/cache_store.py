@@ -0,0 +1,244 @@
+"""Хранилища кэша ответов OWM.
+
+Хранилище отвечает только за байты: ключ, время записи, срок жизни и полезную нагрузку.
+Время записи и срок жизни держатся в индексе в памяти, поэтому проверка
+актуальности не читает и не разбирает сами данные.
+"""
+
+import hashlib
+import json
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:  # orjson — необязательная зависимость
+    orjson = None
+
+
+# --- Сериализация ---
+
+_FORMAT_RAW = b'r'
+_FORMAT_ZLIB = b'z'
+
+
+def dumps(data) -> bytes:
+    """Сериализует данные: orjson, если установлен, иначе json."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads(raw: bytes):
+    """Десериализует данные, записанные dumps()."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def encode_payload(data, compress: bool = False) -> bytes:
+    """Сериализует данные и при необходимости сжимает. Первый байт — формат."""
+    raw = dumps(data)
+    if compress:
+        return _FORMAT_ZLIB + zlib.compress(raw, 6)
+    return _FORMAT_RAW + raw
+
+
+def decode_payload(blob: bytes):
+    """Восстанавливает данные, записанные encode_payload()."""
+    fmt, body = blob[:1], blob[1:]
+    if fmt == _FORMAT_ZLIB:
+        body = zlib.decompress(body)
+    return loads(body)
+
+
+class CacheStore(ABC):
+    """Интерфейс хранилища кэша."""
+
+    @abstractmethod
+    def get(self, key: str, max_age: Optional[float]) -> Optional[tuple[float, object]]:
+        """Возвращает (время записи, данные), если запись не старше max_age секунд;
+        при max_age=None — если не истек срок жизни, указанный при записи."""
+
+    @abstractmethod
+    def put(self, key: str, data, timestamp: float, ttl: float):
+        """Записывает данные с временем записи и сроком жизни."""
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Удаляет запись."""
+
+    @abstractmethod
+    def compact(self, grace: float) -> int:
+        """Удаляет записи, срок жизни которых истек более grace секунд назад.
+        Возвращает количество удаленных."""
+
+    def close(self):
+        """Освобождает ресурсы хранилища."""
+
+
+class FileCacheStore(CacheStore):
+    """Исходный формат: отдельный JSON-файл на каждый ключ."""
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{hashlib.md5(key.encode()).hexdigest()}.json"
+
+    def get(self, key: str, max_age: Optional[float]) -> Optional[tuple[float, object]]:
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                cached_data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        timestamp = cached_data.get('timestamp', 0)
+        if time.time() - timestamp >= (cached_data.get('ttl', 0) if max_age is None else max_age):
+            return None
+        return timestamp, cached_data.get('data')
+
+    def put(self, key: str, data, timestamp: float, ttl: float):
+        with open(self._path(key), 'w', encoding='utf-8') as f:
+            json.dump({'timestamp': timestamp, 'ttl': ttl, 'data': data}, f, ensure_ascii=False)
+
+    def delete(self, key: str):
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+
+    def compact(self, grace: float) -> int:
+        removed = 0
+        now = time.time()
+        for path in self.cache_dir.glob('*.json'):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    cached_data = json.load(f)
+                expires = cached_data.get('timestamp', 0) + cached_data.get('ttl', 0)
+                if now - expires >= grace:
+                    path.unlink()
+                    removed += 1
+            except (OSError, ValueError):
+                continue
+        return removed
+
+
+class SqliteCacheStore(CacheStore):
+    """Все записи в одном файле SQLite с индексом (время записи, срок жизни) в памяти."""
+
+    def __init__(self, path: Path, compress: bool = False):
+        import sqlite3  # Нужен только этому хранилищу
+        self.path = path
+        self.compress = compress
+        self._lock = threading.Lock()
+        path.parent.mkdir(exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, timestamp REAL NOT NULL, ttl REAL NOT NULL, payload BLOB NOT NULL)"
+        )
+        # Индекс в памяти: {key: (timestamp, ttl)}
+        self._index = {
+            key: (timestamp, ttl)
+            for key, timestamp, ttl in self._conn.execute("SELECT key, timestamp, ttl FROM entries")
+        }
+
+    def get(self, key: str, max_age: Optional[float]) -> Optional[tuple[float, object]]:
+        meta = self._index.get(key)
+        if meta is None or time.time() - meta[0] >= (meta[1] if max_age is None else max_age):
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT timestamp, payload FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            return row[0], decode_payload(row[1])
+        except (ValueError, zlib.error):
+            self.delete(key)
+            return None
+
+    def get_meta(self, key: str) -> Optional[tuple[float, float]]:
+        """Возвращает (время записи, срок жизни) из индекса без чтения данных."""
+        return self._index.get(key)
+
+    def put(self, key: str, data, timestamp: float, ttl: float):
+        blob = encode_payload(data, self.compress)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, timestamp, ttl, payload) VALUES (?, ?, ?, ?)",
+                (key, timestamp, ttl, blob)
+            )
+            self._index[key] = (timestamp, ttl)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._index.pop(key, None)
+
+    def compact(self, grace: float) -> int:
+        cutoff = time.time() - grace
+        expired = [key for key, (timestamp, ttl) in list(self._index.items()) if timestamp + ttl < cutoff]
+        if not expired:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in expired])
+            self._conn.execute("COMMIT")
+            for key in expired:
+                self._index.pop(key, None)
+            # Возвращаем освободившееся место файлу
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            if len(expired) > len(self._index):
+                self._conn.execute("VACUUM")
+        return len(expired)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_cache_store(backend: str, cache_dir: Path, compress: bool = False) -> CacheStore:
+    """Создает хранилище кэша по имени: sqlite (по умолчанию) или files."""
+    if backend == 'files':
+        return FileCacheStore(cache_dir)
+    if backend == 'sqlite':
+        return SqliteCacheStore(cache_dir / 'cache.sqlite3', compress=compress)
+    raise ValueError(f"Неизвестное хранилище кэша: {backend}")
+
+
+class CacheCompactor:
+    """Фоновый поток, периодически удаляющий старые записи хранилища."""
+
+    def __init__(self, store: CacheStore, grace: float, interval: float):
+        self.store = store
+        self.grace = grace
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.store.compact(self.grace)
+            except Exception:
+                continue  # Повторим на следующей итерации
+
+    def start(self):
+        """Запускает поток уплотнения."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает поток уплотнения."""
+        self._stop.set()
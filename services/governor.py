@@ -0,0 +1,229 @@
+"""Регулятор запросов к OpenWeatherMap: квоты, приоритеты и автоматический выключатель."""
+
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from utils.metrics import metrics
+
+
+# Классы приоритета запросов (меньше — важнее)
+PRIORITY_INTERACTIVE = 0  # Пользователь ждет ответа в чате
+PRIORITY_INLINE = 1  # Inline-запросы
+PRIORITY_NOTIFICATION = 2  # Фоновые проверки уведомлений
+PRIORITY_PREFETCH = 3  # Упреждающая загрузка
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_INLINE: 'inline',
+    PRIORITY_NOTIFICATION: 'notification',
+    PRIORITY_PREFETCH: 'prefetch',
+}
+
+# Доля минутной квоты, которую приоритет не может занять (резерв для более важных запросов)
+PRIORITY_RESERVE = {
+    PRIORITY_INTERACTIVE: 0.0,
+    PRIORITY_INLINE: 0.1,
+    PRIORITY_NOTIFICATION: 0.3,
+    PRIORITY_PREFETCH: 0.5,
+}
+
+# Сколько секунд запрос может ждать свободный токен, прежде чем будет отброшен
+PRIORITY_MAX_WAIT = {
+    PRIORITY_INTERACTIVE: 2.0,
+    PRIORITY_INLINE: 1.0,
+    PRIORITY_NOTIFICATION: 30.0,
+    PRIORITY_PREFETCH: 0.0,
+}
+
+
+class TokenBucket:
+    """Корзина токенов с непрерывным пополнением."""
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second)
+            self._updated = now
+
+    def try_take(self, amount: float = 1.0, keep: float = 0.0) -> float:
+        """Пытается взять токены, оставляя в корзине не меньше keep.
+        Возвращает 0 при успехе или время ожидания до появления токенов."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens - amount >= keep:
+                self.tokens -= amount
+                return 0.0
+            missing = amount + keep - self.tokens
+            return missing / self.refill_per_second if self.refill_per_second > 0 else float('inf')
+
+    def available(self) -> float:
+        """Сколько токенов сейчас в корзине."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+    def refund(self, amount: float = 1.0):
+        """Возвращает взятые токены, если запрос все-таки не был выполнен."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain(self):
+        """Опустошает корзину (например, после ответа 429)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = 0.0
+
+
+class CircuitBreaker:
+    """Автоматический выключатель по доле ошибок в скользящем окне последних вызовов."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window: int = 20, min_calls: int = 10, error_threshold: float = 0.5,
+                 open_seconds: float = 30.0, probe_timeout: float = 30.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_threshold = error_threshold
+        self.open_seconds = open_seconds
+        # Пробный вызов без результата дольше probe_timeout считается потерянным
+        self.probe_timeout = probe_timeout
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self._probe_owner = None  # Поток, получивший разрешение на пробный вызов
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Разрешает ли выключатель очередной вызов. В полуоткрытом состоянии
+        разрешенный вызов — пробный: после него нужно вызвать record()
+        или, если вызов так и не был выполнен, release_probe()."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            # Полуоткрытое состояние: пропускаем один пробный вызов
+            if self._probe_in_flight:
+                if now - self._probe_started < self.probe_timeout:
+                    return False
+                metrics.counter('owm.breaker.probe_lost').inc()
+            self._probe_in_flight = True
+            self._probe_started = now
+            self._probe_owner = threading.get_ident()
+            return True
+
+    def release_probe(self):
+        """Отказ от пробного вызова, полученного этим потоком через allow(),
+        без результата (например, регулятор квоты отбросил запрос)."""
+        with self._lock:
+            if self._probe_in_flight and self._probe_owner == threading.get_ident():
+                self._probe_in_flight = False
+                self._probe_owner = None
+
+    def record(self, success: bool):
+        """Учитывает результат вызова."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+                self._probe_owner = None
+                if success:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(success)
+            if len(self._outcomes) >= self.min_calls:
+                errors = self._outcomes.count(False)
+                if errors / len(self._outcomes) >= self.error_threshold:
+                    self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        metrics.counter('owm.breaker.opened').inc()
+
+
+class RequestGovernor:
+    """Центральный регулятор вызовов OWM: минутная и суточная квоты с резервом по приоритетам."""
+
+    def __init__(self, calls_per_minute: int, calls_per_day: int):
+        self.calls_per_minute = calls_per_minute
+        self.calls_per_day = calls_per_day
+        self.bucket = TokenBucket(calls_per_minute, calls_per_minute / 60)
+        self._day = None
+        self._day_calls = 0
+        self._day_lock = threading.Lock()
+
+    def _take_daily(self, priority: int) -> bool:
+        """Учитывает вызов в суточной квоте с тем же резервом по приоритетам."""
+        with self._day_lock:
+            today = datetime.now(timezone.utc).date()
+            if today != self._day:
+                self._day = today
+                self._day_calls = 0
+            limit = self.calls_per_day * (1 - PRIORITY_RESERVE[priority])
+            if self._day_calls >= limit:
+                return False
+            self._day_calls += 1
+            return True
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE, max_wait: float = None) -> bool:
+        """Получает разрешение на вызов. При нехватке токенов ждет не дольше max_wait
+        (по умолчанию — по приоритету), затем отбрасывает запрос и возвращает False."""
+        if max_wait is None:
+            max_wait = PRIORITY_MAX_WAIT[priority]
+        name = PRIORITY_NAMES[priority]
+        keep = self.bucket.capacity * PRIORITY_RESERVE[priority]
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            wait = self.bucket.try_take(1.0, keep)
+            if wait == 0.0:
+                break
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                metrics.counter(f"owm.shed.{name}").inc()
+                return False
+            time.sleep(wait)
+
+        if not self._take_daily(priority):
+            # Вызов не состоится: минутный токен возвращаем в корзину
+            self.bucket.refund()
+            metrics.counter(f"owm.shed.{name}").inc()
+            return False
+
+        metrics.counter(f"owm.calls.{name}").inc()
+        metrics.rate('owm.calls').mark()
+        return True
+
+    def penalize(self):
+        """Реакция на 429 от OWM: не отдаем токены до пополнения корзины."""
+        self.bucket.drain()
+        metrics.counter('owm.rate_limited').inc()
+
+    def remaining_today(self) -> int:
+        """Сколько вызовов осталось в суточной квоте."""
+        with self._day_lock:
+            if self._day != datetime.now(timezone.utc).date():
+                return self.calls_per_day
+            return max(0, self.calls_per_day - self._day_calls)
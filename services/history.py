@@ -0,0 +1,339 @@
+"""История наблюдаемой погоды по ячейкам местоположения.
+
+Каждая новая запись текущей погоды (по времени наблюдения OWM dt) добавляется
+в ряд своей ячейки. Ряд хранится по столбцам в массивах array фиксированной
+ширины — время, температура, давление, влажность, ветер и код состояния OWM,
+23 байта на наблюдение. Наблюдение сразу попадает в память, а в файл ячейки
+записями той же длины его дописывает фоновый поток (start_history_writer),
+поэтому обновление кэша не ждет диск. Файл читается при первом обращении
+к ячейке. Наблюдения старше HISTORY_RETENTION удаляются, а файл при этом переписывается.
+
+Время в ряду возрастает, поэтому выборка по интервалу — двоичный поиск.
+По истории вычисляются тенденции (изменение температуры и давления за сутки)
+и температура, которую подписчик видел в прошлый раз.
+"""
+
+import bisect
+import os
+import struct
+import threading
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple, Optional
+from config import settings
+from services.projection import WeatherRecord
+from services.weather_api import CACHE_DIR, add_cache_listener
+
+
+HISTORY_DIR = CACHE_DIR / "history"
+HISTORY_RETENTION = settings.history_retention_days * 86400
+# Наблюдение ищется рядом с нужным временем не дальше этого (сек)
+NEAREST_TOLERANCE = 3 * 3600
+# Как часто фоновый поток записывает накопленные наблюдения в файлы (сек)
+HISTORY_FLUSH_INTERVAL = 5.0
+
+# Запись файла: время, температура, давление, ветер, влажность, код состояния
+_RECORD = struct.Struct('<dfffBH')
+
+_writer_stop = threading.Event()
+_writer_thread = None
+
+
+class Observation(NamedTuple):
+    """Одно наблюдение погоды в ячейке."""
+    at: float  # Время наблюдения OWM (dt), сек
+    temp: float
+    pressure: float
+    humidity: int
+    wind_speed: float
+    condition_id: int
+
+
+def observation_time(record: WeatherRecord) -> float:
+    """Время наблюдения записи погоды — ключ ряда истории."""
+    return float(record.dt or int(record.fetched_at))
+
+
+def _pack(observation: 'Observation') -> bytes:
+    """Запись файла для наблюдения."""
+    at, temp, pressure, humidity, wind_speed, condition_id = observation
+    return _RECORD.pack(at, temp, pressure, wind_speed, humidity, condition_id)
+
+
+def observation_from(record: WeatherRecord) -> Observation:
+    """Оставляет из записи погоды поля, которые хранятся в истории."""
+    return Observation(
+        observation_time(record), record.temp, record.pressure,
+        max(0, min(int(record.humidity), 255)), record.wind_speed, max(0, min(int(record.condition_id), 65535)),
+    )
+
+
+class CellSeries:
+    """Ряд наблюдений одной ячейки по столбцам."""
+
+    __slots__ = ('at', 'temp', 'pressure', 'humidity', 'wind_speed', 'condition_id')
+
+    def __init__(self):
+        self.at = array('d')
+        self.temp = array('f')
+        self.pressure = array('f')
+        self.humidity = array('B')
+        self.wind_speed = array('f')
+        self.condition_id = array('H')
+
+    def __len__(self) -> int:
+        return len(self.at)
+
+    def append(self, observation: Observation):
+        for column, value in zip(self.__slots__, observation):
+            getattr(self, column).append(value)
+
+    def observation(self, index: int) -> Observation:
+        return Observation(*(getattr(self, column)[index] for column in self.__slots__))
+
+    def index_range(self, start: float, end: float) -> tuple[int, int]:
+        """Индексы наблюдений с start <= at < end."""
+        return bisect.bisect_left(self.at, start), bisect.bisect_left(self.at, end)
+
+    def drop_before(self, index: int):
+        """Удаляет первые index наблюдений."""
+        for column in self.__slots__:
+            del getattr(self, column)[:index]
+
+
+class HistoryStore:
+    """Ряды наблюдений по ячейкам. Наблюдения сразу попадают в память, а в файлы
+    фиксированной ширины их записывает flush() — из фонового потока."""
+
+    def __init__(self, directory: Path, retention: float):
+        self.directory = directory
+        self.retention = retention
+        self._series = {}  # {cell: CellSeries}
+        self._cell_locks = {}  # {cell: RLock} — ячейки не ждут друг друга
+        self._locks_lock = threading.Lock()
+        self._pending = {}  # {cell: bytearray} записей, еще не дописанных в файл
+        self._rewrite = set()  # Ячейки, файл которых нужно переписать целиком
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _lock(self, cell: str) -> threading.RLock:
+        """Блокировка ряда ячейки."""
+        with self._locks_lock:
+            lock = self._cell_locks.get(cell)
+            if lock is None:
+                lock = self._cell_locks[cell] = threading.RLock()
+            return lock
+
+    def _path(self, cell: str) -> Path:
+        return self.directory / f"{cell}.bin"
+
+    def _load(self, cell: str) -> CellSeries:
+        """Ряд ячейки; при первом обращении читается из файла. Вызывается под блокировкой ячейки."""
+        series = self._series.get(cell)
+        if series is not None:
+            return series
+        series = CellSeries()
+        try:
+            with open(self._path(cell), 'rb') as f:
+                blob = f.read()
+        except OSError:
+            blob = b''
+        # Неполная последняя запись (обрыв при записи) отбрасывается
+        blob = blob[:len(blob) - len(blob) % _RECORD.size]
+        for at, temp, pressure, wind_speed, humidity, condition_id in _RECORD.iter_unpack(blob):
+            if not len(series) or at > series.at[-1]:
+                series.append(Observation(at, temp, pressure, humidity, wind_speed, condition_id))
+        self._series[cell] = series
+        return series
+
+    def append(self, cell: str, observation: Observation) -> bool:
+        """Добавляет наблюдение, если оно новее последнего в ряду, и ставит его в очередь записи.
+        Возвращает True, если добавлено."""
+        with self._lock(cell):
+            series = self._load(cell)
+            if len(series) and observation.at <= series.at[-1]:
+                return False
+            series.append(observation)
+            expired = self._expire(series, observation.at)
+            with self._pending_lock:
+                if expired:
+                    # Файл будет переписан из памяти целиком, вместе с этим наблюдением
+                    self._rewrite.add(cell)
+                    self._pending.pop(cell, None)
+                elif cell not in self._rewrite:
+                    self._pending.setdefault(cell, bytearray()).extend(_pack(observation))
+            return True
+
+    def _expire(self, series: CellSeries, now: float) -> bool:
+        """Удаляет из памяти наблюдения старше срока хранения. Чтобы не переписывать файл
+        при каждом наблюдении, удаление выполняется, когда лишнего набралось на сутки.
+        Возвращает True, если наблюдения удалены и файл нужно переписать."""
+        if series.at[0] >= now - self.retention - 86400:
+            return False
+        series.drop_before(bisect.bisect_left(series.at, now - self.retention))
+        return True
+
+    def flush(self) -> int:
+        """Дописывает накопленные наблюдения в файлы ячеек и переписывает файлы,
+        из которых удалены старые наблюдения. Возвращает число записанных файлов."""
+        with self._flush_lock:
+            with self._pending_lock:
+                cells = set(self._pending) | self._rewrite
+            written = 0
+            for cell in cells:
+                with self._lock(cell):
+                    with self._pending_lock:
+                        chunk = self._pending.pop(cell, None)
+                        rewrite = cell in self._rewrite
+                        self._rewrite.discard(cell)
+                    if rewrite:
+                        series = self._series[cell]
+                        chunk = b''.join(_pack(series.observation(index)) for index in range(len(series)))
+                if chunk is None:
+                    continue
+                # Диск — вне блокировки ячейки: чтение и новые наблюдения его не ждут.
+                # Файлы пишет только flush(), поэтому порядок записей сохраняется
+                try:
+                    self._write(cell, chunk, rewrite)
+                    written += 1
+                except OSError:
+                    with self._pending_lock:
+                        self._rewrite.add(cell)  # Файл восстановится из памяти при следующей записи
+            return written
+
+    def _write(self, cell: str, blob: bytes, rewrite: bool):
+        """Дописывает записи в файл ячейки или атомарно заменяет его."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(cell)
+        if not rewrite:
+            with open(path, 'ab') as f:
+                f.write(blob)
+            return
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+
+    def range(self, cell: str, start: float, end: float) -> list[Observation]:
+        """Наблюдения ячейки с start <= at < end в порядке времени."""
+        with self._lock(cell):
+            series = self._load(cell)
+            first, last = series.index_range(start, end)
+            return [series.observation(index) for index in range(first, last)]
+
+    def latest(self, cell: str) -> Optional[Observation]:
+        """Последнее наблюдение ячейки или None."""
+        with self._lock(cell):
+            series = self._load(cell)
+            return series.observation(-1) if len(series) else None
+
+    def nearest(self, cell: str, at: float, tolerance: float = NEAREST_TOLERANCE) -> Optional[Observation]:
+        """Наблюдение, ближайшее ко времени at, не дальше tolerance секунд, или None."""
+        with self._lock(cell):
+            series = self._load(cell)
+            index = bisect.bisect_left(series.at, at)
+            candidates = [i for i in (index - 1, index) if 0 <= i < len(series)]
+            if not candidates:
+                return None
+            best = min(candidates, key=lambda i: abs(series.at[i] - at))
+            if abs(series.at[best] - at) > tolerance:
+                return None
+            return series.observation(best)
+
+    def downsample(self, cell: str, start: float, end: float, step: float) -> list[Observation]:
+        """Средние значения по интервалам длиной step секунд от start до end.
+        Время интервала — его начало, состояние — самое частое в интервале.
+        Интервалы без наблюдений пропускаются."""
+        with self._lock(cell):
+            series = self._load(cell)
+            first, last = series.index_range(start, end)
+            result = []
+            index = first
+            while index < last:
+                bucket = start + (series.at[index] - start) // step * step
+                bucket_end = min(bisect.bisect_left(series.at, bucket + step, index, last), last)
+                count = bucket_end - index
+                result.append(Observation(
+                    bucket,
+                    sum(series.temp[index:bucket_end]) / count,
+                    sum(series.pressure[index:bucket_end]) / count,
+                    round(sum(series.humidity[index:bucket_end]) / count),
+                    sum(series.wind_speed[index:bucket_end]) / count,
+                    Counter(series.condition_id[index:bucket_end]).most_common(1)[0][0],
+                ))
+                index = bucket_end
+            return result
+
+    def size(self) -> dict:
+        """Число загруженных ячеек и наблюдений в памяти."""
+        series = list(self._series.values())
+        return {'cells': len(series), 'observations': sum(len(s) for s in series)}
+
+
+history = HistoryStore(HISTORY_DIR, HISTORY_RETENTION)
+
+
+def _on_cache_update(endpoint: str, record, previous):
+    """Каждая новая запись текущей погоды становится наблюдением в истории ячейки."""
+    if endpoint == 'weather':
+        history.append(record.cell, observation_from(record))
+
+
+def init_history():
+    """Подключает запись наблюдений к обновлениям кэша. Вызывается при запуске бота."""
+    add_cache_listener(_on_cache_update)
+
+
+def _writer_loop(interval: float):
+    while not _writer_stop.wait(interval):
+        try:
+            history.flush()
+        except Exception:
+            continue  # Повторим на следующей итерации
+
+
+def start_history_writer(interval: float = HISTORY_FLUSH_INTERVAL):
+    """Запускает фоновую запись наблюдений в файлы ячеек."""
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    _writer_stop.clear()
+    _writer_thread = threading.Thread(target=_writer_loop, args=(interval,), daemon=True)
+    _writer_thread.start()
+
+
+def stop_history_writer():
+    """Останавливает фоновую запись и записывает оставшиеся наблюдения."""
+    _writer_stop.set()
+    try:
+        history.flush()
+    except Exception:
+        pass  # Потеряются только последние наблюдения
+
+
+# --- Признаки по истории ---
+
+def observed_temp(cell: str, at: Optional[float]) -> Optional[float]:
+    """Температура наблюдения ячейки в момент at (что подписчик видел в прошлый раз) или None."""
+    if at is None:
+        return None
+    observation = history.nearest(cell, at)
+    return observation.temp if observation is not None else None
+
+
+def temp_change(record: WeatherRecord, hours: float = 24) -> Optional[float]:
+    """На сколько градусов сейчас теплее (или холоднее), чем hours часов назад, или None без данных."""
+    past = history.nearest(record.cell, observation_time(record) - hours * 3600)
+    return record.temp - past.temp if past is not None else None
+
+
+def pressure_trend(record: WeatherRecord, hours: float = 24, window: float = 3) -> Optional[float]:
+    """Изменение давления (гПа) за hours часов: средние за window часов в начале и конце периода.
+    None, если в начале периода нет наблюдений."""
+    end = observation_time(record) + 1
+    start = end - (hours + window) * 3600
+    buckets = history.downsample(record.cell, start, end, window * 3600)
+    if len(buckets) < 2 or buckets[0].at != start:
+        return None
+    return buckets[-1].pressure - buckets[0].pressure
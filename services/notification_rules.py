@@ -0,0 +1,321 @@
+"""Правила погодных уведомлений.
+
+Пользователь подписывается на правила с порогом: вероятность дождя завтра,
+заморозки, сильный ветер, качество воздуха, резкое изменение температуры.
+Признаки, от которых зависят правила, вычисляются один раз для местоположения
+и версии данных (план оценки), а для каждого подписчика остается только
+сравнить признак со своим порогом. Какие правила вообще нужно оценивать,
+решает событие изменения данных (affected_rules). Повторно одно и то же событие
+(например, дождь на ту же дату) подписчику не сообщается.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Callable, NamedTuple, Optional
+from services.projection import (
+    WeatherRecord, ForecastRecord, AirRecord, air_components, day_summary, local_tomorrow
+)
+from services.weather_api import (
+    analyze_air_pollution, AIR_QUALITY_LEVELS, PART_CURRENT, PART_FORECAST, PART_AIR, PART_ENDPOINTS
+)
+
+
+RULE_PRECIPITATION = 'precipitation'
+RULE_FROST = 'frost'
+RULE_WIND = 'wind'
+RULE_AQI = 'aqi'
+RULE_TEMP_SWING = 'temp_swing'
+
+# Правила по умолчанию повторяют прежнее поведение: дождь завтра и изменение температуры более 5°C
+DEFAULT_RULES = {RULE_PRECIPITATION: 0, RULE_TEMP_SWING: 5}
+
+FEATURE_CACHE_ENTRIES = 1024
+
+# Какую часть данных дает каждый эндпоинт кэша
+ENDPOINT_PARTS = {endpoint: part for part, endpoint in PART_ENDPOINTS.items()}
+
+
+class LocationData(NamedTuple):
+    """Данные одного местоположения, по которым оцениваются правила."""
+    weather: Optional[WeatherRecord]
+    forecast: Optional[ForecastRecord]
+    air: Optional[AirRecord]
+
+
+class RuleType(NamedTuple):
+    """Описание типа правила."""
+    title: str
+    condition: str  # Формат порога для меню, например "≥ {:.0f}%"
+    choices: tuple  # Пороги, между которыми переключается меню
+    parts: frozenset  # Какие данные нужны признаку
+    feature: Callable  # (LocationData, завтрашняя дата) -> значение признака или None
+    triggered: Callable  # (значение, порог, прежнее значение) -> bool
+    message: Callable  # (значение, порог, прежнее значение) -> str
+    alert_key: Callable  # (значение, завтрашняя дата) -> ключ события; None — сообщать при каждом срабатывании
+
+
+def _tomorrow(data: LocationData, tomorrow: date):
+    """Сводка прогноза на завтра (посчитана при получении прогноза) или None."""
+    if data.forecast is None:
+        return None
+    return day_summary(data.forecast, tomorrow)
+
+
+def _rain_probability(data: LocationData, tomorrow: date) -> Optional[float]:
+    """Наибольшая вероятность осадков (%) среди интервалов завтра с дождем, моросью или грозой."""
+    summary = _tomorrow(data, tomorrow)
+    if summary is None or summary.rain_pop is None:
+        return None
+    return summary.rain_pop * 100
+
+
+def _min_temp(data: LocationData, tomorrow: date) -> Optional[float]:
+    summary = _tomorrow(data, tomorrow)
+    return summary.min_temp if summary is not None else None
+
+
+def _max_wind(data: LocationData, tomorrow: date) -> Optional[float]:
+    summary = _tomorrow(data, tomorrow)
+    return summary.max_wind if summary is not None else None
+
+
+def _aqi(data: LocationData, tomorrow: date) -> Optional[float]:
+    if data.air is None:
+        return None
+    return analyze_air_pollution(air_components(data.air))['overall_status']['index']
+
+
+def _current_temp(data: LocationData, tomorrow: date) -> Optional[float]:
+    return data.weather.temp if data.weather is not None else None
+
+
+def _temp_swing_message(value: float, threshold: float, previous: float) -> str:
+    diff = value - previous
+    if diff > 0:
+        return f"📈 Температура повысилась на {diff:.1f}°C\n"
+    return f"📉 Температура понизилась на {abs(diff):.1f}°C\n"
+
+
+RULE_TYPES = {
+    RULE_PRECIPITATION: RuleType(
+        title="🌧️ Дождь завтра",
+        condition="вероятность ≥ {:.0f}%",
+        choices=(0, 30, 50, 70, 90),
+        parts=frozenset({PART_FORECAST}),
+        feature=_rain_probability,
+        triggered=lambda value, threshold, previous: value >= threshold,
+        message=lambda value, threshold, previous: (
+            f"⚠️ Завтра ожидается дождь (вероятность до {value:.0f}%)! Не забудьте зонт.\n\n"
+        ),
+        alert_key=lambda value, tomorrow: tomorrow.isoformat(),
+    ),
+    RULE_FROST: RuleType(
+        title="🥶 Заморозки завтра",
+        condition="≤ {:.0f}°C",
+        choices=(0, -5, -10),
+        parts=frozenset({PART_FORECAST}),
+        feature=_min_temp,
+        triggered=lambda value, threshold, previous: value <= threshold,
+        message=lambda value, threshold, previous: f"🥶 Завтра заморозки: до {value:.1f}°C\n\n",
+        alert_key=lambda value, tomorrow: tomorrow.isoformat(),
+    ),
+    RULE_WIND: RuleType(
+        title="💨 Сильный ветер завтра",
+        condition="≥ {:.0f} м/с",
+        choices=(10, 15, 20),
+        parts=frozenset({PART_FORECAST}),
+        feature=_max_wind,
+        triggered=lambda value, threshold, previous: value >= threshold,
+        message=lambda value, threshold, previous: f"💨 Завтра ветер до {value:.1f} м/с\n\n",
+        alert_key=lambda value, tomorrow: tomorrow.isoformat(),
+    ),
+    RULE_AQI: RuleType(
+        title="🏭 Качество воздуха",
+        condition="индекс ≥ {:.0f}",
+        choices=(3, 4, 5),
+        parts=frozenset({PART_AIR}),
+        feature=_aqi,
+        triggered=lambda value, threshold, previous: value >= threshold,
+        message=lambda value, threshold, previous: (
+            f"🏭 Качество воздуха: {AIR_QUALITY_LEVELS[int(value)]['name_ru'].lower()} (индекс {value:.0f})\n\n"
+        ),
+        alert_key=lambda value, tomorrow: int(value),
+    ),
+    RULE_TEMP_SWING: RuleType(
+        title="🌡️ Изменение температуры",
+        condition="> {:.0f}°C",
+        choices=(3, 5, 10),
+        parts=frozenset({PART_CURRENT}),
+        feature=_current_temp,
+        # Сравнивается с температурой, которую подписчик видел в прошлый раз
+        triggered=lambda value, threshold, previous: previous is not None and abs(value - previous) > threshold,
+        message=_temp_swing_message,
+        alert_key=lambda value, tomorrow: None,
+    ),
+}
+
+
+def user_rules(stored: Optional[dict]) -> dict:
+    """Возвращает правила пользователя {тип: порог}; без сохраненных — правила по умолчанию."""
+    if stored is None:
+        return DEFAULT_RULES
+    return {rule_type: threshold for rule_type, threshold in stored.items() if rule_type in RULE_TYPES}
+
+
+def next_threshold(rule_type: str, threshold: Optional[float]) -> Optional[float]:
+    """Следующий порог правила в меню: выкл → первый порог → ... → последний → выкл."""
+    choices = RULE_TYPES[rule_type].choices
+    if threshold is None:
+        return choices[0]
+    if threshold not in choices:
+        return None
+    index = choices.index(threshold) + 1
+    return choices[index] if index < len(choices) else None
+
+
+def describe_rule(rule_type: str, threshold: Optional[float]) -> str:
+    """Текст правила для меню."""
+    rule = RULE_TYPES[rule_type]
+    if threshold is None:
+        return f"➖ {rule.title}: выкл"
+    return f"✅ {rule.title}: {rule.condition.format(threshold)}"
+
+
+class EvaluationPlan(NamedTuple):
+    """План оценки правил для одного местоположения."""
+    rule_types: frozenset  # Типы правил, на которые подписан хотя бы один подписчик
+    parts: frozenset  # Данные, которые нужно получить
+    subscribers: tuple  # ((user_id, {тип: порог}), ...)
+
+
+def tomorrow_for(forecast: Optional[ForecastRecord]) -> date:
+    """«Завтра» — по местному времени города, если известен его часовой пояс из прогноза."""
+    if forecast is not None:
+        return local_tomorrow(forecast, time.time())
+    return (datetime.now() + timedelta(days=1)).date()
+
+
+def location_data(endpoint: str, record) -> LocationData:
+    """Данные местоположения, в которых есть только запись одного эндпоинта."""
+    part = ENDPOINT_PARTS[endpoint]
+    return LocationData(
+        record if part == PART_CURRENT else None,
+        record if part == PART_FORECAST else None,
+        record if part == PART_AIR else None,
+    )
+
+
+def affected_rules(diff, rule_types: frozenset) -> frozenset:
+    """Типы правил из rule_types, результат которых могло изменить событие diff
+    (services.weather_events.WeatherDiff). Правило затронуто, если событие касается
+    его данных и изменило то, что правило проверяет: для изменения температуры —
+    текущую температуру (temp_delta), для дождя — появились интервалы дождя завтра
+    (new_rain_windows) или изменилась его вероятность, для остальных — значение
+    признака на завтра. Для первой версии данных затронуты все правила этих данных."""
+    part = ENDPOINT_PARTS.get(diff.endpoint)
+    candidates = [rule_type for rule_type in rule_types if part in RULE_TYPES[rule_type].parts]
+    if not candidates or not diff.changed_fields:
+        return frozenset()
+    if diff.previous is None:
+        return frozenset(candidates)
+
+    new = location_data(diff.endpoint, diff.record)
+    old = location_data(diff.endpoint, diff.previous)
+    tomorrow = tomorrow_for(new.forecast)
+    affected = set()
+    for rule_type in candidates:
+        if rule_type == RULE_TEMP_SWING:
+            if diff.temp_delta:
+                affected.add(rule_type)
+            continue
+        if rule_type == RULE_PRECIPITATION and diff.new_rain_windows:
+            summary = day_summary(diff.record, tomorrow)
+            if summary is not None and set(summary.rain_windows) & set(diff.new_rain_windows):
+                affected.add(rule_type)
+                continue
+        feature = RULE_TYPES[rule_type].feature
+        try:
+            if feature(new, tomorrow) != feature(old, tomorrow):
+                affected.add(rule_type)
+        except (KeyError, TypeError, ValueError):
+            affected.add(rule_type)  # Пусть решает оценка правила
+    return frozenset(affected)
+
+
+def compile_plan(subscribers: list) -> EvaluationPlan:
+    """Строит план оценки по подписчикам одного местоположения [(user_id, правила), ...]."""
+    rule_types = frozenset(rule_type for _, rules in subscribers for rule_type in rules)
+    parts = frozenset({PART_CURRENT}).union(*(RULE_TYPES[rule_type].parts for rule_type in rule_types))
+    return EvaluationPlan(rule_types, parts, tuple(subscribers))
+
+
+# Признаки по версии данных: {(типы правил, версии записей, завтрашняя дата): {тип: значение}}
+_feature_cache = OrderedDict()
+_feature_lock = threading.Lock()
+
+
+def location_features(plan: EvaluationPlan, cell: str, data: LocationData, tomorrow: date) -> dict:
+    """Вычисляет признаки всех правил плана. Для одной версии данных вычисляются один раз."""
+    key = (
+        plan.rule_types,
+        cell,
+        data.weather.fetched_at if data.weather is not None else None,
+        data.forecast.fetched_at if data.forecast is not None else None,
+        data.air.fetched_at if data.air is not None else None,
+        tomorrow,
+    )
+    with _feature_lock:
+        features = _feature_cache.get(key)
+    if features is not None:
+        return features
+
+    features = {}
+    for rule_type in plan.rule_types:
+        try:
+            features[rule_type] = RULE_TYPES[rule_type].feature(data, tomorrow)
+        except (KeyError, TypeError, ValueError):
+            features[rule_type] = None
+
+    with _feature_lock:
+        _feature_cache[key] = features
+        while len(_feature_cache) > FEATURE_CACHE_ENTRIES:
+            _feature_cache.popitem(last=False)
+    return features
+
+
+def evaluate_plan(plan: EvaluationPlan, cell: str, data: LocationData, previous_temps: dict,
+                  sent_alerts: Optional[dict] = None, rule_types: Optional[frozenset] = None) -> dict:
+    """Оценивает правила всех подписчиков плана.
+    previous_temps — {user_id: температура, которую подписчик видел в прошлый раз};
+    sent_alerts — {user_id: {тип правила: ключ последнего отправленного события}}:
+    событие с тем же ключом повторно не возвращается;
+    rule_types — оценивать только эти типы правил (по умолчанию все).
+    Возвращает {user_id: [(тип правила, ключ события, текст), ...]} только для подписчиков
+    со сработавшими правилами."""
+    tomorrow = tomorrow_for(data.forecast)
+    features = location_features(plan, cell, data, tomorrow)
+    sent_alerts = sent_alerts or {}
+
+    alerts = {}
+    for user_id, rules in plan.subscribers:
+        previous = previous_temps.get(user_id)
+        sent = sent_alerts.get(user_id, {})
+        messages = []
+        for rule_type, rule in RULE_TYPES.items():
+            if rule_types is not None and rule_type not in rule_types:
+                continue
+            threshold = rules.get(rule_type)
+            value = features.get(rule_type)
+            if threshold is None or value is None:
+                continue
+            if not rule.triggered(value, threshold, previous):
+                continue
+            alert_key = rule.alert_key(value, tomorrow)
+            if alert_key is not None and sent.get(rule_type) == alert_key:
+                continue
+            messages.append((rule_type, alert_key, rule.message(value, threshold, previous)))
+        if messages:
+            alerts[user_id] = messages
+    return alerts
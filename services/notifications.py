@@ -1,122 +1,318 @@
 """Сервис для работы с уведомлениями."""
 
+import queue
+import random
+import threading
 import time
-from datetime import datetime, timedelta
 from collections import defaultdict
 from telebot import TeleBot
-from services.weather_api import get_current_weather, get_forecast_5d3h
+from config import NOTIFICATION_RECOVERY_WINDOW, NOTIFICATION_SEND_RATE
+from services.weather_api import (
+    fetch_bundle, prefetch_current_weather, location_cell, get_cell_record, get_from_cache,
+    PART_CURRENT, PART_FORECAST, PART_AIR, PART_ENDPOINTS
+)
+from services.governor import PRIORITY_NOTIFICATION, TokenBucket
+from services.notification_rules import (
+    LocationData, RULE_TYPES, RULE_TEMP_SWING, affected_rules, compile_plan, evaluate_plan,
+    location_data, user_rules
+)
+from services.weather_events import WeatherDiff, subscribe, start_event_worker
+from services.history import observation_time, observed_temp
 from utils.formatters import format_current_weather
+from utils.metrics import metrics
 from services.user_storage import (
-    user_locations, notifications_enabled, notification_intervals,
-    last_weather, last_notification_check
+    users, user_locations, user_city_ids, notifications_enabled, notification_intervals,
+    notification_rules, notification_alerts, last_observed, last_notification_check,
+    notification_next_due, last_notification_sent, cell_subscribers, notification_subscribers, save_user_to_storage
 )
 
 
+SEND_MAX_ATTEMPTS = 3  # Сколько раз повторять отправку после ответа 429 от Telegram
+
+# Очередь исходящих уведомлений: (user_id, текст, номер попытки)
+_send_queue = queue.Queue()
+_send_bucket = TokenBucket(NOTIFICATION_SEND_RATE, NOTIFICATION_SEND_RATE)
+_lateness = metrics.latency('notifications.lateness')
+
+# Правила, уведомление по которым отложено до конца интервала подписчика: {user_id: {тип правила}}
+_deferred = defaultdict(set)
+_deferred_lock = threading.Lock()
+
+
+def send_queue_depth() -> int:
+    """Сколько уведомлений ждет отправки."""
+    return _send_queue.qsize()
+
+
+def overdue_checks(now: float = None) -> int:
+    """Сколько обновлений данных подписчиков уже наступило, но еще не выполнено."""
+    now = time.time() if now is None else now
+    return sum(1 for user_id in notification_subscribers() if notification_next_due.get(user_id, 0) <= now)
+
+
+def schedule_next_check(user_id: int):
+    """Назначает следующее обновление данных через интервал пользователя после последнего."""
+    with users.lock(user_id):
+        interval_seconds = notification_intervals.get(user_id, 2) * 3600
+        last_check = last_notification_check.get(user_id)
+        notification_next_due[user_id] = (last_check if last_check is not None else time.time()) + interval_seconds
+    save_user_to_storage(user_id)
+
+
+def _claim_check(user_id: int, now: float) -> bool:
+    """Если обновление данных подписчика наступило, отмечает его выполненным и назначает следующее.
+    Точкой отсчета для правила изменения температуры становится погода, которая сейчас в кэше:
+    изменение считается за интервал подписчика. Возвращает True, если обновление выполняет вызывающий."""
+    with users.lock(user_id):
+        if not notifications_enabled.get(user_id) or user_id not in user_locations:
+            return False
+        due = notification_next_due.get(user_id, 0)
+        if due > now:
+            return False
+        if due:
+            # Насколько обновление опоздало относительно расписания
+            _lateness.observe(now - due)
+        last_notification_check[user_id] = now
+        observed = user_id in last_observed
+        lat, lon, _ = user_locations[user_id]
+    # Запись кэша читается вне блокировки пользователя: она может потребовать чтения хранилища
+    weather = get_cell_record(location_cell(lat, lon), 'weather') if observed else None
+    if weather is not None:
+        last_observed[user_id] = observation_time(weather)
+    schedule_next_check(user_id)
+    return True
+
+
+def recover_schedule(window: float = NOTIFICATION_RECOVERY_WINDOW) -> int:
+    """Распределяет просроченные после перезапуска проверки случайно по окну window секунд,
+    чтобы они не выполнялись одновременно. Возвращает количество перенесенных проверок."""
+    now = time.time()
+    recovered = 0
+    for user_id in notification_subscribers():
+        with users.lock(user_id):
+            if notification_next_due.get(user_id, 0) <= now:
+                notification_next_due[user_id] = now + random.uniform(0, window)
+                recovered += 1
+    return recovered
+
+
 def check_weather_notifications(bot: TeleBot):
-    """Проверяет погоду и отправляет уведомления."""
+    """Раз в минуту обновляет данные ячеек подписчиков, которым пора. Правила здесь
+    не оцениваются: если данные изменились, кэш публикует событие, и правила
+    оценивает on_weather_diff. Затем доставляет отложенные ограничением частоты уведомления."""
+    recover_schedule()
+    
     while True:
-        # Проверяем каждую минуту, нужно ли отправить уведомление кому-то
+        # Проверяем каждую минуту, нужно ли обновить данные кому-то
         time.sleep(60)
         
-        current_time = datetime.now()
+        current_time = time.time()
         
-        # Создаем копию словаря для безопасной итерации
-        users_to_check = list(notifications_enabled.items())
+        # Сначала отбираем пользователей, которым пора обновлять данные, и сразу назначаем
+        # им следующее обновление. Снимок подписчиков неизменяем, поэтому его можно обходить без копирования
+        due_users = [user_id for user_id in notification_subscribers() if _claim_check(user_id, current_time)]
         
-        for user_id, enabled in users_to_check:
-            # Проверяем, что уведомления все еще включены
-            if not enabled or user_id not in notifications_enabled or not notifications_enabled[user_id]:
-                continue
-            
-            if user_id not in user_locations:
-                continue
-            
-            # Получаем интервал для пользователя
-            interval_h = notification_intervals.get(user_id, 2)
-            interval_seconds = interval_h * 3600
-            
-            # Проверяем, прошло ли достаточно времени с последней проверки
-            if user_id in last_notification_check:
-                last_check = last_notification_check[user_id]
-                elapsed = (current_time - last_check).total_seconds()
-                if elapsed < interval_seconds:
-                    continue  # Еще не прошло достаточно времени
-            
-            # Обновляем время последней проверки
-            last_notification_check[user_id] = current_time
-            
+        # Текущая погода для известных городов OWM — пакетами по 20 городов за запрос;
+        # дальше она берется из кэша
+        due_locations = []
+        for user_id in due_users:
+            location = user_locations.get(user_id)
+            if location is not None:
+                due_locations.append(location[:2] + (user_city_ids.get(user_id),))
+        try:
+            prefetch_current_weather(due_locations, priority=PRIORITY_NOTIFICATION)
+        except Exception:
+            pass  # Оставшиеся места будут запрошены по одному
+        
+        # Данные ячейки обновляются один раз для всех ее подписчиков (свежий кэш
+        # не запрашивается повторно)
+        subscribers_by_cell = defaultdict(list)
+        for user_id in due_users:
+            location = user_locations.get(user_id)
+            if location is not None:
+                subscribers_by_cell[location_cell(location[0], location[1])].append(user_id)
+        
+        for cell, user_ids in subscribers_by_cell.items():
             try:
-                lat, lon, city_name = user_locations[user_id]
-                weather = get_current_weather(lat, lon)
-                if weather is None:
-                    continue
-                
-                # Проверяем на дождь завтра
-                forecast = get_forecast_5d3h(lat, lon)
-                if forecast is None:
-                    continue
-                
-                tomorrow = (datetime.now() + timedelta(days=1)).date()
-                
-                # Группируем прогноз по дням
-                list_data = forecast.get('list', [])
-                days_data = defaultdict(list)
-                for item in list_data:
-                    dt = datetime.fromtimestamp(item['dt'])
-                    if dt.date() == tomorrow:
-                        days_data[tomorrow].append(item)
-                
-                rain_tomorrow = False
-                if tomorrow in days_data:
-                    for item in days_data[tomorrow]:
-                        weather_main = item['weather'][0]['main'].lower()
-                        if 'rain' in weather_main or 'drizzle' in weather_main or 'storm' in weather_main:
-                            rain_tomorrow = True
-                            break
-                
-                # Проверяем изменение погоды
-                weather_changed = False
-                if user_id in last_weather:
-                    old_weather = last_weather[user_id]
-                    old_temp = old_weather['main']['temp']
-                    new_temp = weather['main']['temp']
-                    
-                    if abs(old_temp - new_temp) > 5:  # Изменение более 5 градусов
-                        weather_changed = True
-                
-                # Отправляем уведомления
-                notification_text = f"🔔 Уведомление о погоде в {city_name}\n\n"
-                send_notification = False
-                
-                if rain_tomorrow:
-                    notification_text += "⚠️ Завтра ожидается дождь! Не забудьте зонт.\n\n"
-                    send_notification = True
-                
-                if weather_changed:
-                    old_temp = last_weather[user_id]['main']['temp']
-                    new_temp = weather['main']['temp']
-                    diff = new_temp - old_temp
-                    if diff > 0:
-                        notification_text += f"📈 Температура повысилась на {diff:.1f}°C\n"
-                    else:
-                        notification_text += f"📉 Температура понизилась на {abs(diff):.1f}°C\n"
-                    send_notification = True
-                
-                # Если это первая проверка, отправляем базовую информацию
-                if user_id not in last_weather:
-                    send_notification = True
-                    notification_text = f"🔔 Уведомления активированы для {city_name}\n\n"
-                    notification_text += format_current_weather(weather, city_name)
-                
-                if send_notification:
-                    try:
-                        bot.send_message(user_id, notification_text)
-                    except Exception:
-                        pass  # Пользователь заблокировал бота или ошибка
-                
-                # Сохраняем текущую погоду
-                last_weather[user_id] = weather
-                
+                refresh_location(user_ids)
+                greet_subscribers(cell, user_ids)
             except Exception:
                 continue  # Пропускаем ошибки
+        
+        try:
+            deliver_deferred(current_time)
+        except Exception:
+            pass
+
+
+def refresh_location(user_ids: list):
+    """Запрашивает данные ячейки, нужные правилам ее подписчиков (свежий кэш не запрашивается повторно)."""
+    lat, lon, _ = user_locations[user_ids[0]]
+    plan = compile_plan([(user_id, user_rules(notification_rules.get(user_id))) for user_id in user_ids])
+    fetch_bundle([(lat, lon)], tuple(plan.parts), priority=PRIORITY_NOTIFICATION)
+
+
+def greet_subscribers(cell: str, user_ids: list):
+    """После обновления данных ячейки запоминает город OWM подписчиков и отправляет
+    базовую информацию тем, кто еще ничего не видел. Состояние сохраняется,
+    поэтому после перезапуска это сообщение не повторяется."""
+    weather = get_cell_record(cell, 'weather')
+    if weather is None:
+        return
+    for user_id in user_ids:
+        location = user_locations.get(user_id)
+        if location is None:
+            continue
+        changed = False
+        with users.lock(user_id):
+            first_observation = user_id not in last_observed
+            if first_observation:
+                last_observed[user_id] = observation_time(weather)
+                changed = True
+            # Запоминаем город OWM для следующих пакетных запросов
+            if weather.city_id and user_city_ids.get(user_id) != weather.city_id:
+                user_city_ids[user_id] = weather.city_id
+                changed = True
+        if changed:
+            save_user_to_storage(user_id)
+        if first_observation:
+            notification_text = f"🔔 Уведомления активированы для {location[2]}\n\n"
+            notification_text += format_current_weather(weather, location[2])
+            enqueue_notification(user_id, notification_text)
+
+
+def _previous_temps(cell: str, user_ids) -> dict:
+    """Температуры, которые подписчики видели в прошлый раз (из истории ячейки по времени наблюдения)."""
+    observed_at = {user_id: last_observed.get(user_id) for user_id in user_ids}
+    temps = {at: observed_temp(cell, at) for at in set(observed_at.values())}
+    return {user_id: temps[at] for user_id, at in observed_at.items() if temps[at] is not None}
+
+
+def on_weather_diff(diff: WeatherDiff):
+    """Данные ячейки изменились: оценивает только правила, которые затронуло изменение
+    (affected_rules по полям события), и только по новой записи из события.
+    Расписание обновлений подписчиков не меняется; частоту отправки ограничивает _deliver."""
+    user_ids = cell_subscribers(diff.cell)
+    if not user_ids:
+        return
+    plan = compile_plan([(user_id, user_rules(notification_rules.get(user_id))) for user_id in user_ids])
+    affected = affected_rules(diff, plan.rule_types)
+    if not affected:
+        metrics.counter('notifications.diff_ignored').inc()
+        return
+    metrics.counter('notifications.diff_checks').inc(len(user_ids))
+    
+    data = location_data(diff.endpoint, diff.record)
+    alerts = evaluate_plan(plan, diff.cell, data, _previous_temps(diff.cell, user_ids), notification_alerts, affected)
+    now = time.time()
+    for user_id, messages in alerts.items():
+        _deliver(user_id, messages, data.weather, now)
+
+
+def _deliver(user_id: int, messages: list, weather, now: float) -> bool:
+    """Отправляет подписчику сработавшие правила [(тип, ключ события, текст), ...], если с прошлого
+    уведомления прошел его интервал; иначе откладывает типы правил до конца интервала
+    (deliver_deferred). Возвращает True, если уведомление поставлено в очередь."""
+    with users.lock(user_id):
+        location = user_locations.get(user_id)
+        if not notifications_enabled.get(user_id) or location is None:
+            return False
+        last_sent = last_notification_sent.get(user_id)
+        if last_sent is not None and now - last_sent < notification_intervals.get(user_id, 2) * 3600:
+            with _deferred_lock:
+                _deferred[user_id].update(rule_type for rule_type, _, _ in messages)
+            metrics.counter('notifications.deferred').inc()
+            return False
+        last_notification_sent[user_id] = now
+        if weather is not None and any(rule_type == RULE_TEMP_SWING for rule_type, _, _ in messages):
+            # Подписчик увидел новую температуру: следующее изменение считается от нее
+            last_observed[user_id] = observation_time(weather)
+        keys = {rule_type: alert_key for rule_type, alert_key, _ in messages if alert_key is not None}
+        if keys:
+            notification_alerts.apply(user_id, lambda sent: {**(sent or {}), **keys})
+    save_user_to_storage(user_id)
+    
+    notification_text = f"🔔 Уведомление о погоде в {location[2]}\n\n"
+    notification_text += ''.join(message for _, _, message in messages)
+    enqueue_notification(user_id, notification_text)
+    return True
+
+
+def deliver_deferred(now: float):
+    """Для подписчиков, у которых закончился интервал с прошлого уведомления, повторно
+    оценивает отложенные правила по свежим данным кэша (без запросов к OWM) и отправляет
+    то, что все еще срабатывает. Если свежих данных нет, правила остаются отложенными
+    до следующего обновления ячейки."""
+    with _deferred_lock:
+        user_ids = list(_deferred)
+    for user_id in user_ids:
+        location = user_locations.get(user_id)
+        if not notifications_enabled.get(user_id) or location is None:
+            with _deferred_lock:
+                _deferred.pop(user_id, None)
+            continue
+        last_sent = last_notification_sent.get(user_id, 0)
+        if now - last_sent < notification_intervals.get(user_id, 2) * 3600:
+            continue
+        
+        with _deferred_lock:
+            rule_types = frozenset(_deferred.get(user_id, ()))
+        lat, lon, _ = location
+        parts = frozenset().union(*(RULE_TYPES[rule_type].parts for rule_type in rule_types))
+        records = {part: get_from_cache(lat, lon, PART_ENDPOINTS[part]) for part in parts}
+        if any(record is None for record in records.values()):
+            continue
+        
+        with _deferred_lock:
+            _deferred.pop(user_id, None)
+        cell = location_cell(lat, lon)
+        data = LocationData(records.get(PART_CURRENT), records.get(PART_FORECAST), records.get(PART_AIR))
+        plan = compile_plan([(user_id, user_rules(notification_rules.get(user_id)))])
+        alerts = evaluate_plan(plan, cell, data, _previous_temps(cell, (user_id,)), notification_alerts, rule_types)
+        if user_id in alerts:
+            _deliver(user_id, alerts[user_id], data.weather, now)
+
+
+def enqueue_notification(user_id: int, text: str):
+    """Ставит уведомление в очередь отправки."""
+    _send_queue.put((user_id, text, 1))
+
+
+def _retry_after(error: Exception) -> float:
+    """Возвращает паузу из ответа 429 от Telegram или 0 для других ошибок."""
+    if getattr(error, 'error_code', None) != 429:
+        return 0.0
+    result = getattr(error, 'result_json', None) or {}
+    return float(result.get('parameters', {}).get('retry_after', 1))
+
+
+def _sender_loop(bot: TeleBot):
+    """Отправляет уведомления из очереди не чаще NOTIFICATION_SEND_RATE в секунду."""
+    while True:
+        user_id, text, attempt = _send_queue.get()
+        wait = _send_bucket.try_take()
+        while wait > 0:
+            time.sleep(wait)
+            wait = _send_bucket.try_take()
+        
+        try:
+            bot.send_message(user_id, text)
+            metrics.counter('notifications.sent').inc()
+        except Exception as e:
+            pause = _retry_after(e)
+            if pause and attempt < SEND_MAX_ATTEMPTS:
+                # Telegram просит подождать: останавливаем всю отправку, а не только это сообщение
+                metrics.counter('notifications.throttled').inc()
+                _send_bucket.drain()
+                time.sleep(pause)
+                _send_queue.put((user_id, text, attempt + 1))
+            else:
+                metrics.counter('notifications.failed').inc()  # Пользователь заблокировал бота или ошибка
+
 
+def start_event_notifications(bot: TeleBot):
+    """Подписывает рассылку уведомлений на изменения данных и запускает
+    доставку событий и поток отправки уведомлений."""
+    subscribe(on_weather_diff)
+    start_event_worker()
+    threading.Thread(target=_sender_loop, args=(bot,), daemon=True).start()
@@ -0,0 +1,269 @@
+"""Проекция ответов OWM в компактные записи.
+
+Из ответа API при получении оставляются только поля, которые использует бот.
+В кэше записи хранятся как списки значений в порядке полей; при изменении
+набора полей увеличивается SCHEMA_VERSION, и старые записи кэша
+перестают совпадать по ключу.
+
+Для прогноза при получении один раз вычисляются сводки по дням в часовом
+поясе города (DaySummary), и они хранятся в кэше вместе с записью.
+"""
+
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+
+SCHEMA_VERSION = 8
+
+# Значения ForecastItem.main (в нижнем регистре), которые считаются осадками-дождем
+RAIN_KINDS = ('rain', 'drizzle', 'storm')
+
+
+class WeatherRecord(NamedTuple):
+    """Текущая погода (/data/2.5/weather или элемент /data/2.5/group)."""
+    cell: str  # Ячейка местоположения (см. weather_api.location_cell)
+    fetched_at: float  # Время получения от OWM — версия данных
+    city_id: int  # Идентификатор города OWM (для /data/2.5/group), 0 если неизвестен
+    name: str
+    dt: int
+    temp: float
+    feels_like: float
+    humidity: int
+    pressure: int
+    wind_speed: float
+    wind_deg: int
+    description: str
+    clouds: int
+    visibility: Optional[int]
+    sunrise: int
+    sunset: int
+    condition_id: int  # Код состояния погоды OWM (weather[0].id), 0 если неизвестен
+
+
+class ForecastItem(NamedTuple):
+    """Один трехчасовой интервал прогноза."""
+    dt: int
+    temp: float
+    feels_like: float
+    humidity: int
+    pressure: int
+    wind_speed: float
+    main: str
+    description: str
+    pop: float  # Вероятность осадков, 0..1
+
+
+class DaySummary(NamedTuple):
+    """Сводка прогноза за один день по местному времени города."""
+    date: str  # Дата в формате YYYY-MM-DD
+    first: int  # Индекс первого интервала дня в ForecastRecord.items
+    count: int  # Число интервалов дня
+    min_temp: float
+    max_temp: float
+    avg_temp: float
+    avg_feels_like: float
+    main: str  # Преобладающее состояние погоды (самое частое ForecastItem.main)
+    max_wind: float
+    rain_pop: Optional[float]  # Наибольшая вероятность осадков среди интервалов с дождем, 0..1; None — дождя нет
+    rain_windows: tuple  # dt интервалов с дождем, моросью или грозой
+
+
+class ForecastRecord(NamedTuple):
+    """Прогноз на 5 дней с шагом 3 часа (/data/2.5/forecast)."""
+    cell: str
+    fetched_at: float
+    city_name: str
+    items: tuple
+    timezone: int  # Смещение часового пояса города от UTC, сек
+    days: tuple  # DaySummary по дням в порядке дат
+
+
+class AirRecord(NamedTuple):
+    """Концентрации загрязнителей, мкг/м³ (/data/2.5/air_pollution)."""
+    cell: str
+    fetched_at: float
+    so2: float
+    no2: float
+    pm10: float
+    pm2_5: float
+    o3: float
+    co: float
+    dt: int  # Время данных (list[0].dt), 0 если неизвестно
+
+
+# Поля AirRecord с концентрациями загрязнителей
+POLLUTANT_FIELDS = ('so2', 'no2', 'pm10', 'pm2_5', 'o3', 'co')
+
+
+def project_weather(data: dict, cell: str, fetched_at: float) -> WeatherRecord:
+    """Оставляет из ответа /weather (или элемента списка /group) только используемые поля."""
+    main = data['main']
+    wind = data.get('wind', {})
+    weather = data.get('weather') or [{}]
+    sys = data.get('sys', {})
+    return WeatherRecord(
+        cell=cell,
+        fetched_at=fetched_at,
+        city_id=data.get('id', 0),
+        name=data.get('name', ''),
+        dt=data.get('dt', 0),
+        temp=main['temp'],
+        feels_like=main['feels_like'],
+        humidity=main['humidity'],
+        pressure=main['pressure'],
+        wind_speed=wind.get('speed', 0),
+        wind_deg=wind.get('deg', 0),
+        description=weather[0].get('description', ''),
+        clouds=data.get('clouds', {}).get('all', 0),
+        visibility=data.get('visibility'),
+        sunrise=sys.get('sunrise', 0),
+        sunset=sys.get('sunset', 0),
+        condition_id=weather[0].get('id', 0),
+    )
+
+
+def project_forecast_item(item: dict) -> ForecastItem:
+    """Оставляет из интервала прогноза только используемые поля."""
+    main = item['main']
+    weather = item.get('weather') or [{}]
+    return ForecastItem(
+        dt=item['dt'],
+        temp=main['temp'],
+        feels_like=main['feels_like'],
+        humidity=main['humidity'],
+        pressure=main['pressure'],
+        wind_speed=item.get('wind', {}).get('speed', 0),
+        main=weather[0].get('main', ''),
+        description=weather[0].get('description', ''),
+        pop=item.get('pop', 0),
+    )
+
+
+def is_rain(item: ForecastItem) -> bool:
+    """Дождь, морось или гроза в интервале прогноза."""
+    main = item.main.lower()
+    return any(kind in main for kind in RAIN_KINDS)
+
+
+def local_date(timestamp: float, tz_offset: int) -> date:
+    """Дата момента timestamp по местному времени пояса со смещением tz_offset секунд."""
+    return datetime.fromtimestamp(timestamp + tz_offset, timezone.utc).date()
+
+
+def local_time(timestamp: float, tz_offset: int) -> datetime:
+    """Местное время момента timestamp (без информации о поясе, только для вывода)."""
+    return datetime.fromtimestamp(timestamp + tz_offset, timezone.utc).replace(tzinfo=None)
+
+
+def summarize_days(items: tuple, tz_offset: int) -> tuple:
+    """Группирует интервалы прогноза по дням местного времени и считает сводки.
+    Интервалы OWM идут по возрастанию времени, поэтому день — непрерывный диапазон."""
+    days = []
+    first = 0
+    while first < len(items):
+        day = local_date(items[first].dt, tz_offset)
+        end = first
+        while end < len(items) and local_date(items[end].dt, tz_offset) == day:
+            end += 1
+        day_items = items[first:end]
+        temps = [item.temp for item in day_items]
+        rain = [item for item in day_items if is_rain(item)]
+        days.append(DaySummary(
+            date=day.isoformat(),
+            first=first,
+            count=end - first,
+            min_temp=min(temps),
+            max_temp=max(temps),
+            avg_temp=sum(temps) / len(temps),
+            avg_feels_like=sum(item.feels_like for item in day_items) / len(day_items),
+            main=Counter(item.main for item in day_items).most_common(1)[0][0],
+            max_wind=max(item.wind_speed for item in day_items),
+            rain_pop=max(item.pop for item in rain) if rain else None,
+            rain_windows=tuple(item.dt for item in rain),
+        ))
+        first = end
+    return tuple(days)
+
+
+def project_forecast(data: dict, cell: str, fetched_at: float) -> ForecastRecord:
+    """Оставляет из ответа /forecast только используемые поля и считает сводки по дням."""
+    tz_offset = data.get('city', {}).get('timezone', 0)
+    items = tuple(sorted((project_forecast_item(item) for item in data['list']), key=lambda item: item.dt))
+    return ForecastRecord(
+        cell=cell,
+        fetched_at=fetched_at,
+        city_name=data.get('city', {}).get('name', ''),
+        items=items,
+        timezone=tz_offset,
+        days=summarize_days(items, tz_offset),
+    )
+
+
+def day_items(record: ForecastRecord, summary: DaySummary) -> tuple:
+    """Интервалы прогноза одного дня."""
+    return record.items[summary.first:summary.first + summary.count]
+
+
+def day_summary(record: ForecastRecord, day: date) -> Optional[DaySummary]:
+    """Сводка прогноза за день или None, если день не входит в прогноз."""
+    key = day.isoformat()
+    for summary in record.days:
+        if summary.date == key:
+            return summary
+    return None
+
+
+def local_tomorrow(record: ForecastRecord, now: float) -> date:
+    """Завтрашняя дата по местному времени города прогноза."""
+    return local_date(now, record.timezone) + timedelta(days=1)
+
+
+def project_air(components: dict, cell: str, fetched_at: float, dt: int = 0) -> AirRecord:
+    """Оставляет из компонентов загрязнения только анализируемые загрязнители."""
+    return AirRecord(cell, fetched_at, *(components.get(field, 0) for field in POLLUTANT_FIELDS), dt)
+
+
+def air_components(record: AirRecord) -> dict:
+    """Возвращает концентрации загрязнителей в виде словаря для analyze_air_pollution."""
+    return {field: getattr(record, field) for field in POLLUTANT_FIELDS}
+
+
+# --- Представление в кэше ---
+
+def _forecast_to_row(record: ForecastRecord) -> list:
+    return [
+        record.cell, record.fetched_at, record.city_name, [list(item) for item in record.items],
+        record.timezone, [list(day) for day in record.days],
+    ]
+
+
+def _day_from_row(row: list) -> DaySummary:
+    summary = DaySummary._make(row)
+    return summary._replace(rain_windows=tuple(summary.rain_windows))
+
+
+def _forecast_from_row(row: list) -> ForecastRecord:
+    cell, fetched_at, city_name, items, tz_offset, days = row
+    return ForecastRecord(
+        cell, fetched_at, city_name, tuple(ForecastItem._make(item) for item in items),
+        tz_offset, tuple(_day_from_row(day) for day in days),
+    )
+
+
+# {endpoint: (запись -> строка кэша, строка кэша -> запись)}
+CODECS = {
+    'weather': (list, WeatherRecord._make),
+    'forecast': (_forecast_to_row, _forecast_from_row),
+    'air_pollution': (list, AirRecord._make),
+}
+
+
+def to_row(endpoint: str, record) -> list:
+    """Преобразует запись в список значений для хранения в кэше."""
+    return CODECS[endpoint][0](record)
+
+
+def from_row(endpoint: str, row: list):
+    """Восстанавливает запись из списка значений кэша."""
+    return CODECS[endpoint][1](row)
@@ -0,0 +1,71 @@
+"""Сводка показателей работы бота для команды /stats.
+
+Показатели собираются из общего реестра метрик и состояния сервисов в момент
+запроса; на горячих путях обновляются только дешевые счетчики и гистограммы.
+"""
+
+from services.weather_api import governor, breaker
+from services.notifications import send_queue_depth, overdue_checks
+from services.user_storage import user_data, user_locations, notification_subscribers
+from utils.metrics import metrics, process_rss
+
+
+def _cache_stats() -> dict:
+    """Попадания в кэш по видам данных и уровням (память, хранилище)
+    и повторные запросы к OWM, вернувшие те же данные."""
+    result = {}
+
+    def counts_for(endpoint: str) -> dict:
+        return result.setdefault(endpoint, {'memory': 0, 'store': 0, 'miss': 0, 'identical': 0, 'changed': 0})
+
+    for name, value in metrics.counters('cache.hit.').items():
+        endpoint, tier = name[len('cache.hit.'):].rsplit('.', 1)
+        counts_for(endpoint)[tier] = value
+    for name, value in metrics.counters('cache.miss.').items():
+        counts_for(name[len('cache.miss.'):])['miss'] = value
+    for name, value in metrics.counters('cache.refetch.').items():
+        outcome, endpoint = name[len('cache.refetch.'):].split('.', 1)
+        counts_for(endpoint)[outcome] = value
+    for counts in result.values():
+        total = counts['memory'] + counts['store'] + counts['miss']
+        counts['hit_ratio'] = (counts['memory'] + counts['store']) / total if total else 0.0
+    return result
+
+
+def collect_stats() -> dict:
+    """Собирает текущие показатели: OWM, кэш, объединение запросов, уведомления,
+    задержки обработчиков, память процесса и число пользователей."""
+    leaders = metrics.counters('owm.single_flight').get('owm.single_flight', 0)
+    coalesced = metrics.counters('owm.coalesced').get('owm.coalesced', 0)
+    notifications = metrics.counters('notifications.')
+    return {
+        'owm': {
+            'calls_per_minute': metrics.rate('owm.calls').per_minute(),
+            'minute_limit': governor.calls_per_minute,
+            'minute_available': int(governor.bucket.available()),
+            'remaining_today': governor.remaining_today(),
+            'day_limit': governor.calls_per_day,
+            'breaker': breaker.state,
+            'shed': sum(metrics.counters('owm.shed.').values()),
+        },
+        'cache': _cache_stats(),
+        'single_flight': {
+            'leaders': leaders,
+            'coalesced': coalesced,
+            'ratio': coalesced / (leaders + coalesced) if leaders + coalesced else 0.0,
+        },
+        'notifications': {
+            'overdue': overdue_checks(),
+            'lateness': metrics.latency('notifications.lateness').snapshot(),
+            'send_queue': send_queue_depth(),
+            'sent': notifications.get('notifications.sent', 0),
+            'failed': notifications.get('notifications.failed', 0),
+        },
+        'handlers': metrics.latency('handlers').snapshot(),
+        'rss': process_rss(),
+        'users': {
+            'sessions': len(user_data),
+            'locations': len(user_locations),
+            'subscribers': len(notification_subscribers()),
+        },
+    }
@@ -32,6 +32,58 @@ def load_user(user_id: int) -> dict:
         return {}
 
 
+def _write_atomic(all_data: dict) -> None:
+    """
+    Атомарно перезаписывает файл хранилища.
+    
+    Данные пишутся во временный файл в той же папке, сбрасываются на диск (fsync)
+    и подменяют основной файл через os.replace, поэтому сбой посреди записи
+    не оставляет поврежденный User_Data.json.
+    
+    Args:
+        all_data: Словарь со всеми пользователями
+    """
+    tmp_path = STORAGE_FILE.with_name(f"{STORAGE_FILE.name}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(all_data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, STORAGE_FILE)
+    
+    # Фиксируем переименование в каталоге (на платформах, где это возможно)
+    try:
+        dir_fd = os.open(STORAGE_FILE.parent, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def save_users(batch: Dict[int, dict]) -> None:
+    """
+    Сохраняет данные нескольких пользователей за одну запись файла.
+    
+    Args:
+        batch: Словарь {user_id: данные пользователя}
+    """
+    if not batch:
+        return
+    
+    # Загружаем все существующие данные
+    all_data = load_all_users()
+    
+    # Обновляем данные пользователей пакета
+    for user_id, data in batch.items():
+        all_data[str(user_id)] = data
+    
+    # Сохраняем обратно в файл (ошибки записи пробрасываются вызывающему)
+    _write_atomic(all_data)
+
+
 def save_user(user_id: int, data: dict) -> None:
     """
     Сохраняет данные пользователя в файл.
@@ -40,24 +92,9 @@ def save_user(user_id: int, data: dict) -> None:
         user_id: ID пользователя
         data: Словарь с данными пользователя для сохранения
     """
-    # Загружаем все существующие данные
-    all_data = {}
-    if STORAGE_FILE.exists():
-        try:
-            with open(STORAGE_FILE, 'r', encoding='utf-8') as f:
-                all_data = json.load(f)
-        except (json.JSONDecodeError, IOError):
-            all_data = {}
-    
-    # Обновляем данные конкретного пользователя
-    user_id_str = str(user_id)
-    all_data[user_id_str] = data
-    
-    # Сохраняем обратно в файл
     try:
-        with open(STORAGE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(all_data, f, ensure_ascii=False, indent=2)
-    except IOError:
+        save_users({user_id: data})
+    except OSError:
         pass  # Игнорируем ошибки записи
 
 
@@ -68,13 +105,39 @@ def load_all_users() -> dict:
     Returns:
         dict: Словарь со всеми пользователями
     """
-    if not STORAGE_FILE.exists():
+    return parse_storage(read_storage())
+
+
+def read_storage() -> Optional[bytes]:
+    """
+    Читает содержимое файла хранилища целиком.
+    
+    Returns:
+        bytes: Содержимое файла или None, если файла нет или он не читается
+    """
+    try:
+        return STORAGE_FILE.read_bytes()
+    except (FileNotFoundError, IOError):
+        return None
+
+
+def parse_storage(raw: Optional[bytes]) -> dict:
+    """
+    Разбирает содержимое файла хранилища.
+    
+    Args:
+        raw: Содержимое файла, полученное через read_storage()
+        
+    Returns:
+        dict: Словарь со всеми пользователями или пустой словарь при ошибке
+    """
+    if not raw:
         return {}
     
     try:
-        with open(STORAGE_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError, Exception):
+        data = json.loads(raw)
+        return data if isinstance(data, dict) else {}
+    except (json.JSONDecodeError, UnicodeDecodeError, ValueError):
         return {}
 
 
@@ -95,9 +158,7 @@ def delete_user(user_id: int) -> None:
         user_id_str = str(user_id)
         if user_id_str in all_data:
             del all_data[user_id_str]
-            
-            with open(STORAGE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(all_data, f, ensure_ascii=False, indent=2)
+            _write_atomic(all_data)
     except (json.JSONDecodeError, IOError):
         pass
 
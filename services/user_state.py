@@ -0,0 +1,164 @@
+"""Потокобезопасное хранилище состояния пользователей в памяти.
+
+Все данные пользователя лежат в одной записи UserRecord. Записи защищены
+полосами блокировок: пользователю соответствует одна из STRIPES блокировок
+по его id, поэтому обработчики разных пользователей не ждут друг друга,
+а изменения одного пользователя из разных потоков не перемешиваются.
+
+Для совместимости с остальным кодом поля записей доступны через FieldView —
+объект с интерфейсом словаря {user_id: значение поля}. Каждая операция
+с ним атомарна; для чтения-изменения-записи есть FieldView.apply()
+и UserStore.lock(user_id).
+"""
+
+import threading
+from collections.abc import MutableMapping
+from typing import Callable, Optional
+
+
+STRIPES = 64
+
+_MISSING = object()  # Поле не задано (как отсутствующий ключ словаря)
+
+
+class UserRecord:
+    """Данные одного пользователя."""
+
+    __slots__ = (
+        'session',  # Состояние диалога и временные данные обработчиков
+        'location',  # (lat, lon, city_name)
+        'city_id',  # Город OWM для пакетных запросов /data/2.5/group
+        'notifications_enabled',
+        'notification_interval',  # Часы
+        'notification_rules',  # {rule_type: threshold}
+        'last_observed',  # Время наблюдения (services.history), которое подписчик видел в прошлый раз
+        'last_check',  # Время последней проверки, сек
+        'next_due',  # Время следующей проверки, сек
+        'last_sent',  # Время последнего уведомления о сработавших правилах, сек
+        'alerts',  # {rule_type: ключ последнего отправленного события}
+    )
+
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, _MISSING)
+
+
+class UserStore:
+    """Записи пользователей с полосами блокировок по user_id."""
+
+    def __init__(self, stripes: int = STRIPES):
+        self._records = {}  # {user_id: UserRecord}
+        self._locks = tuple(threading.RLock() for _ in range(stripes))
+
+    def lock(self, user_id: int) -> threading.RLock:
+        """Блокировка записи пользователя. Повторно входимая: внутри нее можно
+        обращаться к полям через FieldView."""
+        return self._locks[hash(user_id) % len(self._locks)]
+
+    def get(self, user_id: int) -> Optional[UserRecord]:
+        """Возвращает запись пользователя или None, не создавая ее."""
+        return self._records.get(user_id)
+
+    def record(self, user_id: int) -> UserRecord:
+        """Возвращает запись пользователя, создавая ее при первом обращении."""
+        record = self._records.get(user_id)
+        if record is None:
+            with self.lock(user_id):
+                record = self._records.setdefault(user_id, UserRecord())
+        return record
+
+    def update(self, user_id: int, func: Callable):
+        """Атомарно вызывает func(запись) под блокировкой пользователя и возвращает результат."""
+        with self.lock(user_id):
+            return func(self.record(user_id))
+
+    def user_ids(self) -> list:
+        """Все пользователи с записями."""
+        return list(self._records)
+
+    def field(self, name: str, factory: Optional[Callable] = None) -> 'FieldView':
+        """Возвращает представление поля записей в виде словаря."""
+        if name not in UserRecord.__slots__:
+            raise ValueError(f"Неизвестное поле записи пользователя: {name}")
+        return FieldView(self, name, factory)
+
+
+class FieldView(MutableMapping):
+    """Словарь {user_id: значение поля записи}.
+    С factory отсутствующее значение создается при обращении (как defaultdict)."""
+
+    def __init__(self, store: UserStore, name: str, factory: Optional[Callable] = None):
+        self._store = store
+        self._name = name
+        self._factory = factory
+
+    def _value(self, user_id):
+        record = self._store.get(user_id)
+        return _MISSING if record is None else getattr(record, self._name)
+
+    def __getitem__(self, user_id):
+        value = self._value(user_id)
+        if value is not _MISSING:
+            return value
+        if self._factory is None:
+            raise KeyError(user_id)
+        with self._store.lock(user_id):
+            record = self._store.record(user_id)
+            value = getattr(record, self._name)
+            if value is _MISSING:
+                value = self._factory()
+                setattr(record, self._name, value)
+            return value
+
+    def __setitem__(self, user_id, value):
+        with self._store.lock(user_id):
+            setattr(self._store.record(user_id), self._name, value)
+
+    def __delitem__(self, user_id):
+        with self._store.lock(user_id):
+            record = self._store.get(user_id)
+            if record is None or getattr(record, self._name) is _MISSING:
+                raise KeyError(user_id)
+            setattr(record, self._name, _MISSING)
+
+    def __contains__(self, user_id) -> bool:
+        return self._value(user_id) is not _MISSING
+
+    def __iter__(self):
+        return (user_id for user_id in self._store.user_ids() if user_id in self)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def get(self, user_id, default=None):
+        value = self._value(user_id)
+        return default if value is _MISSING else value
+
+    def pop(self, user_id, default=_MISSING):
+        with self._store.lock(user_id):
+            value = self._value(user_id)
+            if value is _MISSING:
+                if default is _MISSING:
+                    raise KeyError(user_id)
+                return default
+            setattr(self._store.get(user_id), self._name, _MISSING)
+            return value
+
+    def setdefault(self, user_id, default=None):
+        with self._store.lock(user_id):
+            record = self._store.record(user_id)
+            value = getattr(record, self._name)
+            if value is _MISSING:
+                value = default
+                setattr(record, self._name, value)
+            return value
+
+    def apply(self, user_id, func: Callable, default=None):
+        """Атомарно заменяет значение на func(текущее значение или default)
+        и возвращает новое значение."""
+        with self._store.lock(user_id):
+            record = self._store.record(user_id)
+            value = getattr(record, self._name)
+            value = func(default if value is _MISSING else value)
+            setattr(record, self._name, value)
+            return value
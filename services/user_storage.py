@@ -1,39 +1,212 @@
 """Сервис для работы с данными пользователей."""
 
-from collections import defaultdict
-from services.storage import load_user, save_user, load_all_users
+import threading
+import time
+from config import STORAGE_FLUSH_INTERVAL, STORAGE_FLUSH_THRESHOLD, STARTUP_LAZY_HYDRATION
+from services.storage import load_user, save_users, read_storage, parse_storage
+from services.user_state import UserStore
+from services.weather_api import location_cell
+from utils.tracing import span, trace_update
 
 
-# Глобальные хранилища данных пользователей
-user_data = defaultdict(dict)
-user_locations = {}  # {user_id: (lat, lon, city_name)}
-notifications_enabled = {}  # {user_id: True/False}
-notification_intervals = {}  # {user_id: interval_hours}
-last_weather = {}  # {user_id: weather_data} для отслеживания изменений
-last_notification_check = {}  # {user_id: datetime}
+# Записи пользователей с блокировками по user_id (см. services/user_state.py)
+users = UserStore()
+
+# Поля записей в виде словарей {user_id: значение}; каждая операция атомарна
+user_data = users.field('session', dict)
+user_locations = users.field('location')  # {user_id: (lat, lon, city_name)}
+user_city_ids = users.field('city_id')  # {user_id: OWM city id} для пакетных запросов /data/2.5/group
+notifications_enabled = users.field('notifications_enabled')  # {user_id: True/False}
+notification_intervals = users.field('notification_interval')  # {user_id: interval_hours}
+notification_rules = users.field('notification_rules')  # {user_id: {rule_type: threshold}}; нет записи — правила по умолчанию
+# Состояние рассылки уведомлений; сохраняется вместе с пользователем и переживает перезапуск
+last_observed = users.field('last_observed')  # {user_id: время наблюдения} — что подписчик видел в прошлый раз; температура берется из истории
+last_notification_check = users.field('last_check')  # {user_id: время последней проверки, сек}
+notification_next_due = users.field('next_due')  # {user_id: время следующей проверки, сек}
+last_notification_sent = users.field('last_sent')  # {user_id: время последнего уведомления о сработавших правилах, сек}
+notification_alerts = users.field('alerts')  # {user_id: {rule_type: ключ последнего отправленного события}}
+
+# Подписчики уведомлений по ячейкам местоположения: {cell: frozenset(user_id, ...)}.
+# Множества не изменяются, а заменяются, поэтому читатели обходят их без копирования
+_cell_subscribers = {}
+_subscriber_cells = {}  # {user_id: cell}
+_all_subscribers = frozenset()
+_subscribers_lock = threading.Lock()
+
+# Отложенная запись: пользователи с несохраненными изменениями
+_dirty_users = set()
+_dirty_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_flush_requested = threading.Event()
+_flusher_stop = threading.Event()
+_flusher_thread = None
+
+# Записи пользователей, загруженные при старте, но еще не примененные к памяти
+_pending_records = {}  # {user_id: stored_data}
+_pending_lock = threading.Lock()
 
 
 def load_user_from_storage(user_id: int):
     """Загружает данные пользователя из хранилища и обновляет память."""
-    stored_data = load_user(user_id)
+    # Блокировка сброса исключает чтение файла посреди пакетной записи
+    with _flush_lock:
+        with _dirty_lock:
+            if user_id in _dirty_users:
+                return  # В памяти более свежие данные, чем в файле
+        stored_data = load_user(user_id)
+    
+    with _pending_lock:
+        _pending_records.pop(user_id, None)
     
     if stored_data:
-        # Восстанавливаем местоположение
-        if 'lat' in stored_data and 'lon' in stored_data and 'city' in stored_data:
-            user_locations[user_id] = (
-                stored_data['lat'],
-                stored_data['lon'],
-                stored_data['city']
-            )
+        _apply_stored_record(user_id, stored_data)
+
+
+def _apply_stored_record(user_id: int, stored_data: dict, subscribe: bool = True):
+    """Переносит сохраненную запись пользователя в память.
+    subscribe=False — не обновлять индекс подписчиков (при загрузке он строится один раз)."""
+    with users.lock(user_id):
+        _apply_stored_fields(user_id, stored_data)
+    if subscribe:
+        update_subscription(user_id)
+
+
+def _apply_stored_fields(user_id: int, stored_data: dict):
+    # Восстанавливаем местоположение
+    if 'lat' in stored_data and 'lon' in stored_data and 'city' in stored_data:
+        user_locations[user_id] = (
+            stored_data['lat'],
+            stored_data['lon'],
+            stored_data['city']
+        )
+    if stored_data.get('city_id'):
+        user_city_ids[user_id] = stored_data['city_id']
+    
+    # Восстанавливаем настройки уведомлений
+    if 'notifications' in stored_data:
+        notifications_enabled[user_id] = stored_data['notifications'].get('enabled', False)
+        notification_intervals[user_id] = stored_data['notifications'].get('interval_h', 2)
+        if isinstance(stored_data['notifications'].get('rules'), dict):
+            notification_rules[user_id] = stored_data['notifications']['rules']
+        if isinstance(stored_data['notifications'].get('state'), dict):
+            _apply_notification_state(user_id, stored_data['notifications']['state'])
+
+
+def _apply_notification_state(user_id: int, state: dict):
+    """Восстанавливает состояние рассылки уведомлений пользователя."""
+    if state.get('last_check') is not None:
+        last_notification_check[user_id] = state['last_check']
+    if state.get('next_due') is not None:
+        notification_next_due[user_id] = state['next_due']
+    if state.get('last_sent') is not None:
+        last_notification_sent[user_id] = state['last_sent']
+    if state.get('observed_at') is not None:
+        last_observed[user_id] = state['observed_at']
+    elif state.get('last_temp') is not None:
+        # Формат до появления истории: время получения данных вместо времени наблюдения
+        last_observed[user_id] = state.get('last_temp_at', 0)
+    if isinstance(state.get('alerts'), dict):
+        notification_alerts[user_id] = dict(state['alerts'])
+
+
+def _notification_state(user_id: int) -> dict:
+    """Собирает состояние рассылки уведомлений пользователя для хранилища."""
+    state = {}
+    if user_id in last_notification_check:
+        state['last_check'] = last_notification_check[user_id]
+    if user_id in notification_next_due:
+        state['next_due'] = notification_next_due[user_id]
+    if user_id in last_notification_sent:
+        state['last_sent'] = last_notification_sent[user_id]
+    if user_id in last_observed:
+        state['observed_at'] = last_observed[user_id]
+    if notification_alerts.get(user_id):
+        state['alerts'] = notification_alerts[user_id]
+    return state
+
+
+def update_subscription(user_id: int):
+    """Обновляет индекс подписчиков по ячейкам после изменения местоположения
+    или включения/отключения уведомлений пользователя."""
+    global _all_subscribers
+    # Блокировка пользователя держится до обновления индекса, чтобы
+    # одновременные изменения не записали в индекс устаревшую ячейку
+    with users.lock(user_id):
+        cell = None
+        location = user_locations.get(user_id)
+        if notifications_enabled.get(user_id) and location is not None:
+            lat, lon, _ = location
+            cell = location_cell(lat, lon)
         
-        # Восстанавливаем настройки уведомлений
-        if 'notifications' in stored_data:
-            notifications_enabled[user_id] = stored_data['notifications'].get('enabled', False)
-            notification_intervals[user_id] = stored_data['notifications'].get('interval_h', 2)
+        with _subscribers_lock:
+            old_cell = _subscriber_cells.get(user_id)
+            if old_cell == cell:
+                return
+            if old_cell is not None:
+                subscribers = _cell_subscribers.get(old_cell, frozenset()) - {user_id}
+                if subscribers:
+                    _cell_subscribers[old_cell] = subscribers
+                else:
+                    _cell_subscribers.pop(old_cell, None)
+                del _subscriber_cells[user_id]
+            if cell is not None:
+                _cell_subscribers[cell] = _cell_subscribers.get(cell, frozenset()) | {user_id}
+                _subscriber_cells[user_id] = cell
+                _all_subscribers = _all_subscribers | {user_id}
+            else:
+                _all_subscribers = _all_subscribers - {user_id}
 
 
-def save_user_to_storage(user_id: int):
-    """Сохраняет данные пользователя в хранилище."""
+def _rebuild_subscriptions():
+    """Строит индекс подписчиков заново по всем записям в памяти."""
+    global _all_subscribers
+    by_cell = {}
+    cells = {}
+    for user_id in users.user_ids():
+        location = user_locations.get(user_id)
+        if notifications_enabled.get(user_id) and location is not None:
+            cell = location_cell(location[0], location[1])
+            by_cell.setdefault(cell, set()).add(user_id)
+            cells[user_id] = cell
+    
+    with _subscribers_lock:
+        _cell_subscribers.clear()
+        _cell_subscribers.update((cell, frozenset(user_ids)) for cell, user_ids in by_cell.items())
+        _subscriber_cells.clear()
+        _subscriber_cells.update(cells)
+        _all_subscribers = frozenset(cells)
+
+
+def cell_subscribers(cell: str) -> frozenset:
+    """Возвращает подписчиков уведомлений в ячейке (неизменяемый снимок, без копирования)."""
+    return _cell_subscribers.get(cell, frozenset())
+
+
+def notification_subscribers() -> frozenset:
+    """Возвращает всех подписчиков уведомлений с местоположением
+    (неизменяемый снимок, без копирования)."""
+    return _all_subscribers
+
+
+def ensure_user_loaded(user_id: int):
+    """Применяет отложенную при старте запись пользователя, если она еще не применена.
+    Вызывается при каждом обновлении, поэтому быстрый путь — одна проверка словаря."""
+    if user_id not in _pending_records:
+        return
+    with _pending_lock:
+        stored_data = _pending_records.pop(user_id, None)
+    if stored_data:
+        _apply_stored_record(user_id, stored_data)
+
+
+def build_user_record(user_id: int) -> dict:
+    """Собирает запись пользователя для хранилища из данных в памяти."""
+    ensure_user_loaded(user_id)
+    with users.lock(user_id):
+        return _build_record_fields(user_id)
+
+
+def _build_record_fields(user_id: int) -> dict:
     data = {}
     
     # Сохраняем местоположение
@@ -42,25 +215,142 @@ def save_user_to_storage(user_id: int):
         data['lat'] = lat
         data['lon'] = lon
         data['city'] = city_name
+    if user_id in user_city_ids:
+        data['city_id'] = user_city_ids[user_id]
     
     # Сохраняем настройки уведомлений
     notifications = {
         'enabled': notifications_enabled.get(user_id, False),
         'interval_h': notification_intervals.get(user_id, 2)
     }
+    if user_id in notification_rules:
+        notifications['rules'] = notification_rules[user_id]
+    state = _notification_state(user_id)
+    if state:
+        notifications['state'] = state
     data['notifications'] = notifications
     
-    save_user(user_id, data)
+    return data
+
+
+def save_user_to_storage(user_id: int):
+    """Помечает данные пользователя как измененные.
+    Запись на диск выполняет фоновый поток (см. start_storage_flusher)."""
+    with _dirty_lock:
+        _dirty_users.add(user_id)
+        dirty_count = len(_dirty_users)
+    
+    if dirty_count >= STORAGE_FLUSH_THRESHOLD:
+        _flush_requested.set()
+
+
+def flush_dirty_users() -> int:
+    """Записывает всех измененных пользователей одним пакетом.
+    Возвращает количество сохраненных пользователей."""
+    with _flush_lock:
+        with _dirty_lock:
+            user_ids = list(_dirty_users)
+            _dirty_users.clear()
+        
+        if not user_ids:
+            return 0
+        
+        # Запись строится из текущего состояния, поэтому несколько изменений
+        # одного пользователя между сбросами сливаются в одну
+        with span('storage.build', users=len(user_ids)):
+            batch = {user_id: build_user_record(user_id) for user_id in user_ids}
+        try:
+            with span('storage.write', users=len(batch)):
+                save_users(batch)
+        except Exception:
+            # Возвращаем пользователей в очередь, чтобы не потерять изменения
+            with _dirty_lock:
+                _dirty_users.update(user_ids)
+            raise
+        return len(batch)
+
+
+def _storage_flusher_loop():
+    """Фоновый цикл отложенной записи."""
+    while not _flusher_stop.is_set():
+        _flush_requested.wait(STORAGE_FLUSH_INTERVAL)
+        _flush_requested.clear()
+        try:
+            # Фоновая запись — отдельная трасса, медленные сбросы сохраняются вместе с обновлениями
+            with trace_update('storage.flush'):
+                flush_dirty_users()
+        except Exception:
+            continue  # Повторим на следующей итерации
+
 
+def start_storage_flusher():
+    """Запускает фоновый поток отложенной записи данных пользователей."""
+    global _flusher_thread
+    if _flusher_thread is not None and _flusher_thread.is_alive():
+        return
+    _flusher_stop.clear()
+    _flusher_thread = threading.Thread(target=_storage_flusher_loop, daemon=True)
+    _flusher_thread.start()
 
-def load_all_users_from_storage():
-    """Загружает данные всех пользователей из хранилища при старте."""
-    all_users = load_all_users()
+
+def stop_storage_flusher():
+    """Останавливает поток отложенной записи и сохраняет все оставшиеся изменения."""
+    global _flusher_thread
+    _flusher_stop.set()
+    _flush_requested.set()
+    if _flusher_thread is not None:
+        _flusher_thread.join(timeout=STORAGE_FLUSH_INTERVAL + 5)
+        _flusher_thread = None
+    flush_dirty_users()
+
+
+def load_all_users_from_storage(lazy: bool = STARTUP_LAZY_HYDRATION) -> dict:
+    """Загружает данные всех пользователей из хранилища при старте.
+    
+    Файл читается и разбирается один раз. Подписчики уведомлений применяются
+    к памяти сразу (они нужны потоку уведомлений), остальные при lazy=True
+    откладываются до первого обновления от пользователя (см. ensure_user_loaded).
+    
+    Returns:
+        dict: Длительность этапов загрузки в секундах и количество пользователей
+    """
+    timings = {}
+    
+    start = time.perf_counter()
+    raw = read_storage()
+    timings['read'] = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    all_users = parse_storage(raw)
+    timings['parse'] = time.perf_counter() - start
     
-    for user_id_str, user_data_dict in all_users.items():
+    start = time.perf_counter()
+    pending = {}
+    hydrated = 0
+    for user_id_str, stored_data in all_users.items():
         try:
             user_id = int(user_id_str)
-            load_user_from_storage(user_id)
-        except (ValueError, KeyError):
+        except ValueError:
             continue
-
+        if not isinstance(stored_data, dict):
+            continue
+        
+        try:
+            subscriber = stored_data.get('notifications', {}).get('enabled', False)
+            if lazy and not subscriber:
+                pending[user_id] = stored_data
+                continue
+            _apply_stored_record(user_id, stored_data, subscribe=False)
+            hydrated += 1
+        except (KeyError, TypeError, AttributeError):
+            continue
+    
+    _rebuild_subscriptions()
+    with _pending_lock:
+        _pending_records.update(pending)
+    timings['hydrate'] = time.perf_counter() - start
+    
+    timings['users'] = len(all_users)
+    timings['hydrated'] = hydrated
+    timings['deferred'] = len(pending)
+    return timings
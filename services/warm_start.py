@@ -0,0 +1,103 @@
+"""Теплый старт: снимок горячих данных кэша.
+
+При остановке и периодически в файл сохраняются самые востребованные записи
+кэша в памяти (погода, прогнозы, качество воздуха, координаты городов) и готовые
+тексты сообщений. При запуске снимок загружается обратно, а записи, истекшие
+за время простоя, отбрасываются. Так после перезапуска первые запросы
+пользователей не уходят в OWM и не форматируются заново.
+"""
+
+import os
+import zlib
+import threading
+import time
+from pathlib import Path
+from services.cache_store import encode_payload, decode_payload
+from services.projection import ForecastRecord
+from services.weather_api import CACHE_DIR, memory_snapshot, memory_restore
+from utils.formatters import format_forecast_5days
+from utils.render_cache import render_cache
+
+
+SNAPSHOT_FILE = CACHE_DIR / "warm_start.snapshot"
+SNAPSHOT_FORMAT = 1
+
+_snapshot_stop = threading.Event()
+_snapshot_thread = None
+
+
+def save_snapshot(path: Path = SNAPSHOT_FILE) -> int:
+    """Атомарно записывает снимок горячих данных. Возвращает количество записей кэша."""
+    entries = memory_snapshot()
+    snapshot = {
+        'format': SNAPSHOT_FORMAT,
+        'saved_at': time.time(),
+        'entries': entries,
+        'renders': render_cache.snapshot(),
+    }
+    blob = encode_payload(snapshot, compress=True)
+
+    path.parent.mkdir(exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(entries)
+
+
+def load_snapshot(path: Path = SNAPSHOT_FILE) -> dict:
+    """Загружает снимок, отбрасывая истекшие записи.
+    Возвращает количество восстановленных записей, текстов и время загрузки."""
+    started = time.perf_counter()
+    result = {'entries': 0, 'renders': 0, 'time': 0.0}
+    try:
+        with open(path, 'rb') as f:
+            snapshot = decode_payload(f.read())
+    except (OSError, ValueError, zlib.error):
+        return result
+    if not isinstance(snapshot, dict) or snapshot.get('format') != SNAPSHOT_FORMAT:
+        return result
+
+    records = memory_restore(snapshot.get('entries', []))
+    versions = {(record.cell, record.fetched_at) for record in records}
+    result['entries'] = len(records)
+    result['renders'] = render_cache.restore(snapshot.get('renders', []), versions)
+
+    # Прогнозы форматируются в текст и данные по дням, поэтому не попадают в снимок —
+    # строим их заново по восстановленным записям, пока бот еще не принимает запросы
+    for record in records:
+        if isinstance(record, ForecastRecord):
+            format_forecast_5days(record)
+            result['renders'] += 1
+
+    result['time'] = time.perf_counter() - started
+    return result
+
+
+def _snapshot_loop(interval: float):
+    while not _snapshot_stop.wait(interval):
+        try:
+            save_snapshot()
+        except Exception:
+            continue  # Повторим на следующей итерации
+
+
+def start_snapshot_writer(interval: float):
+    """Запускает периодическую запись снимка, чтобы он пережил аварийную остановку."""
+    global _snapshot_thread
+    if _snapshot_thread is not None and _snapshot_thread.is_alive():
+        return
+    _snapshot_stop.clear()
+    _snapshot_thread = threading.Thread(target=_snapshot_loop, args=(interval,), daemon=True)
+    _snapshot_thread.start()
+
+
+def stop_snapshot_writer():
+    """Останавливает периодическую запись и сохраняет последний снимок."""
+    _snapshot_stop.set()
+    try:
+        save_snapshot()
+    except Exception:
+        pass  # Без снимка бот просто стартует с холодным кэшем
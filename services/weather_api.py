@@ -1,21 +1,104 @@
 """API для работы с OpenWeatherMap."""
 
-import os
-from dotenv import load_dotenv
+import math
 import time
-from typing import Optional
-import requests
+import random
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait
+from typing import TYPE_CHECKING, NamedTuple, Optional
 import json
-import hashlib
+import threading
+from collections import OrderedDict
 from pathlib import Path
+from services.cache_store import create_cache_store, CacheCompactor
+from services.cache_expiry import record_ttl, same_data
+from services.projection import (
+    SCHEMA_VERSION, WeatherRecord, ForecastRecord, AirRecord,
+    project_weather, project_forecast, project_air, air_components, to_row, from_row
+)
+from services.governor import (
+    RequestGovernor, CircuitBreaker, PRIORITY_MAX_WAIT,
+    PRIORITY_INTERACTIVE, PRIORITY_INLINE, PRIORITY_NOTIFICATION, PRIORITY_PREFETCH
+)
+from utils.metrics import metrics
+from utils.tracing import span, traced, run_in_context
+from config import settings
 
+if TYPE_CHECKING:
+    import requests  # Загружается при первом запросе к OWM
 
-load_dotenv()
 
-OW_API_KEY = os.getenv("OW_API_KEY")
-CACHE_DIR = Path(".cache")
-CACHE_DIR.mkdir(exist_ok=True)
-CACHE_TTL = 600  # 10 минут в секундах
+OW_API_KEY = settings.ow_api_key
+CACHE_DIR = Path(settings.cache_dir)
+CACHE_STALE_TTL = settings.cache_stale_ttl  # Сколько хранить устаревшие данные для отказа OWM
+GEOCODE_TTL = settings.geocode_ttl  # Координаты городов почти не меняются: 30 дней
+
+# Хранилище кэша: sqlite (один файл) или files (файл на ключ), с разобранными записями в памяти
+CACHE_BACKEND = settings.cache_backend
+CACHE_COMPRESS = settings.cache_compress
+CACHE_MEMORY_ENTRIES = settings.cache_memory_entries
+CACHE_COMPACT_INTERVAL = settings.cache_compact_interval
+
+# Хранилище открывается, а пулы потоков создаются при первом использовании,
+# поэтому импорт модуля не трогает диск и не запускает потоков
+_cache_store = None
+_compactor = None
+_executor = None
+_bundle_executor = None
+_lazy_lock = threading.Lock()
+_memory_cache = OrderedDict()  # {key: (timestamp, ttl, data)}
+_memory_lock = threading.Lock()
+_cache_listeners = []  # Функции (endpoint, record, previous), вызываемые после обновления записи кэша
+_inflight = {}  # {ключ: Future} запросов к OWM, выполняющихся прямо сейчас
+_inflight_lock = threading.Lock()
+
+# Точность ячейки местоположения: 2 знака (~1 км). Запросы к OWM и кэш
+# используют координаты ячейки, поэтому соседние пользователи делят записи
+CELL_PRECISION = 2
+
+# Квоты тарифа OWM (Free: 60 запросов в минуту, 1 000 000 в месяц)
+OWM_CALLS_PER_MINUTE = settings.owm_calls_per_minute
+OWM_CALLS_PER_DAY = settings.owm_calls_per_day
+
+governor = RequestGovernor(OWM_CALLS_PER_MINUTE, OWM_CALLS_PER_DAY)
+breaker = CircuitBreaker(
+    window=settings.owm_breaker_window,
+    min_calls=settings.owm_breaker_min_calls,
+    error_threshold=settings.owm_breaker_error_rate,
+    open_seconds=settings.owm_breaker_open_seconds,
+)
+
+# Бюджет времени на один вызов OWM с учетом всех повторов (секунды)
+REQUEST_BUDGETS = {
+    PRIORITY_INTERACTIVE: settings.owm_budget_interactive,
+    PRIORITY_INLINE: settings.owm_budget_interactive,
+    PRIORITY_NOTIFICATION: settings.owm_budget_background,
+    PRIORITY_PREFETCH: settings.owm_budget_background,
+}
+REQUEST_TIMEOUT = 15  # Максимальный таймаут одной попытки
+RETRY_BASE_DELAY = 1.0  # Верхняя граница первой паузы; паузы случайны в [0, граница]
+RETRYABLE_OUTCOMES = frozenset({'rate_limited', 'server_error', 'timeout', 'network_error'})
+
+# Дублирующие запросы: второй запрос, если первый не ответил за p95 задержки
+HEDGE_ENABLED = settings.owm_hedge
+HEDGE_DEFAULT_DELAY = 1.0  # Пока статистики мало
+HEDGE_MIN_DELAY = 0.2
+HEDGE_MIN_SAMPLES = 20
+
+# Сколько городов OWM принимает в одном запросе /data/2.5/group
+GROUP_MAX_IDS = 20
+# Ответ /group описывает центр города: он сохраняется только в ячейки не дальше этого расстояния
+GROUP_RADIUS_KM = settings.owm_group_radius_km
+
+# Сколько ждать части после deadline: запрос, не успевший к сроку, еще отдает устаревшие данные из кэша
+BUNDLE_COLLECT_GRACE = 0.25
+
+# Части, которые умеет получать fetch_bundle
+PART_GEOCODE = 'geocode'
+PART_CURRENT = 'current'
+PART_FORECAST = 'forecast'
+PART_AIR = 'air'
+# Какой эндпоинт кэша дает данные для каждой части
+PART_ENDPOINTS = {PART_CURRENT: 'weather', PART_FORECAST: 'forecast', PART_AIR: 'air_pollution'}
 
 # Словарь для перевода описаний погоды на русский
 WEATHER_DESCRIPTIONS = {
@@ -65,103 +148,401 @@ WEATHER_DESCRIPTIONS = {
 }
 
 
+def cell_coords(lat: float, lon: float) -> tuple[float, float]:
+    """Округляет координаты до ячейки местоположения."""
+    return round(lat, CELL_PRECISION), round(lon, CELL_PRECISION)
+
+def location_cell(lat: float, lon: float) -> str:
+    """Возвращает идентификатор ячейки местоположения."""
+    lat, lon = cell_coords(lat, lon)
+    return f"{lat:.{CELL_PRECISION}f},{lon:.{CELL_PRECISION}f}"
+
+def get_cache_store():
+    """Возвращает хранилище кэша, открывая его при первом обращении."""
+    global _cache_store
+    if _cache_store is None:
+        with _lazy_lock:
+            if _cache_store is None:
+                _cache_store = create_cache_store(CACHE_BACKEND, CACHE_DIR, compress=CACHE_COMPRESS)
+    return _cache_store
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Общий пул потоков для запросов к OWM."""
+    global _executor
+    if _executor is None:
+        with _lazy_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.owm_pool_size, thread_name_prefix="owm")
+    return _executor
+
+def _get_bundle_executor() -> ThreadPoolExecutor:
+    """Пул для частей fetch_bundle. Отдельный, чтобы части, ожидающие дублирующие
+    запросы в общем пуле, не занимали его потоки."""
+    global _bundle_executor
+    if _bundle_executor is None:
+        with _lazy_lock:
+            if _bundle_executor is None:
+                _bundle_executor = ThreadPoolExecutor(
+                    max_workers=settings.owm_bundle_pool_size, thread_name_prefix="owm-bundle"
+                )
+    return _bundle_executor
+
+def add_cache_listener(listener):
+    """Подписывает функцию listener(endpoint, record, previous) на обновления записей кэша.
+    previous — предыдущая запись той же ячейки или None. Повторная подписка ничего не меняет."""
+    if listener not in _cache_listeners:
+        _cache_listeners.append(listener)
+
 def get_cache_key(lat: float, lon: float, endpoint: str) -> str:
-    """Создает ключ кэша на основе координат и эндпоинта."""
-    key_str = f"{lat:.4f},{lon:.4f},{endpoint}"
-    return hashlib.md5(key_str.encode()).hexdigest()
-
-def get_cache_path(lat: float, lon: float, endpoint: str) -> Path:
-    """Возвращает путь к файлу кэша."""
-    cache_key = get_cache_key(lat, lon, endpoint)
-    return CACHE_DIR / f"{cache_key}.json"
-
-def get_from_cache(lat: float, lon: float, endpoint: str) -> Optional[dict]:
-    """Получает данные из кэша, если они не устарели."""
-    cache_path = get_cache_path(lat, lon, endpoint)
-    if not cache_path.exists():
-        return None
-    
-    try:
-        with open(cache_path, 'r', encoding='utf-8') as f:
-            cached_data = json.load(f)
-        
-        # Проверяем, не устарел ли кэш
-        if time.time() - cached_data.get('timestamp', 0) < CACHE_TTL:
-            return cached_data.get('data')
-        else:
-            # Удаляем устаревший кэш
-            cache_path.unlink()
+    """Создает ключ кэша на основе координат, эндпоинта и версии схемы записей."""
+    return f"{lat:.4f},{lon:.4f},{endpoint}:v{SCHEMA_VERSION}"
+
+def _memory_get(key: str, max_age: Optional[float]) -> Optional[dict]:
+    """Ищет уже разобранные данные в памяти. max_age=None — в пределах срока жизни записи."""
+    with _memory_lock:
+        entry = _memory_cache.get(key)
+        if entry is None or time.time() - entry[0] >= (entry[1] if max_age is None else max_age):
             return None
-    except Exception:
+        _memory_cache.move_to_end(key)
+        return entry[2]
+
+def _memory_put(key: str, timestamp: float, ttl: float, data):
+    """Кладет разобранные данные в память, вытесняя самые давние записи."""
+    with _memory_lock:
+        _memory_cache[key] = (timestamp, ttl, data)
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > CACHE_MEMORY_ENTRIES:
+            _memory_cache.popitem(last=False)
+
+def _key_endpoint(key: str) -> Optional[str]:
+    """Эндпоинт из ключа кэша записей; None для ключей геокодирования."""
+    if key.startswith('geo:'):
         return None
+    return key.rsplit(',', 1)[1].split(':', 1)[0]
+
+def memory_snapshot() -> list:
+    """Возвращает записи из памяти для снимка: [[ключ, время записи, строка], ...],
+    начиная с самых востребованных."""
+    with _memory_lock:
+        items = list(_memory_cache.items())
+    entries = []
+    for key, (timestamp, _, data) in reversed(items):
+        endpoint = _key_endpoint(key)
+        try:
+            row = list(data) if endpoint is None else to_row(endpoint, data)
+        except (KeyError, TypeError):
+            continue
+        entries.append([key, timestamp, row])
+    return entries
+
+def memory_restore(entries: list) -> list:
+    """Восстанавливает записи снимка в память, отбрасывая истекшие за время простоя
+    и записи другой версии схемы. Возвращает восстановленные записи погоды."""
+    now = time.time()
+    suffix = f":v{SCHEMA_VERSION}"
+    restored = []
+    # Снимок начинается с самых востребованных; в LRU они должны оказаться последними
+    for key, timestamp, row in reversed(entries[:CACHE_MEMORY_ENTRIES]):
+        endpoint = _key_endpoint(key)
+        if endpoint is not None and not key.endswith(suffix):
+            continue
+        try:
+            data = tuple(row) if endpoint is None else from_row(endpoint, row)
+        except (KeyError, TypeError, ValueError):
+            continue
+        ttl = GEOCODE_TTL if endpoint is None else record_ttl(endpoint, data, timestamp)
+        if now - timestamp >= ttl:
+            continue
+        _memory_put(key, timestamp, ttl, data)
+        if endpoint is not None:
+            restored.append(data)
+    return restored
 
-def save_to_cache(lat: float, lon: float, endpoint: str, data: dict):
-    """Сохраняет данные в кэш."""
-    cache_path = get_cache_path(lat, lon, endpoint)
+def get_from_cache(lat: float, lon: float, endpoint: str, max_age: Optional[float] = None):
+    """Получает данные из кэша, если они не старше max_age секунд,
+    а без max_age — если не истек срок свежести записи (services/cache_expiry.py).
+    Сначала проверяется память, затем хранилище (проверка по индексу без чтения данных).
+    Возвращает запись из services.projection.
+    Устаревшие данные хранятся до CACHE_STALE_TTL для ответа при недоступности OWM."""
+    data, source = _lookup(get_cache_key(lat, lon, endpoint), endpoint, max_age)
+    if data is None:
+        metrics.counter(f"cache.miss.{endpoint}").inc()
+    else:
+        metrics.counter(f"cache.hit.{endpoint}.{source}").inc()
+    return data
+
+def _lookup(key: str, endpoint: str, max_age: Optional[float]) -> tuple:
+    """Ищет запись в памяти, затем в хранилище. Возвращает (запись или None, memory|store)."""
+    with span('cache.memory', endpoint=endpoint) as current:
+        data = _memory_get(key, max_age)
+        current.set('hit', data is not None)
+    if data is not None:
+        return data, 'memory'
+    
+    with span('cache.store', endpoint=endpoint) as current:
+        try:
+            entry = get_cache_store().get(key, max_age)
+            if entry is None:
+                current.set('hit', False)
+                return None, None
+            timestamp, data = entry[0], from_row(endpoint, entry[1])
+        except Exception:
+            current.set('hit', False)
+            return None, None
+        current.set('hit', True)
+    
+    _memory_put(key, timestamp, record_ttl(endpoint, data, timestamp), data)
+    return data, 'store'
+
+def save_to_cache(lat: float, lon: float, endpoint: str, record):
+    """Сохраняет запись в кэш со сроком свежести по времени данных и оповещает
+    подписчиков об обновлении. Повторные запросы, вернувшие те же данные,
+    учитываются в счетчиках cache.refetch.identical.<эндпоинт> и сохраняют
+    версию предыдущей записи (ее fetched_at): готовые тексты и file_id графика
+    по этой версии остаются действительными, а свежесть отсчитывается от нового получения.
+    Возвращает сохраненную запись."""
+    key = get_cache_key(lat, lon, endpoint)
+    previous = _lookup(key, endpoint, CACHE_STALE_TTL)[0]
+    timestamp = record.fetched_at
+    ttl = record_ttl(endpoint, record)
+    if previous is not None:
+        identical = same_data(previous, record)
+        metrics.counter(f"cache.refetch.{'identical' if identical else 'changed'}.{endpoint}").inc()
+        if identical:
+            record = previous
+    _memory_put(key, timestamp, ttl, record)
+    with span('cache.write', endpoint=endpoint, ttl=round(ttl)):
+        try:
+            get_cache_store().put(key, to_row(endpoint, record), timestamp, ttl)
+        except Exception:
+            pass  # Игнорируем ошибки кэширования
+    
+    for listener in _cache_listeners:
+        try:
+            listener(endpoint, record, previous)
+        except Exception:
+            continue  # Ошибка подписчика не должна мешать кэшированию
+    return record
+
+def get_cell_record(cell: str, endpoint: str):
+    """Возвращает последнюю запись ячейки из кэша (в том числе устаревшую) без запроса к OWM."""
+    lat, lon = (float(value) for value in cell.split(','))
+    return _lookup(get_cache_key(lat, lon, endpoint), endpoint, CACHE_STALE_TTL)[0]
+
+def start_cache_compactor():
+    """Запускает фоновое удаление записей кэша, срок жизни которых истек более CACHE_STALE_TTL назад."""
+    global _compactor
+    if _compactor is None:
+        _compactor = CacheCompactor(get_cache_store(), CACHE_STALE_TTL, CACHE_COMPACT_INTERVAL)
+    _compactor.start()
+
+def get_stale_from_cache(lat: float, lon: float, endpoint: str):
+    """Возвращает устаревшие данные из кэша, когда свежие получить нельзя."""
+    stale = get_from_cache(lat, lon, endpoint, max_age=CACHE_STALE_TTL)
+    if stale is not None:
+        metrics.counter(f"cache.stale_served.{endpoint}").inc()
+    return stale
+
+def _single_flight(key: str, fetch, deadline: Optional[float] = None):
+    """Выполняет fetch() один раз для одновременных вызовов с одинаковым ключом.
+    Остальные вызывающие ждут результат первого (не дольше deadline) и получают его же;
+    по истечении срока возвращается None."""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+    
+    if not leader:
+        metrics.counter('owm.coalesced').inc()
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        with span('owm.coalesced_wait'):
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeoutError:
+                return None
+    
+    metrics.counter('owm.single_flight').inc()
     try:
-        with open(cache_path, 'w', encoding='utf-8') as f:
-            json.dump({
-                'timestamp': time.time(),
-                'data': data
-            }, f, ensure_ascii=False)
-    except Exception:
-        pass  # Игнорируем ошибки кэширования
+        result = fetch()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
 
 def translate_weather_description(description: str) -> str:
     """Переводит описание погоды на русский язык."""
     desc_lower = description.lower()
     return WEATHER_DESCRIPTIONS.get(desc_lower, description)
 
-def request_with_retries(url: str, max_retries: int = 3) -> Optional[requests.Response]:
-    """HTTP GET с ретраями при 429/5xx и экспоненциальной паузой (1s, 2s, 4s).
+def _localize_weather(data: dict):
+    """Локализует описание погоды, если API вернул английский."""
+    if 'weather' in data and len(data['weather']) > 0:
+        desc = data['weather'][0].get('description', '')
+        if desc:
+            data['weather'][0]['description'] = translate_weather_description(desc)
+
+def _attempt(url: str, timeout: float) -> tuple[str, Optional['requests.Response']]:
+    """Выполняет одну попытку запроса и записывает ее исход.
+    Возвращает (исход, ответ); исход — ok, client_error, rate_limited,
+    server_error, timeout или network_error."""
+    import requests
+    start = time.perf_counter()
+    resp = None
+    try:
+        with span('owm.http') as current:
+            resp = requests.get(url, timeout=timeout)
+            current.set('status', resp.status_code)
+        if resp.status_code == 429:
+            outcome = 'rate_limited'
+            governor.penalize()
+        elif 400 <= resp.status_code < 500:
+            outcome = 'client_error'
+        elif 500 <= resp.status_code < 600:
+            outcome = 'server_error'
+        else:
+            outcome = 'ok'
+    except requests.exceptions.Timeout:
+        outcome = 'timeout'
+    except requests.exceptions.RequestException:
+        outcome = 'network_error'
+    except Exception:
+        # Любая другая ошибка — тоже неудачная попытка, а не исключение для вызывающего
+        outcome = 'network_error'
+    
+    # Клиентские ошибки (кроме 429) не говорят о неисправности OWM
+    breaker.record(outcome in ('ok', 'client_error'))
+    metrics.latency('owm.attempt').observe(time.perf_counter() - start, error=outcome != 'ok')
+    metrics.counter(f"owm.attempt.{outcome}").inc()
+    return outcome, resp
+
+def _hedge_delay() -> float:
+    """Задержка перед дублирующим запросом: p95 задержки попыток или значение по умолчанию."""
+    stats = metrics.latency('owm.attempt')
+    if stats.count < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, stats.percentile(0.95) or HEDGE_DEFAULT_DELAY)
+
+def _hedged_attempt(url: str, timeout: float, priority: int, deadline: float) -> tuple[str, Optional['requests.Response']]:
+    """Попытка с дублированием: если первый запрос не ответил за p95,
+    отправляется второй, и используется первый успешный ответ."""
+    executor = _get_executor()
+    first = executor.submit(run_in_context(_attempt), url, timeout)
+    delay = _hedge_delay()
+    try:
+        return first.result(timeout=delay)
+    except FutureTimeoutError:
+        pass
+    
+    remaining = deadline - time.monotonic()
+    pending = [first]
+    # Дублируем, только если второй запрос успеет ответить и квота позволяет
+    if remaining > delay and breaker.allow():
+        if governor.acquire(priority, max_wait=0):
+            metrics.counter('owm.hedged').inc()
+            pending.append(executor.submit(run_in_context(_attempt), url, min(timeout, remaining)))
+        else:
+            breaker.release_probe()
+    
+    result = ('deadline', None)
+    try:
+        for future in as_completed(pending, timeout=max(0.0, remaining)):
+            result = future.result()
+            if result[0] not in RETRYABLE_OUTCOMES:
+                return result
+    except FutureTimeoutError:
+        pass
+    return result
+
+def request_with_retries(url: str, max_retries: int = 3, priority: int = PRIORITY_INTERACTIVE,
+                         deadline: Optional[float] = None) -> Optional['requests.Response']:
+    """HTTP GET с ретраями при 429/5xx и сетевых ошибках в пределах бюджета времени.
+    deadline — момент time.monotonic(), к которому запрос должен завершиться
+    (по умолчанию — бюджет приоритета из REQUEST_BUDGETS). Паузы между попытками —
+    экспоненциальные со случайным разбросом и никогда не выходят за deadline.
+    Каждая попытка проходит через автоматический выключатель и регулятор квоты.
     Возвращает None при ошибках вместо исключений."""
-    delay_seconds = 1
-    last_exc: Optional[BaseException] = None
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_BUDGETS[priority]
+    delay_seconds = RETRY_BASE_DELAY
+    gave_up = 'owm.retries_exhausted'
     for attempt in range(1, max_retries + 1):
-        try:
-            resp = requests.get(url, timeout=15)
-            # 4xx ошибки - клиентские ошибки, не ретраим
-            if 400 <= resp.status_code < 500:
-                return None
-            # 429 и 5xx - серверные ошибки, ретраим
-            if resp.status_code == 429 or 500 <= resp.status_code < 600:
-                if attempt < max_retries:
-                    time.sleep(delay_seconds)
-                    delay_seconds *= 2
-                    continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            gave_up = 'owm.deadline_exceeded'
+            break
+        if not breaker.allow():
+            metrics.counter('owm.breaker.rejected').inc()
+            return None
+        with span('owm.quota_wait'):
+            if not governor.acquire(priority, max_wait=min(PRIORITY_MAX_WAIT[priority], remaining)):
+                # Запрос отброшен до обращения к OWM: пробный вызов выключателя не израсходован
+                breaker.release_probe()
                 return None
+        
+        timeout = min(REQUEST_TIMEOUT, max(0.1, deadline - time.monotonic()))
+        with span('owm.attempt', attempt=attempt) as current:
+            if HEDGE_ENABLED:
+                outcome, resp = _hedged_attempt(url, timeout, priority, deadline)
+            else:
+                outcome, resp = _attempt(url, timeout)
+            current.set('outcome', outcome)
+        
+        if outcome == 'ok':
             return resp
-        except requests.exceptions.RequestException as exc:
-            last_exc = exc
-            if attempt < max_retries:
-                time.sleep(delay_seconds)
-                delay_seconds *= 2
-                continue
-        except Exception as exc:
-            last_exc = exc
-            if attempt < max_retries:
-                time.sleep(delay_seconds)
-                delay_seconds *= 2
-                continue
+        # 4xx ошибки - клиентские ошибки, не ретраим
+        if outcome not in RETRYABLE_OUTCOMES:
+            return None
+        
+        # 429, 5xx и сетевые ошибки - ретраим, если пауза укладывается в бюджет
+        if attempt < max_retries:
+            pause = random.uniform(0, delay_seconds)
+            if time.monotonic() + pause >= deadline:
+                gave_up = 'owm.deadline_exceeded'
+                break
+            with span('owm.backoff'):
+                time.sleep(pause)
+            delay_seconds *= 2
+    
+    metrics.counter(gave_up).inc()
     # После всех ретраев возвращаем None вместо исключения
     return None
 
-def get_current_weather(lat: float, lon: float) -> Optional[dict]:
+@traced('get.current_weather')
+def get_current_weather(lat: float, lon: float, priority: int = PRIORITY_INTERACTIVE,
+                        deadline: Optional[float] = None) -> Optional[WeatherRecord]:
     """Возвращает текущую погоду по координатам через /data/2.5/weather.
+    Одновременные запросы одной ячейки выполняются одним обращением к OWM.
+    Если OWM недоступен или квота исчерпана, возвращает устаревшие данные из кэша.
     Возвращает None при ошибках вместо исключений."""
     if not OW_API_KEY:
         return None
     
+    lat, lon = cell_coords(lat, lon)
+    
     # Проверяем кэш
     cached = get_from_cache(lat, lon, 'weather')
     if cached:
         return cached
     
+    record = _single_flight(get_cache_key(lat, lon, 'weather'),
+                            lambda: _fetch_current_weather(lat, lon, priority, deadline), deadline)
+    if record is None:
+        return get_stale_from_cache(lat, lon, 'weather')
+    return record
+
+def _fetch_current_weather(lat: float, lon: float, priority: int, deadline: Optional[float]) -> Optional[WeatherRecord]:
+    """Запрашивает текущую погоду у OWM и сохраняет запись в кэш."""
     url = (
         f"https://api.openweathermap.org/data/2.5/weather?"
         f"lat={lat}&lon={lon}&appid={OW_API_KEY}&units=metric&lang=ru"
     )
-    response = request_with_retries(url)
+    response = request_with_retries(url, priority=priority, deadline=deadline)
     if response is None:
         return None
     
@@ -171,57 +552,193 @@ def get_current_weather(lat: float, lon: float) -> Optional[dict]:
             # Проверяем, что ответ не пустой
             if not data or 'main' not in data:
                 return None
-            # Локализуем описание погоды, если API вернул английский
-            if 'weather' in data and len(data['weather']) > 0:
-                desc = data['weather'][0].get('description', '')
-                if desc:
-                    translated = translate_weather_description(desc)
-                    data['weather'][0]['description'] = translated
-            # Сохраняем в кэш
-            save_to_cache(lat, lon, 'weather', data)
-            return data
-        except (json.JSONDecodeError, KeyError, ValueError):
+            _localize_weather(data)
+            # Оставляем только используемые поля и сохраняем в кэш
+            record = project_weather(data, location_cell(lat, lon), time.time())
+            return save_to_cache(lat, lon, 'weather', record)
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
             return None
     
     return None
 
-def get_coordinates(city: str) -> Optional[tuple[float, float]]:
+def _distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Приблизительное расстояние между двумя точками в километрах (для малых расстояний)."""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371.0 * math.hypot(x, y)
+
+def prefetch_current_weather(locations: list, priority: int = PRIORITY_NOTIFICATION,
+                             deadline: Optional[float] = None) -> int:
+    """Заполняет кэш текущей погоды для нескольких мест пакетными запросами
+    /data/2.5/group (до GROUP_MAX_IDS городов за запрос).
+    locations — список (lat, lon, city_id); места без city_id и со свежим кэшем пропускаются.
+    Ответ по городу (погода в его центре) сохраняется в ячейки мест с этим city_id,
+    которые лежат не дальше GROUP_RADIUS_KM от центра; последующие get_current_weather()
+    для них берут данные из кэша, а более далекие ячейки запрашиваются отдельно.
+    Все пакеты укладываются в один deadline (по умолчанию — бюджет приоритета).
+    Возвращает количество заполненных ячеек."""
+    if not OW_API_KEY:
+        return 0
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_BUDGETS[priority]
+    
+    cells_by_city = {}  # {city_id: {(lat, lon) ячейки, ...}}
+    for lat, lon, city_id in locations:
+        if not city_id:
+            continue
+        lat, lon = cell_coords(lat, lon)
+        if get_from_cache(lat, lon, 'weather') is not None:
+            continue
+        cells_by_city.setdefault(city_id, set()).add((lat, lon))
+    
+    city_ids = list(cells_by_city)
+    filled = 0
+    for start in range(0, len(city_ids), GROUP_MAX_IDS):
+        if time.monotonic() >= deadline:
+            metrics.counter('owm.deadline_exceeded').inc()
+            break
+        chunk = city_ids[start:start + GROUP_MAX_IDS]
+        url = (
+            f"https://api.openweathermap.org/data/2.5/group?"
+            f"id={','.join(str(city_id) for city_id in chunk)}&appid={OW_API_KEY}&units=metric&lang=ru"
+        )
+        response = request_with_retries(url, priority=priority, deadline=deadline)
+        if response is None or response.status_code != 200:
+            continue
+        try:
+            items = response.json().get('list', [])
+        except (json.JSONDecodeError, AttributeError, ValueError):
+            continue
+        
+        fetched_at = time.time()
+        for data in items:
+            try:
+                if 'main' not in data:
+                    continue
+                center = data.get('coord') or {}
+                if 'lat' not in center or 'lon' not in center:
+                    continue  # Неизвестно, где находится город: ячейки запросятся отдельно
+                _localize_weather(data)
+                for lat, lon in cells_by_city.get(data.get('id'), ()):
+                    if _distance_km(lat, lon, center['lat'], center['lon']) > GROUP_RADIUS_KM:
+                        metrics.counter('owm.group.too_far').inc()
+                        continue
+                    save_to_cache(lat, lon, 'weather', project_weather(data, location_cell(lat, lon), fetched_at))
+                    filled += 1
+            except (KeyError, TypeError, ValueError):
+                continue
+        metrics.counter('owm.group.requests').inc()
+        metrics.counter('owm.group.cities').inc(len(chunk))
+    return filled
+
+def get_coordinates(city: str, priority: int = PRIORITY_INTERACTIVE,
+                    deadline: Optional[float] = None) -> Optional[tuple[float, float]]:
     """Возвращает (lat, lon) для города через OpenWeather Geocoding API.
+    Найденные координаты кэшируются на GEOCODE_TTL.
     Возвращает None при ошибках или пустом ответе вместо исключений."""
+    return resolve_city(city, priority, deadline)[0]
+
+@traced('get.coordinates')
+def resolve_city(city: str, priority: int = PRIORITY_INTERACTIVE,
+                 deadline: Optional[float] = None) -> tuple[Optional[tuple[float, float]], bool]:
+    """Как get_coordinates, но отличает отсутствие города от сбоя.
+    Возвращает (координаты или None, not_found): not_found равно True, только если
+    OWM ответил, что такого города нет; при таймауте и ошибках — False."""
     if not city or not city.strip():
-        return None
+        return None, True
     
+    key = f"geo:{city.strip().lower()}"
+    coords, source = _lookup_coordinates(key)
+    if coords is not None:
+        metrics.counter(f"cache.hit.geocode.{source}").inc()
+        return coords, False
+    metrics.counter('cache.miss.geocode').inc()
+    
+    result = _single_flight(key, lambda: _fetch_coordinates(city, priority, deadline), deadline)
+    if result is None:
+        return None, False  # Не дождались ответа первого запроса
+    coords, not_found = result
+    if coords is not None:
+        timestamp = time.time()
+        _memory_put(key, timestamp, GEOCODE_TTL, coords)
+        try:
+            get_cache_store().put(key, list(coords), timestamp, GEOCODE_TTL)
+        except Exception:
+            pass  # Игнорируем ошибки кэширования
+    return coords, not_found
+
+def _lookup_coordinates(key: str) -> tuple:
+    """Ищет координаты города в памяти, затем в хранилище. Возвращает (координаты или None, memory|store)."""
+    coords = _memory_get(key, GEOCODE_TTL)
+    if coords is not None:
+        return coords, 'memory'
+    try:
+        entry = get_cache_store().get(key, GEOCODE_TTL)
+    except Exception:
+        entry = None
+    if entry is None:
+        return None, None
+    coords = tuple(entry[1])
+    _memory_put(key, entry[0], GEOCODE_TTL, coords)
+    return coords, 'store'
+
+def _fetch_coordinates(city: str, priority: int, deadline: Optional[float]) -> tuple[Optional[tuple[float, float]], bool]:
+    """Запрашивает координаты города у OWM. Возвращает (координаты или None, город не найден)."""
     url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={OW_API_KEY}"
-    response = request_with_retries(url)
+    response = request_with_retries(url, priority=priority, deadline=deadline)
     if response is None:
-        return None
+        return None, False
     
     if response.status_code == 200:
         try:
             data = response.json()
-            # Проверяем, что ответ не пустой
+            # Пустой ответ — OWM не знает такого города
             if not data or len(data) == 0:
-                return None
+                return None, True
             if 'lat' not in data[0] or 'lon' not in data[0]:
-                return None
+                return None, True
             lat = data[0]["lat"]
             lon = data[0]["lon"]
-            return lat, lon
+            return (lat, lon), False
         except (json.JSONDecodeError, KeyError, IndexError, ValueError):
-            return None
+            return None, False
     
-    return None
+    return None, False
+
+def get_cell_forecast(cell: str, cached_first: bool = True) -> Optional[ForecastRecord]:
+    """Прогноз ячейки для навигации по кнопкам: из кэша (с cached_first — в том числе устаревший),
+    а если его там нет — из OWM. Возвращает None при ошибках."""
+    if cached_first:
+        record = get_cell_record(cell, 'forecast')
+        if record is not None:
+            return record
+    lat, lon = (float(value) for value in cell.split(','))
+    return get_forecast_5d3h(lat, lon)
 
-def get_forecast_5d3h(lat: float, lon: float) -> Optional[dict]:
+@traced('get.forecast')
+def get_forecast_5d3h(lat: float, lon: float, priority: int = PRIORITY_INTERACTIVE,
+                      deadline: Optional[float] = None) -> Optional[ForecastRecord]:
     """Возвращает прогноз погоды на 5 дней с шагом 3 часа.
+    Одновременные запросы одной ячейки выполняются одним обращением к OWM.
+    Если OWM недоступен или квота исчерпана, возвращает устаревшие данные из кэша.
     Возвращает None при ошибках вместо исключений."""
+    lat, lon = cell_coords(lat, lon)
+    
     # Проверяем кэш
     cached = get_from_cache(lat, lon, 'forecast')
     if cached:
         return cached
     
+    record = _single_flight(get_cache_key(lat, lon, 'forecast'),
+                            lambda: _fetch_forecast(lat, lon, priority, deadline), deadline)
+    if record is None:
+        return get_stale_from_cache(lat, lon, 'forecast')
+    return record
+
+def _fetch_forecast(lat: float, lon: float, priority: int, deadline: Optional[float]) -> Optional[ForecastRecord]:
+    """Запрашивает прогноз у OWM и сохраняет запись в кэш."""
     url = f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={OW_API_KEY}&units=metric&lang=ru"
-    response = request_with_retries(url)
+    response = request_with_retries(url, priority=priority, deadline=deadline)
     if response is None:
         return None
     
@@ -238,24 +755,38 @@ def get_forecast_5d3h(lat: float, lon: float) -> Optional[dict]:
                         desc = item['weather'][0].get('description', '')
                         if desc and desc.lower() in WEATHER_DESCRIPTIONS:
                             item['weather'][0]['description'] = translate_weather_description(desc)
-            # Сохраняем в кэш
-            save_to_cache(lat, lon, 'forecast', data)
-            return data
-        except (json.JSONDecodeError, KeyError, ValueError):
+            # Оставляем только используемые поля и сохраняем в кэш
+            record = project_forecast(data, location_cell(lat, lon), time.time())
+            return save_to_cache(lat, lon, 'forecast', record)
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
             return None
     
     return None
 
-def get_air_pollution(lat: float, lon: float) -> Optional[dict]:
+@traced('get.air_pollution')
+def get_air_pollution(lat: float, lon: float, priority: int = PRIORITY_INTERACTIVE,
+                      deadline: Optional[float] = None) -> Optional[AirRecord]:
     """Возвращает загрязнение воздуха по координатам через /data/2.5/air_pollution.
+    Одновременные запросы одной ячейки выполняются одним обращением к OWM.
+    Если OWM недоступен или квота исчерпана, возвращает устаревшие данные из кэша.
     Возвращает None при ошибках вместо исключений."""
+    lat, lon = cell_coords(lat, lon)
+    
     # Проверяем кэш
     cached = get_from_cache(lat, lon, 'air_pollution')
     if cached:
         return cached
     
+    record = _single_flight(get_cache_key(lat, lon, 'air_pollution'),
+                            lambda: _fetch_air_pollution(lat, lon, priority, deadline), deadline)
+    if record is None:
+        return get_stale_from_cache(lat, lon, 'air_pollution')
+    return record
+
+def _fetch_air_pollution(lat: float, lon: float, priority: int, deadline: Optional[float]) -> Optional[AirRecord]:
+    """Запрашивает загрязнение воздуха у OWM и сохраняет запись в кэш."""
     url = f"https://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={OW_API_KEY}"
-    response = request_with_retries(url)
+    response = request_with_retries(url, priority=priority, deadline=deadline)
     if response is None:
         return None
     
@@ -268,14 +799,131 @@ def get_air_pollution(lat: float, lon: float) -> Optional[dict]:
             components = data['list'][0].get('components')
             if not components:
                 return None
-            # Сохраняем в кэш
-            save_to_cache(lat, lon, 'air_pollution', components)
-            return components
+            # Оставляем только анализируемые загрязнители и сохраняем в кэш
+            record = project_air(components, location_cell(lat, lon), time.time(), data['list'][0].get('dt', 0))
+            return save_to_cache(lat, lon, 'air_pollution', record)
         except (json.JSONDecodeError, KeyError, IndexError, ValueError):
             return None
     
     return None
 
+class Bundle(NamedTuple):
+    """Результат fetch_bundle для одного местоположения.
+    Части, которые не запрошены или не получены к сроку, равны None.
+    Если coords равны None, а not_found — False, координаты не получены из-за
+    таймаута или ошибки, а не потому, что города нет."""
+    location: object  # Название города или (lat, lon), как передано в fetch_bundle
+    coords: Optional[tuple]
+    current: Optional[WeatherRecord]
+    forecast: Optional[ForecastRecord]
+    air: Optional[AirRecord]
+    not_found: bool = False  # OWM ответил, что такого города нет
+
+
+# {часть: функция (lat, lon, priority, deadline) -> запись}
+_PART_FETCHERS = {
+    PART_CURRENT: get_current_weather,
+    PART_FORECAST: get_forecast_5d3h,
+    PART_AIR: get_air_pollution,
+}
+
+
+def _collect(futures: dict, results: dict, deadline: float) -> bool:
+    """Собирает результаты задач, завершившихся до deadline, в results.
+    Возвращает False, если часть задач не успела."""
+    timeout = max(0.0, deadline + BUNDLE_COLLECT_GRACE - time.monotonic())
+    done, not_done = wait(futures.values(), timeout=timeout)
+    for key, future in futures.items():
+        if future in done:
+            try:
+                results[key] = future.result()
+            except Exception:
+                results[key] = None
+        else:
+            future.cancel()
+    return not not_done
+
+@traced('get.bundle')
+def fetch_bundle(locations: list, parts: tuple, priority: int = PRIORITY_INTERACTIVE,
+                 deadline: Optional[float] = None) -> list[Bundle]:
+    """Получает части parts (PART_CURRENT, PART_FORECAST, PART_AIR) для нескольких
+    местоположений параллельно. Местоположение — название города (сначала
+    определяются координаты, PART_GEOCODE) или (lat, lon).
+    Все запросы укладываются в один deadline (по умолчанию — бюджет приоритета);
+    не успевшие части возвращаются как None. Порядок результатов совпадает с locations."""
+    start = time.perf_counter()
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_BUDGETS[priority]
+    
+    # Сначала координаты для названий городов: от них зависят остальные части
+    coords = {}
+    not_found = set()
+    geocode_jobs = {}
+    for i, location in enumerate(locations):
+        if isinstance(location, str):
+            geocode_jobs[i] = _get_bundle_executor().submit(run_in_context(resolve_city), location, priority, deadline)
+        else:
+            coords[i] = location
+    resolved = {}
+    complete = _collect(geocode_jobs, resolved, deadline) if geocode_jobs else True
+    for i, result in resolved.items():
+        # Упавшая задача дает None, не успевшая к сроку — отсутствует в resolved
+        coords[i], city_not_found = result or (None, False)
+        if city_not_found:
+            not_found.add(i)
+    
+    jobs = {}
+    for i in range(len(locations)):
+        if coords.get(i) is None:
+            continue
+        lat, lon = coords[i]
+        for part in parts:
+            if part in _PART_FETCHERS:
+                jobs[(i, part)] = _get_bundle_executor().submit(
+                    run_in_context(_PART_FETCHERS[part]), lat, lon, priority, deadline
+                )
+    results = {}
+    if jobs:
+        complete = _collect(jobs, results, deadline) and complete
+    
+    if not complete:
+        metrics.counter('bundle.partial').inc()
+    metrics.latency('bundle').observe(time.perf_counter() - start, error=not complete)
+    return [
+        Bundle(
+            location=location,
+            coords=coords.get(i),
+            current=results.get((i, PART_CURRENT)),
+            forecast=results.get((i, PART_FORECAST)),
+            air=results.get((i, PART_AIR)),
+            not_found=i in not_found,
+        )
+        for i, location in enumerate(locations)
+    ]
+
+def cached_bundle(locations: list, parts: tuple) -> list[Bundle]:
+    """Собирает результат как fetch_bundle, но только из кэша (в том числе устаревшего),
+    без запросов к OWM. Используется, когда запрос не допущен из-за перегрузки."""
+    bundles = []
+    for location in locations:
+        if isinstance(location, str):
+            coords = _lookup_coordinates(f"geo:{location.strip().lower()}")[0] if location.strip() else None
+        else:
+            coords = location
+        records = {}
+        if coords is not None:
+            cell = location_cell(*coords)
+            records = {part: get_cell_record(cell, PART_ENDPOINTS[part]) for part in parts if part in PART_ENDPOINTS}
+        bundles.append(Bundle(
+            location=location,
+            coords=coords,
+            current=records.get(PART_CURRENT),
+            forecast=records.get(PART_FORECAST),
+            air=records.get(PART_AIR),
+        ))
+    return bundles
+
+
 # Константы для анализа качества воздуха
 AIR_QUALITY_LEVELS = {
     1: {'name': 'Good', 'name_ru': 'Хорошо', 'ranges': {'so2': (0, 20), 'no2': (0, 40), 'pm10': (0, 20), 'pm2_5': (0, 10), 'o3': (0, 60), 'co': (0, 4400)}},
@@ -360,5 +1008,5 @@ def format_air_pollution_report(result: dict) -> str:
 if __name__ == "__main__":
     res = get_coordinates('Москва')
     air_pollution = get_air_pollution(res[0], res[1])
-    result = analyze_air_pollution(air_pollution, extended=True)
-    print(format_air_pollution_report(result))
\ No newline at end of file
+    result = analyze_air_pollution(air_components(air_pollution), extended=True)
+    print(format_air_pollution_report(result))
@@ -0,0 +1,110 @@
+"""События обновления данных о погоде.
+
+Когда запись кэша ячейки обновляется, она сравнивается с предыдущей версией.
+Если наблюдаемые значения изменились, структурированная разница публикуется
+подписчикам; если нет — событие не создается и никакой работы не выполняется.
+Подписчики вызываются в отдельном потоке, чтобы не задерживать запрос,
+который обновил кэш.
+"""
+
+import queue
+import threading
+from typing import NamedTuple, Optional
+from services.projection import POLLUTANT_FIELDS
+from services.weather_api import add_cache_listener
+from utils.metrics import metrics
+
+
+# Поля текущей погоды, изменение которых считается изменением данных
+WEATHER_FIELDS = ('temp', 'feels_like', 'humidity', 'pressure', 'wind_speed', 'description', 'clouds')
+
+
+class WeatherDiff(NamedTuple):
+    """Разница между двумя версиями записи одной ячейки."""
+    endpoint: str
+    cell: str
+    record: object
+    previous: Optional[object]  # None, если предыдущей версии нет
+    changed_fields: tuple  # Изменившиеся поля (для прогноза — 'items')
+    temp_delta: Optional[float]  # Изменение текущей температуры (только weather)
+    new_rain_windows: tuple  # dt интервалов прогноза, в которых дождь появился в этой версии
+
+
+def _rain_windows(forecast) -> frozenset:
+    """dt интервалов прогноза с дождем, моросью или грозой (из сводок по дням)."""
+    if forecast is None:
+        return frozenset()
+    return frozenset(dt for day in forecast.days for dt in day.rain_windows)
+
+
+def compute_diff(endpoint: str, record, previous) -> Optional[WeatherDiff]:
+    """Сравнивает новую версию записи с предыдущей.
+    Возвращает None, если наблюдаемые значения не изменились."""
+    temp_delta = None
+    new_rain_windows = ()
+    if endpoint == 'weather':
+        fields = WEATHER_FIELDS
+    elif endpoint == 'air_pollution':
+        fields = POLLUTANT_FIELDS
+    elif endpoint == 'forecast':
+        fields = ('items',)
+    else:
+        return None
+
+    if previous is None:
+        changed = fields
+    else:
+        changed = tuple(field for field in fields if getattr(record, field) != getattr(previous, field))
+    if not changed:
+        return None
+
+    if endpoint == 'weather' and previous is not None:
+        temp_delta = record.temp - previous.temp
+    if endpoint == 'forecast':
+        new_rain_windows = tuple(sorted(_rain_windows(record) - _rain_windows(previous)))
+
+    return WeatherDiff(endpoint, record.cell, record, previous, changed, temp_delta, new_rain_windows)
+
+
+_handlers = []  # Функции handler(diff)
+_events = queue.Queue()
+_worker_thread = None
+
+
+def subscribe(handler):
+    """Подписывает функцию handler(diff) на изменения данных."""
+    _handlers.append(handler)
+
+
+def _on_cache_update(endpoint: str, record, previous):
+    """Слушатель кэша: публикует разницу, если данные изменились."""
+    if not _handlers:
+        return
+    diff = compute_diff(endpoint, record, previous)
+    if diff is None:
+        metrics.counter(f"events.unchanged.{endpoint}").inc()
+        return
+    metrics.counter(f"events.published.{endpoint}").inc()
+    _events.put(diff)
+
+
+def _worker_loop():
+    """Доставляет события подписчикам."""
+    while True:
+        diff = _events.get()
+        for handler in _handlers:
+            try:
+                handler(diff)
+            except Exception:
+                continue  # Ошибка подписчика не должна останавливать доставку
+
+
+def start_event_worker():
+    """Подписывается на обновления кэша и запускает поток доставки событий.
+    До запуска события не публикуются."""
+    global _worker_thread
+    add_cache_listener(_on_cache_update)
+    if _worker_thread is not None and _worker_thread.is_alive():
+        return
+    _worker_thread = threading.Thread(target=_worker_loop, daemon=True)
+    _worker_thread.start()
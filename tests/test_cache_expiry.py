@@ -0,0 +1,79 @@
+"""Тесты срока свежести записей кэша (services/cache_expiry.py)."""
+
+import pytest
+
+from services.cache_expiry import POLICIES, next_change, record_ttl, same_data
+from services.projection import AirRecord, ForecastItem, ForecastRecord, WeatherRecord
+
+
+CELL = '55.76,37.62'
+
+
+def weather(dt, fetched_at):
+    return WeatherRecord(
+        CELL, fetched_at, 524901, 'Moscow', dt, 5.0, 2.0, 80, 1012, 3.0, 200,
+        'облачно', 90, 10000, 0, 0, 804,
+    )
+
+
+def air(dt, fetched_at):
+    return AirRecord(CELL, fetched_at, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, dt)
+
+
+def forecast(dts, fetched_at):
+    items = tuple(ForecastItem(dt, 5.0, 2.0, 80, 1012, 3.0, 'Clouds', 'облачно', 0.0) for dt in dts)
+    return ForecastRecord(CELL, fetched_at, 'Moscow', items, 0, ())
+
+
+def test_weather_next_change_follows_data_time():
+    # Данные от 1000, получены через 100 сек: следующее обновление — через период от времени данных
+    assert next_change('weather', weather(1000, 1100)) == 1600
+    # Получены, когда уже должен был выйти следующий ответ: ждем еще одного периода
+    assert next_change('weather', weather(1000, 1700)) == 2200
+
+
+def test_next_change_without_data_time_counts_from_fetch():
+    assert next_change('air_pollution', air(0, 5000)) == 5000 + POLICIES['air_pollution'].cadence
+
+
+def test_forecast_next_change_is_next_interval():
+    record = forecast((900, 1800, 2700), 1000)
+    assert next_change('forecast', record) == 1800
+    assert next_change('forecast', record, fetched_at=2000) == 2700
+    # Все интервалы в прошлом
+    assert next_change('forecast', record, fetched_at=3000) == 3000 + POLICIES['forecast'].cadence
+
+
+def test_record_ttl_within_bounds():
+    policy = POLICIES['weather']
+    ttl = record_ttl('weather', weather(1000, 1000 + 600 - policy.floor - 50))
+    assert ttl == policy.floor + 50
+
+
+def test_record_ttl_floor():
+    # До обновления OWM осталось несколько секунд: срок не меньше нижней границы
+    assert record_ttl('weather', weather(1000, 1595)) == POLICIES['weather'].floor
+
+
+def test_record_ttl_ceiling():
+    # Ближайший интервал прогноза далеко: срок не больше верхней границы
+    policy = POLICIES['forecast']
+    record = forecast((1000 + policy.ceiling * 2,), 1000)
+    assert record_ttl('forecast', record) == policy.ceiling
+
+
+def test_record_ttl_uses_given_fetch_time():
+    record = weather(1000, 1100)
+    assert record_ttl('weather', record, fetched_at=1100) == record_ttl('weather', record)
+    assert record_ttl('weather', record, fetched_at=1500) < record_ttl('weather', record)
+
+
+@pytest.mark.parametrize('endpoint, make', [('weather', weather), ('air_pollution', air)])
+def test_same_data_ignores_fetch_time(endpoint, make):
+    assert same_data(make(1000, 1100), make(1000, 1700))
+    assert not same_data(make(1000, 1100), make(1600, 1700))
+
+
+def test_same_data_forecast_items():
+    assert same_data(forecast((1800, 2700), 1000), forecast((1800, 2700), 2000))
+    assert not same_data(forecast((1800, 2700), 1000), forecast((2700, 3600), 2000))
@@ -0,0 +1,74 @@
+"""Тесты кодирования callback_data навигации по прогнозу (keyboards/inline.py)."""
+
+from datetime import date
+
+import pytest
+
+from keyboards.inline import (
+    forecast_callback, parse_forecast_callback, FORECAST_CALLBACK_PREFIXES,
+    FORECAST_DAY, FORECAST_BACK, FORECAST_LIST, FORECAST_CHART,
+)
+from services.weather_api import location_cell
+
+
+CELL = location_cell(55.7558, 37.6173)
+
+
+@pytest.mark.parametrize('index', [0, 1, 4])
+def test_day_round_trip(index):
+    first_day = date(2026, 10, 19)
+    data = forecast_callback(FORECAST_DAY, CELL, first_day, index)
+    assert parse_forecast_callback(data) == (FORECAST_DAY, CELL, date(2026, 10, 19 + index))
+
+
+@pytest.mark.parametrize('kind', [FORECAST_BACK, FORECAST_LIST, FORECAST_CHART])
+def test_cell_round_trip(kind):
+    assert parse_forecast_callback(forecast_callback(kind, CELL)) == (kind, CELL, None)
+
+
+@pytest.mark.parametrize('kind', [FORECAST_DAY, FORECAST_BACK, FORECAST_LIST, FORECAST_CHART])
+def test_callback_matches_registered_prefix(kind):
+    data = forecast_callback(kind, CELL, date(2026, 10, 19), 0)
+    assert data.startswith(FORECAST_CALLBACK_PREFIXES)
+
+
+def test_callback_fits_telegram_limit():
+    # Самая длинная ячейка: отрицательные координаты с тремя цифрами в целой части долготы
+    cell = location_cell(-89.99, -179.99)
+    data = forecast_callback(FORECAST_DAY, cell, date(9999, 12, 31), 0)
+    assert len(data.encode()) <= 64
+    assert parse_forecast_callback(data) == (FORECAST_DAY, cell, date(9999, 12, 31))
+
+
+def test_day_past_max_date_is_rejected():
+    data = forecast_callback(FORECAST_DAY, CELL, date(9999, 12, 31), 4)
+    assert parse_forecast_callback(data) is None
+
+
+def test_cell_is_normalized():
+    data = forecast_callback(FORECAST_BACK, '55.7558000,37.6173')
+    assert parse_forecast_callback(data) == (FORECAST_BACK, CELL, None)
+
+
+@pytest.mark.parametrize('data', [
+    None,
+    '',
+    'fd1',
+    'fb1:',
+    'fb2:55.76,37.62',  # Другая версия формата
+    'fx1:55.76,37.62',  # Неизвестный вид
+    'fb1:55.76',
+    'fb1:abc,37.62',
+    'fb1:95.00,37.62',  # Широта вне диапазона
+    'fb1:55.76,190.00',  # Долгота вне диапазона
+    'fb1:nan,37.62',
+    'fb1:55.76,37.62:extra',
+    'fd1:55.76,37.62',  # День без даты и номера
+    'fd1:55.76,37.62:fuog',
+    'fd1:55.76,37.62:!!:0',
+    'fd1:55.76,37.62:fuog:x',
+    'fd1:55.76,37.62:zzzzzzzzzzzz:0',  # Дата вне диапазона
+    'fd1:55.76,37.62:fuog:0:1',
+])
+def test_malformed_input(data):
+    assert parse_forecast_callback(data) is None
@@ -0,0 +1,137 @@
+"""Тесты автоматического выключателя и квот регулятора запросов OWM."""
+
+import threading
+
+import pytest
+
+from services import governor
+from services.governor import CircuitBreaker, RequestGovernor, PRIORITY_INTERACTIVE, PRIORITY_PREFETCH
+
+
+class FakeClock:
+    """Подменяет time.monotonic в модуле регулятора."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(governor.time, 'monotonic', fake.monotonic)
+    monkeypatch.setattr(governor.time, 'sleep', fake.sleep)
+    return fake
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_breaker_stays_closed_below_min_calls(clock):
+    breaker = CircuitBreaker(window=10, min_calls=5, error_threshold=0.5)
+    for _ in range(4):
+        breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_opens_on_error_rate(clock):
+    breaker = CircuitBreaker(window=10, min_calls=4, error_threshold=0.5)
+    breaker.record(True)
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_allows_single_probe(clock):
+    breaker = CircuitBreaker(window=4, min_calls=2, open_seconds=30)
+    open_breaker(breaker)
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_probe_success_closes(clock):
+    breaker = CircuitBreaker(window=4, min_calls=2, open_seconds=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_probe_failure_reopens(clock):
+    breaker = CircuitBreaker(window=4, min_calls=2, open_seconds=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_released_probe_can_be_retaken(clock):
+    breaker = CircuitBreaker(window=4, min_calls=2, open_seconds=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.release_probe()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+
+def test_breaker_probe_released_only_by_owner(clock):
+    breaker = CircuitBreaker(window=4, min_calls=2, open_seconds=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    other = threading.Thread(target=breaker.release_probe)
+    other.start()
+    other.join()
+    assert not breaker.allow()
+
+
+def test_breaker_lost_probe_expires(clock):
+    breaker = CircuitBreaker(window=4, min_calls=2, open_seconds=30, probe_timeout=10)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    clock.now += 9
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_governor_refunds_minute_token_when_daily_quota_is_spent(clock):
+    regulator = RequestGovernor(calls_per_minute=60, calls_per_day=2)
+    assert regulator.acquire(PRIORITY_INTERACTIVE)
+    assert regulator.acquire(PRIORITY_INTERACTIVE)
+    tokens = regulator.bucket.available()
+    assert not regulator.acquire(PRIORITY_INTERACTIVE)
+    assert regulator.bucket.available() == tokens
+    assert regulator.remaining_today() == 0
+
+
+def test_governor_keeps_reserve_from_low_priority(clock):
+    regulator = RequestGovernor(calls_per_minute=10, calls_per_day=1000)
+    granted = 0
+    while regulator.acquire(PRIORITY_PREFETCH):
+        granted += 1
+    assert granted == 5
+    assert regulator.acquire(PRIORITY_INTERACTIVE, max_wait=0)
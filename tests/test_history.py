@@ -0,0 +1,109 @@
+"""Тесты истории наблюдений по ячейкам (services/history.py)."""
+
+import pytest
+
+from services.history import HistoryStore, Observation
+
+
+CELL = '55.76,37.62'
+DAY = 86400
+RETENTION = 2 * DAY
+
+
+def observation(at, temp=10.0, condition_id=800):
+    return Observation(at, temp, 1000.0, 50, 2.0, condition_id)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(tmp_path, RETENTION)
+
+
+def test_append_keeps_time_order(store):
+    assert store.append(CELL, observation(100))
+    assert store.append(CELL, observation(200))
+    assert not store.append(CELL, observation(200))
+    assert not store.append(CELL, observation(150))
+    assert [item.at for item in store.range(CELL, 0, 1000)] == [100, 200]
+
+
+def test_range_is_half_open(store):
+    for at in (100, 200, 300, 400):
+        store.append(CELL, observation(at))
+    assert [item.at for item in store.range(CELL, 200, 400)] == [200, 300]
+    assert store.range(CELL, 500, 600) == []
+    assert store.range('0.00,0.00', 0, 1000) == []
+
+
+def test_nearest_within_tolerance(store):
+    for at in (1000, 2000, 3000):
+        store.append(CELL, observation(at, temp=at / 100))
+    assert store.nearest(CELL, 1400).at == 1000
+    assert store.nearest(CELL, 1600).at == 2000
+    assert store.nearest(CELL, 0, tolerance=1000).at == 1000
+    assert store.nearest(CELL, 9000, tolerance=1000) is None
+    assert store.nearest('0.00,0.00', 1000) is None
+
+
+def test_downsample_averages_buckets(store):
+    store.append(CELL, observation(0, temp=10, condition_id=500))
+    store.append(CELL, observation(600, temp=20, condition_id=800))
+    store.append(CELL, observation(1200, temp=30, condition_id=500))
+    store.append(CELL, observation(7200, temp=5, condition_id=600))
+    buckets = store.downsample(CELL, 0, 10800, 3600)
+    assert [bucket.at for bucket in buckets] == [0, 7200]  # Интервал без наблюдений пропущен
+    assert buckets[0].temp == pytest.approx(20)
+    assert buckets[0].condition_id == 500
+    assert buckets[1].temp == pytest.approx(5)
+
+
+def test_flush_and_reload(tmp_path, store):
+    for at in (100, 200):
+        store.append(CELL, observation(at, temp=at / 10))
+    assert store.flush() == 1
+    store.append(CELL, observation(300, temp=30))
+    assert store.flush() == 1
+    assert store.flush() == 0
+
+    reloaded = HistoryStore(tmp_path, RETENTION)
+    assert reloaded.range(CELL, 0, 1000) == store.range(CELL, 0, 1000)
+
+
+def test_reload_drops_partial_record(tmp_path, store):
+    store.append(CELL, observation(100))
+    store.flush()
+    with open(tmp_path / f"{CELL}.bin", 'ab') as f:
+        f.write(b'\x00\x01\x02')
+    assert [item.at for item in HistoryStore(tmp_path, RETENTION).range(CELL, 0, 1000)] == [100]
+
+
+def test_expire_after_extra_day(tmp_path, store):
+    store.append(CELL, observation(0))
+    store.append(CELL, observation(DAY + 10))
+    store.flush()
+    # Старое наблюдение вышло за срок хранения, но лишнего еще меньше суток
+    store.append(CELL, observation(RETENTION + DAY))
+    assert store.range(CELL, 0, 10 * DAY)[0].at == 0
+    # Лишнего набралось больше суток: ряд обрезается, а файл переписывается
+    store.append(CELL, observation(RETENTION + DAY + 1))
+    assert [item.at for item in store.range(CELL, 0, 10 * DAY)] == [DAY + 10, RETENTION + DAY, RETENTION + DAY + 1]
+    store.flush()
+    reloaded = HistoryStore(tmp_path, RETENTION)
+    assert [item.at for item in reloaded.range(CELL, 0, 10 * DAY)] == [DAY + 10, RETENTION + DAY, RETENTION + DAY + 1]
+
+
+def test_failed_write_is_retried_from_memory(tmp_path, store, monkeypatch):
+    store.append(CELL, observation(100))
+    calls = []
+
+    def failing_write(cell, blob, rewrite):
+        calls.append(rewrite)
+        raise OSError('disk full')
+
+    monkeypatch.setattr(store, '_write', failing_write)
+    assert store.flush() == 0
+    assert calls == [False]
+    monkeypatch.undo()
+    store.append(CELL, observation(200))
+    assert store.flush() == 1
+    assert [item.at for item in HistoryStore(tmp_path, RETENTION).range(CELL, 0, 1000)] == [100, 200]
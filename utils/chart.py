@@ -0,0 +1,207 @@
+"""График прогноза на 5 дней в PNG без внешних зависимостей.
+
+Изображение рисуется в памяти (RGB-растр в bytearray) и кодируется в PNG
+стандартными zlib и struct: кривая температуры, столбцы вероятности осадков
+и границы дней по местному времени города. График строится один раз
+для версии прогноза ячейки и хранится в кэше рендеринга как байты PNG.
+После первой отправки Telegram возвращает file_id загруженного фото — он
+тоже хранится в кэше рендеринга (вместо байтов PNG), и дальше фото
+отправляется по file_id без повторной загрузки. При обновлении прогноза
+значения его прежней версии удаляются.
+"""
+
+import struct
+import zlib
+from typing import Optional
+from services.projection import ForecastRecord, local_date
+from utils.render_cache import cached_render, render_cache
+
+
+WIDTH = 800
+HEIGHT = 400
+MARGIN_LEFT = 56
+MARGIN_RIGHT = 48
+MARGIN_TOP = 24
+MARGIN_BOTTOM = 40
+
+BACKGROUND = (255, 255, 255)
+GRID = (225, 225, 225)
+AXIS = (120, 120, 120)
+TEMP = (220, 60, 40)
+RAIN = (110, 160, 230)
+TEXT = (60, 60, 60)
+
+# Шрифт 3x5 для подписей осей: строки глифа сверху вниз, '1' — закрашенный пиксель
+FONT = {
+    '0': ('111', '101', '101', '101', '111'),
+    '1': ('010', '110', '010', '010', '111'),
+    '2': ('111', '001', '111', '100', '111'),
+    '3': ('111', '001', '111', '001', '111'),
+    '4': ('101', '101', '111', '001', '001'),
+    '5': ('111', '100', '111', '001', '111'),
+    '6': ('111', '100', '111', '101', '111'),
+    '7': ('111', '001', '010', '010', '010'),
+    '8': ('111', '101', '111', '101', '111'),
+    '9': ('111', '101', '111', '001', '111'),
+    '-': ('000', '000', '111', '000', '000'),
+    '.': ('000', '000', '000', '000', '010'),
+    '%': ('101', '001', '010', '100', '101'),
+    '°': ('111', '101', '111', '000', '000'),
+    ' ': ('000', '000', '000', '000', '000'),
+}
+
+
+class Canvas:
+    """RGB-растр с простыми операциями рисования."""
+
+    def __init__(self, width: int, height: int, background: tuple):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(bytes(background) * (width * height))
+
+    def rect(self, x0: int, y0: int, x1: int, y1: int, color: tuple):
+        """Закрашивает прямоугольник [x0, x1) x [y0, y1), обрезая его по границам."""
+        x0, x1 = max(0, min(x0, x1)), min(self.width, max(x0, x1))
+        y0, y1 = max(0, min(y0, y1)), min(self.height, max(y0, y1))
+        if x0 >= x1:
+            return
+        row = bytes(color) * (x1 - x0)
+        for y in range(y0, y1):
+            start = (y * self.width + x0) * 3
+            self.pixels[start:start + len(row)] = row
+
+    def line(self, x0: int, y0: int, x1: int, y1: int, color: tuple, width: int = 1):
+        """Рисует отрезок алгоритмом Брезенхема кистью width x width."""
+        half = width // 2
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        error = dx + dy
+        while True:
+            self.rect(x0 - half, y0 - half, x0 - half + width, y0 - half + width, color)
+            if x0 == x1 and y0 == y1:
+                return
+            doubled = 2 * error
+            if doubled >= dy:
+                error += dy
+                x0 += sx
+            if doubled <= dx:
+                error += dx
+                y0 += sy
+
+    def text(self, x: int, y: int, text: str, color: tuple, scale: int = 2):
+        """Пишет текст шрифтом FONT; неизвестные символы пропускаются."""
+        for char in text:
+            glyph = FONT.get(char)
+            if glyph is None:
+                continue
+            for row, bits in enumerate(glyph):
+                for column, bit in enumerate(bits):
+                    if bit == '1':
+                        self.rect(x + column * scale, y + row * scale,
+                                  x + (column + 1) * scale, y + (row + 1) * scale, color)
+            x += 4 * scale
+
+    def png(self) -> bytes:
+        """Кодирует растр в PNG (8 бит на канал, RGB, без фильтров строк)."""
+        stride = self.width * 3
+        raw = b''.join(
+            b'\x00' + bytes(self.pixels[y * stride:(y + 1) * stride]) for y in range(self.height)
+        )
+
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+        header = struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0)
+        return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+                + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+
+def text_width(text: str, scale: int = 2) -> int:
+    return len(text) * 4 * scale - scale
+
+
+@cached_render('chart', lambda forecast_data: (forecast_data.cell, forecast_data.fetched_at))
+def render_forecast_chart(forecast_data: ForecastRecord) -> bytes:
+    """Рисует график прогноза: температура (линия, шкала слева) и вероятность
+    осадков (столбцы, шкала справа). Возвращает байты PNG."""
+    canvas = Canvas(WIDTH, HEIGHT, BACKGROUND)
+    items = forecast_data.items
+    left, right = MARGIN_LEFT, WIDTH - MARGIN_RIGHT
+    top, bottom = MARGIN_TOP, HEIGHT - MARGIN_BOTTOM
+    if not items:
+        return canvas.png()
+
+    low = min(item.temp for item in items)
+    high = max(item.temp for item in items)
+    # Шкала температуры с шагом 5 градусов и запасом сверху и снизу
+    low, high = (int(low // 5) - 1) * 5, (int(high // 5) + 1) * 5
+    first, last = items[0].dt, items[-1].dt
+    span = max(last - first, 1)
+    slot = (right - left) / len(items)
+
+    def x_at(timestamp: float) -> int:
+        return round(left + slot / 2 + (timestamp - first) / span * (right - left - slot))
+
+    def y_at(temp: float) -> int:
+        return round(bottom - (temp - low) / (high - low) * (bottom - top))
+
+    # Сетка и подписи температуры
+    for temp in range(low, high + 1, 5):
+        y = y_at(temp)
+        canvas.rect(left, y, right, y + 1, AXIS if temp == 0 else GRID)
+        label = f"{temp}°"
+        canvas.text(left - 8 - text_width(label), y - 5, label, TEXT)
+    for percent in (0, 50, 100):
+        y = round(bottom - percent / 100 * (bottom - top))
+        canvas.text(right + 8, y - 5, f"{percent}%", RAIN)
+
+    # Вероятность осадков
+    bar = max(int(slot) - 4, 2)
+    for item in items:
+        if item.pop > 0:
+            x = x_at(item.dt)
+            canvas.rect(x - bar // 2, round(bottom - item.pop * (bottom - top)), x - bar // 2 + bar, bottom, RAIN)
+
+    # Границы и подписи дней по местному времени города
+    starts = []  # [(x начала дня, дата)]
+    for item in items:
+        day = local_date(item.dt, forecast_data.timezone)
+        if not starts or starts[-1][1] != day:
+            starts.append((max(x_at(item.dt) - round(slot / 2), left), day))
+    for index, (x, day) in enumerate(starts):
+        if index:
+            canvas.rect(x, top, x + 1, bottom, GRID)
+        label = day.strftime('%d.%m')
+        end = starts[index + 1][0] if index + 1 < len(starts) else right
+        # Короткий неполный день остается без подписи, чтобы она не налезала на следующую
+        if end - x >= text_width(label) + 8:
+            canvas.text(x + 4, bottom + 12, label, TEXT)
+
+    # Кривая температуры
+    points = [(x_at(item.dt), y_at(item.temp)) for item in items]
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        canvas.line(x0, y0, x1, y1, TEMP, width=3)
+
+    canvas.rect(left, top, left + 1, bottom + 1, AXIS)
+    canvas.rect(left, bottom, right, bottom + 1, AXIS)
+    return canvas.png()
+
+
+def chart_file_id(forecast_data: ForecastRecord) -> Optional[str]:
+    """file_id графика этой версии прогноза, уже загруженного в Telegram, или None."""
+    return render_cache.get('chart_file_id', (forecast_data.cell, forecast_data.fetched_at))
+
+
+def remember_chart_file_id(forecast_data: ForecastRecord, file_id: str):
+    """Запоминает file_id загруженного графика для повторных отправок.
+    Байты PNG после этого больше не нужны и удаляются из кэша."""
+    key = (forecast_data.cell, forecast_data.fetched_at)
+    render_cache.put('chart_file_id', key, file_id)
+    render_cache.discard('chart', key)
+
+
+def forget_chart_file_id(forecast_data: ForecastRecord, file_id: str):
+    """Забывает file_id, который Telegram больше не принимает; график будет загружен заново."""
+    key = (forecast_data.cell, forecast_data.fetched_at)
+    if render_cache.get('chart_file_id', key) == file_id:
+        render_cache.discard('chart_file_id', key)
@@ -1,85 +1,109 @@
 """Функции форматирования сообщений."""
 
+import math
 from datetime import datetime
-from collections import defaultdict
-from services.weather_api import get_air_pollution, analyze_air_pollution, format_air_pollution_report
+from typing import Optional
+from services.weather_api import analyze_air_pollution, format_air_pollution_report
+from services.history import temp_change, pressure_trend
+from services.projection import (
+    WeatherRecord, ForecastRecord, AirRecord, air_components, day_items, local_time
+)
 from utils.icons import get_weather_icon
+from utils.render_cache import cached_render
 
 
-def format_current_weather(weather_data: dict, city_name: str = None) -> str:
+@cached_render('current', lambda weather_data, city_name=None: (weather_data.cell, weather_data.fetched_at, city_name))
+def format_current_weather(weather_data: WeatherRecord, city_name: str = None) -> str:
     """Форматирует текущую погоду для отображения."""
-    temp = weather_data['main']['temp']
-    feels_like = weather_data['main']['feels_like']
-    humidity = weather_data['main']['humidity']
-    pressure = weather_data['main']['pressure']
-    wind_speed = weather_data.get('wind', {}).get('speed', 0)
-    wind_deg = weather_data.get('wind', {}).get('deg', 0)
-    description = weather_data['weather'][0]['description'].capitalize()
-    city = city_name or weather_data.get('name', 'Неизвестно')
+    temp = weather_data.temp
+    feels_like = weather_data.feels_like
+    humidity = weather_data.humidity
+    pressure = weather_data.pressure
+    wind_speed = weather_data.wind_speed
+    wind_deg = weather_data.wind_deg
+    description = weather_data.description.capitalize()
+    city = city_name or weather_data.name or 'Неизвестно'
     
     wind_direction = ""
     if wind_deg:
         directions = ["С", "СВ", "В", "ЮВ", "Ю", "ЮЗ", "З", "СЗ"]
         wind_direction = directions[int((wind_deg + 22.5) / 45) % 8]
     
-    text = f"🌤️ Погода в {city}\n\n"
-    text += f"🌡️ Температура: {temp}°C (ощущается как {feels_like}°C)\n"
-    text += f"☁️ {description}\n"
-    text += f"💧 Влажность: {humidity}%\n"
-    text += f"🌬️ Ветер: {wind_speed} м/с {wind_direction}\n"
-    text += f"📊 Давление: {pressure} гПа\n"
-    
-    return text
+    return (
+        f"🌤️ Погода в {city}\n\n"
+        f"🌡️ Температура: {temp}°C (ощущается как {feels_like}°C)\n"
+        f"☁️ {description}\n"
+        f"💧 Влажность: {humidity}%\n"
+        f"🌬️ Ветер: {wind_speed} м/с {wind_direction}\n"
+        f"📊 Давление: {pressure} гПа\n"
+    )
 
 
-def format_extended_weather(weather_data: dict, city_name: str = None, lat: float = None, lon: float = None) -> str:
-    """Форматирует расширенные данные о погоде."""
-    text = format_current_weather(weather_data, city_name)
+@cached_render('extended', lambda weather_data, city_name=None, air_pollution=None: (
+    weather_data.cell, weather_data.fetched_at, city_name,
+    air_pollution.fetched_at if air_pollution is not None else None
+))
+def format_extended_weather(weather_data: WeatherRecord, city_name: str = None,
+                            air_pollution: Optional[AirRecord] = None) -> str:
+    """Форматирует расширенные данные о погоде из уже полученных записей.
+    Если air_pollution равен None, вместо анализа воздуха выводится предупреждение."""
+    parts = [format_current_weather(weather_data, city_name)]
     
     # Дополнительные данные из текущей погоды
-    cloudiness = weather_data.get('clouds', {}).get('all', 0)
-    visibility = weather_data.get('visibility', 0) / 1000 if weather_data.get('visibility') else None
+    cloudiness = weather_data.clouds
+    visibility = weather_data.visibility / 1000 if weather_data.visibility else None
     
     # Восход и закат
-    sunrise = datetime.fromtimestamp(weather_data['sys']['sunrise'])
-    sunset = datetime.fromtimestamp(weather_data['sys']['sunset'])
+    sunrise = datetime.fromtimestamp(weather_data.sunrise)
+    sunset = datetime.fromtimestamp(weather_data.sunset)
     
-    text += f"\n📈 Расширенные данные:\n"
-    text += f"☁️ Облачность: {cloudiness}%\n"
+    parts.append(f"\n📈 Расширенные данные:\n")
+    parts.append(f"☁️ Облачность: {cloudiness}%\n")
     if visibility:
-        text += f"👁️ Видимость: {visibility} км\n"
-    text += f"🌅 Восход солнца: {sunrise.strftime('%H:%M')}\n"
-    text += f"🌇 Закат солнца: {sunset.strftime('%H:%M')}\n"
+        parts.append(f"👁️ Видимость: {visibility} км\n")
+    parts.append(f"🌅 Восход солнца: {sunrise.strftime('%H:%M')}\n")
+    parts.append(f"🌇 Закат солнца: {sunset.strftime('%H:%M')}\n")
+    parts.append(format_trends(weather_data))
     
     # Загрязнение воздуха
-    if lat and lon:
-        air_pollution = get_air_pollution(lat, lon)
-        if air_pollution is not None:
-            try:
-                air_analysis = analyze_air_pollution(air_pollution, extended=True)
-                text += f"\n{format_air_pollution_report(air_analysis)}"
-            except Exception:
-                text += f"\n⚠️ Данные о загрязнении воздуха недоступны\n"
-        else:
-            text += f"\n⚠️ Данные о загрязнении воздуха недоступны\n"
+    if air_pollution is not None:
+        try:
+            air_analysis = analyze_air_pollution(air_components(air_pollution), extended=True)
+            parts.append(f"\n{format_air_pollution_report(air_analysis)}")
+        except Exception:
+            parts.append(f"\n⚠️ Данные о загрязнении воздуха недоступны\n")
+    else:
+        parts.append(f"\n⚠️ Данные о загрязнении воздуха недоступны\n")
     
-    return text
+    return ''.join(parts)
 
 
-def format_forecast_5days(forecast_data: dict) -> tuple[str, dict]:
-    """Форматирует прогноз на 5 дней и возвращает текст и данные по дням."""
-    list_data = forecast_data['list']
-    city_name = forecast_data['city']['name']
+def format_trends(weather_data: WeatherRecord) -> str:
+    """Форматирует тенденции по истории наблюдений ячейки: температура и давление за сутки.
+    Если истории за сутки нет, возвращает пустую строку."""
+    parts = []
     
-    # Группируем по дням
-    days_data = defaultdict(list)
-    for item in list_data:
-        dt = datetime.fromtimestamp(item['dt'])
-        day_key = dt.date()
-        days_data[day_key].append(item)
+    change = temp_change(weather_data)
+    if change is not None:
+        if abs(change) < 1:
+            parts.append("🌡️ Температура примерно как вчера\n")
+        else:
+            parts.append(f"🌡️ На {abs(change):.1f}°C {'теплее' if change > 0 else 'холоднее'}, чем вчера\n")
+    
+    trend = pressure_trend(weather_data)
+    if trend is not None:
+        direction = 'стабильно' if abs(trend) < 3 else ('растет' if trend > 0 else 'падает')
+        parts.append(f"📊 Давление за сутки: {trend:+.0f} гПа ({direction})\n")
     
-    # Сортируем дни
-    sorted_days = sorted(days_data.keys())[:5]
+    return ''.join(parts)
+
+
+@cached_render('forecast', lambda forecast_data: (forecast_data.cell, forecast_data.fetched_at))
+def format_forecast_5days(forecast_data: ForecastRecord) -> tuple[str, dict]:
+    """Форматирует прогноз на 5 дней и возвращает текст и данные по дням.
+    Дни и сводки по ним (по местному времени города) уже посчитаны при получении прогноза.
+    Результат общий для всех пользователей ячейки и не должен изменяться."""
+    city_name = forecast_data.city_name
     
     # Простое сообщение без детального текста
     text = f"📅 Прогноз погоды на 5 дней в {city_name}\n\nВыберите день для подробного прогноза:"
@@ -87,79 +111,71 @@ def format_forecast_5days(forecast_data: dict) -> tuple[str, dict]:
     day_details = {}
     day_names = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
     
-    for day in sorted_days:
-        day_items = days_data[day]
-        day_name = day_names[day.weekday()]
-        date_str = day.strftime('%d.%m')
-        
-        # Берем средние значения за день
-        temps = [item['main']['temp'] for item in day_items]
-        feels_like_temps = [item['main']['feels_like'] for item in day_items]
-        min_temp = min(temps)
-        max_temp = max(temps)
-        avg_temp = sum(temps) / len(temps)
-        avg_feels_like = sum(feels_like_temps) / len(feels_like_temps)
-        
-        # Основное описание (берем дневное значение) для иконки
-        main_weather = day_items[len(day_items)//2]['weather'][0]['main']
-        weather_icon = get_weather_icon(main_weather)
+    for summary in forecast_data.days[:5]:
+        day = datetime.strptime(summary.date, '%Y-%m-%d').date()
         
         day_details[day] = {
-            'name': day_name,
-            'date': date_str,
-            'items': day_items,
-            'min_temp': min_temp,
-            'max_temp': max_temp,
-            'avg_temp': avg_temp,
-            'avg_feels_like': avg_feels_like,
-            'weather_icon': weather_icon
+            'name': day_names[day.weekday()],
+            'date': day.strftime('%d.%m'),
+            'items': day_items(forecast_data, summary),
+            'timezone': forecast_data.timezone,
+            'min_temp': summary.min_temp,
+            'max_temp': summary.max_temp,
+            'avg_temp': summary.avg_temp,
+            'avg_feels_like': summary.avg_feels_like,
+            # Иконка по преобладающему за день состоянию погоды
+            'weather_icon': get_weather_icon(summary.main),
+            'version': (forecast_data.cell, forecast_data.fetched_at)
         }
     
     return text, day_details
 
 
+@cached_render('day', lambda day_data, day_key: day_data['version'] + (day_key,) if 'version' in day_data else None)
 def format_day_details(day_data: dict, day_key: datetime.date) -> str:
     """Форматирует детальную информацию о дне."""
     day_name = day_data['name']
     date_str = day_data['date']
     items = day_data['items']
     
-    text = f"📆 {day_name}, {date_str}\n\n"
+    parts = [f"📆 {day_name}, {date_str}\n\n"]
     
     for item in items:
-        dt = datetime.fromtimestamp(item['dt'])
-        time_str = dt.strftime('%H:%M')
-        temp = item['main']['temp']
-        feels_like = item['main']['feels_like']
-        humidity = item['main']['humidity']
-        pressure = item['main']['pressure']
-        wind_speed = item.get('wind', {}).get('speed', 0)
-        description = item['weather'][0]['description'].capitalize()
+        # Время по местному времени города
+        time_str = local_time(item.dt, day_data.get('timezone', 0)).strftime('%H:%M')
+        temp = item.temp
+        feels_like = item.feels_like
+        humidity = item.humidity
+        pressure = item.pressure
+        wind_speed = item.wind_speed
+        description = item.description.capitalize()
         
-        text += f"🕐 {time_str}\n"
-        text += f"   🌡️ {temp}°C (ощущается как {feels_like}°C)\n"
-        text += f"   ☁️ {description}\n"
-        text += f"   💧 Влажность: {humidity}%\n"
-        text += f"   🌬️ Ветер: {wind_speed} м/с\n"
-        text += f"   📊 Давление: {pressure} гПа\n\n"
+        parts.append(
+            f"🕐 {time_str}\n"
+            f"   🌡️ {temp}°C (ощущается как {feels_like}°C)\n"
+            f"   ☁️ {description}\n"
+            f"   💧 Влажность: {humidity}%\n"
+            f"   🌬️ Ветер: {wind_speed} м/с\n"
+            f"   📊 Давление: {pressure} гПа\n\n"
+        )
     
-    return text
+    return ''.join(parts)
 
 
-def format_cities_comparison(city1: str, weather1: dict, city2: str, weather2: dict) -> str:
+def format_cities_comparison(city1: str, weather1: WeatherRecord, city2: str, weather2: WeatherRecord) -> str:
     """Форматирует сравнение двух городов в текстовом виде построчно."""
-    temp1 = weather1['main']['temp']
-    temp2 = weather2['main']['temp']
-    feels1 = weather1['main']['feels_like']
-    feels2 = weather2['main']['feels_like']
-    humidity1 = weather1['main']['humidity']
-    humidity2 = weather2['main']['humidity']
-    wind1 = weather1.get('wind', {}).get('speed', 0)
-    wind2 = weather2.get('wind', {}).get('speed', 0)
-    pressure1 = weather1['main']['pressure']
-    pressure2 = weather2['main']['pressure']
-    desc1 = weather1['weather'][0]['description'].capitalize()
-    desc2 = weather2['weather'][0]['description'].capitalize()
+    temp1 = weather1.temp
+    temp2 = weather2.temp
+    feels1 = weather1.feels_like
+    feels2 = weather2.feels_like
+    humidity1 = weather1.humidity
+    humidity2 = weather2.humidity
+    wind1 = weather1.wind_speed
+    wind2 = weather2.wind_speed
+    pressure1 = weather1.pressure
+    pressure2 = weather2.pressure
+    desc1 = weather1.description.capitalize()
+    desc2 = weather2.description.capitalize()
     
     text = f"📊 Сравнение городов\n\n"
     text += f"🏙️ {city1} vs {city2}\n\n"
@@ -199,3 +215,104 @@ def format_cities_comparison(city1: str, weather1: dict, city2: str, weather2: d
     
     return text
 
+
+
+def format_cities_ranking(cities: list, not_found: list = (), failed: list = ()) -> str:
+    """Форматирует сравнение нескольких городов, упорядоченных по температуре.
+    cities — список (название, WeatherRecord, AirRecord или None);
+    not_found и failed — названия ненайденных городов и городов, данные о которых не получены."""
+    ranked = sorted(cities, key=lambda entry: entry[1].temp, reverse=True)
+    
+    parts = [f"📊 Сравнение городов ({len(ranked)}), от самого теплого\n\n"]
+    for place, (city, weather, air) in enumerate(ranked, 1):
+        if air is not None:
+            aqi = analyze_air_pollution(air_components(air))['overall_status']
+            air_text = f"{aqi['index']} ({aqi['name_ru'].lower()})"
+        else:
+            air_text = "нет данных"
+        parts.append(
+            f"{place}. {city} — {weather.description}\n"
+            f"   🌡️ {weather.temp:.1f}°C (ощущается как {weather.feels_like:.1f}°C)\n"
+            f"   🌬️ Ветер: {weather.wind_speed:.1f} м/с\n"
+            f"   💧 Влажность: {weather.humidity}%\n"
+            f"   🏭 Качество воздуха: {air_text}\n\n"
+        )
+    
+    if len(ranked) > 1:
+        warmest, coldest = ranked[0], ranked[-1]
+        diff = warmest[1].temp - coldest[1].temp
+        if diff > 0.1:
+            parts.append(f"💡 В {warmest[0]} теплее, чем в {coldest[0]}, на {diff:.1f}°C\n")
+    
+    if not_found:
+        parts.append(f"\n❌ Не найдены: {', '.join(not_found)}\n")
+    if failed:
+        parts.append(f"\n⚠️ Нет данных о погоде: {', '.join(failed)}\n")
+    
+    return ''.join(parts)
+
+
+def format_retry_after(retry_after: float) -> str:
+    """Ответ на запрос, не допущенный из-за перегрузки или слишком частых запросов."""
+    return f"⏳ Слишком много запросов. Попробуйте через {math.ceil(retry_after)} с."
+
+
+def format_cached_notice(retry_after: float) -> str:
+    """Пометка к данным из кэша, показанным вместо нового запроса."""
+    return f"\n\n⏳ Показаны сохраненные данные: слишком много запросов, обновить можно через {math.ceil(retry_after)} с."
+
+
+def _format_ms(seconds: Optional[float]) -> str:
+    return '—' if seconds is None else f"{seconds * 1000:.0f} мс"
+
+
+def format_stats(stats: dict) -> str:
+    """Форматирует сводку показателей бота (services.stats.collect_stats) для /stats."""
+    owm = stats['owm']
+    parts = [
+        "📈 Состояние бота\n\n",
+        f"🌐 OWM: {owm['calls_per_minute']} выз/мин (лимит {owm['minute_limit']}, "
+        f"свободно {owm['minute_available']})\n",
+        f"   За сутки осталось {owm['remaining_today']} из {owm['day_limit']}, "
+        f"выключатель: {owm['breaker']}, отброшено: {owm['shed']}\n\n",
+        "🗄️ Кэш (память / хранилище / промах, доля попаданий):\n",
+    ]
+    for endpoint, counts in sorted(stats['cache'].items()):
+        parts.append(
+            f"   {endpoint}: {counts['memory']} / {counts['store']} / {counts['miss']}, "
+            f"{counts['hit_ratio'] * 100:.0f}%\n"
+        )
+        refetches = counts['identical'] + counts['changed']
+        if refetches:
+            parts.append(f"      повторных запросов без изменений: {counts['identical']} из {refetches}\n")
+    
+    single_flight = stats['single_flight']
+    parts.append(
+        f"\n🔗 Объединено одинаковых запросов: {single_flight['coalesced']} из "
+        f"{single_flight['leaders'] + single_flight['coalesced']} ({single_flight['ratio'] * 100:.0f}%)\n"
+    )
+    
+    notifications = stats['notifications']
+    lateness = notifications['lateness']
+    parts.append(
+        f"\n🔔 Уведомления: просрочено проверок {notifications['overdue']}, "
+        f"опоздание p50 {_format_ms(lateness['p50'])}, p95 {_format_ms(lateness['p95'])}\n"
+        f"   Очередь отправки: {notifications['send_queue']}, "
+        f"отправлено {notifications['sent']}, ошибок {notifications['failed']}\n"
+    )
+    
+    handlers = stats['handlers']
+    parts.append(
+        f"\n⏱️ Обработчики: {handlers['count']} вызовов, ошибок {handlers['errors']}, "
+        f"p50 {_format_ms(handlers['p50'])}, p95 {_format_ms(handlers['p95'])}\n"
+    )
+    
+    rss = stats['rss']
+    users = stats['users']
+    parts.append(f"\n💾 Память процесса: {'—' if rss is None else f'{rss / 2 ** 20:.1f} МБ'}\n")
+    parts.append(
+        f"👥 Сессий: {users['sessions']}, с местоположением: {users['locations']}, "
+        f"подписчиков: {users['subscribers']}\n"
+    )
+    
+    return ''.join(parts)
@@ -0,0 +1,180 @@
+"""Лёгкие счетчики и гистограммы задержек для горячих путей."""
+
+import sys
+import threading
+import time
+from bisect import bisect_left
+from typing import Optional
+
+
+# Верхние границы корзин гистограммы задержек в миллисекундах
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, float('inf'))
+
+
+class Counter:
+    """Потокобезопасный монотонный счетчик."""
+
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        """Увеличивает значение счетчика."""
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+
+class LatencyStats:
+    """Гистограмма задержек с фиксированными корзинами.
+    Обновление стоит O(log B), перцентили оцениваются по верхней границе корзины."""
+
+    __slots__ = ('count', 'errors', 'total', 'max', '_buckets', '_lock')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = [0] * len(LATENCY_BUCKETS_MS)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, error: bool = False):
+        """Учитывает одно измерение длительности в секундах."""
+        index = bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            if error:
+                self.errors += 1
+            self._buckets[index] += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Возвращает оценку перцентиля q (0..1) в секундах или None, если данных нет."""
+        with self._lock:
+            if self.count == 0:
+                return None
+            rank = q * self.count
+            seen = 0
+            for index, bucket_count in enumerate(self._buckets):
+                seen += bucket_count
+                if seen >= rank and bucket_count:
+                    upper = LATENCY_BUCKETS_MS[index]
+                    return self.max if upper == float('inf') else min(upper / 1000, self.max)
+            return self.max
+
+    def snapshot(self) -> dict:
+        """Возвращает сводку по гистограмме."""
+        count = self.count
+        return {
+            'count': count,
+            'errors': self.errors,
+            'avg': self.total / count if count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+        }
+
+
+class RateMeter:
+    """Частота событий за последнюю минуту: 60 корзин по одной секунде.
+    Отметка события — O(1), устаревшие корзины обнуляются при повторном использовании."""
+
+    __slots__ = ('_counts', '_seconds', '_lock')
+
+    def __init__(self):
+        self._counts = [0] * 60
+        self._seconds = [0] * 60
+        self._lock = threading.Lock()
+
+    def mark(self, amount: int = 1):
+        """Учитывает amount событий в текущую секунду."""
+        second = int(time.monotonic())
+        index = second % 60
+        with self._lock:
+            if self._seconds[index] != second:
+                self._seconds[index] = second
+                self._counts[index] = 0
+            self._counts[index] += amount
+
+    def per_minute(self) -> int:
+        """Число событий за последние 60 секунд."""
+        now = int(time.monotonic())
+        with self._lock:
+            return sum(count for count, second in zip(self._counts, self._seconds) if now - second < 60)
+
+
+class MetricsRegistry:
+    """Реестр именованных метрик. Создание метрики берет блокировку,
+    повторное получение по имени — обычный поиск в словаре."""
+
+    def __init__(self):
+        self._counters = {}
+        self._latencies = {}
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str) -> Counter:
+        """Возвращает счетчик по имени, создавая его при первом обращении."""
+        metric = self._counters.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._counters.setdefault(name, Counter())
+        return metric
+
+    def latency(self, name: str) -> LatencyStats:
+        """Возвращает гистограмму задержек по имени, создавая ее при первом обращении."""
+        metric = self._latencies.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._latencies.setdefault(name, LatencyStats())
+        return metric
+
+    def rate(self, name: str) -> RateMeter:
+        """Возвращает измеритель частоты по имени, создавая его при первом обращении."""
+        metric = self._rates.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._rates.setdefault(name, RateMeter())
+        return metric
+
+    def counters(self, prefix: str = '') -> dict:
+        """Возвращает значения счетчиков, имена которых начинаются с prefix."""
+        return {name: c.value for name, c in list(self._counters.items()) if name.startswith(prefix)}
+
+    def latencies(self, prefix: str = '') -> dict:
+        """Возвращает сводки гистограмм, имена которых начинаются с prefix."""
+        return {name: l.snapshot() for name, l in list(self._latencies.items()) if name.startswith(prefix)}
+
+    def rates(self, prefix: str = '') -> dict:
+        """Возвращает число событий за минуту для измерителей, имена которых начинаются с prefix."""
+        return {name: r.per_minute() for name, r in list(self._rates.items()) if name.startswith(prefix)}
+
+
+def process_rss() -> Optional[int]:
+    """Резидентная память процесса в байтах (Linux) или пиковая, если текущая недоступна."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в килобайтах в Linux и в байтах в macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Общий реестр метрик процесса
+metrics = MetricsRegistry()
@@ -0,0 +1,147 @@
+"""Кэш готовых текстов сообщений и разметки клавиатур.
+
+Результат форматирования зависит только от записи погоды (ее ячейки и версии
+fetched_at) и параметров шаблона, поэтому пользователи одной ячейки получают
+один и тот же готовый текст. Когда запись кэша данных обновляется,
+тексты, построенные по ее предыдущей версии, удаляются.
+"""
+
+import functools
+import threading
+from collections import OrderedDict
+from services.weather_api import add_cache_listener
+from utils.metrics import metrics
+
+
+RENDER_CACHE_ENTRIES = 4096
+
+
+class RenderCache:
+    """LRU-кэш результатов рендеринга с индексом ключей по версии данных (ячейка, fetched_at)."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # {(template, cell, ...): value}
+        self._by_version = {}  # {(cell, fetched_at): {key, ...}}
+        self._lock = threading.Lock()
+
+    def get_or_render(self, template: str, key: tuple, render):
+        """Возвращает готовый результат по ключу или вызывает render() и запоминает результат.
+        Первые два элемента key — ячейка местоположения и версия данных."""
+        full_key = (template,) + key
+        with self._lock:
+            value = self._entries.get(full_key)
+            if value is not None:
+                self._entries.move_to_end(full_key)
+        if value is not None:
+            metrics.counter(f"render.hit.{template}").inc()
+            return value
+
+        metrics.counter(f"render.miss.{template}").inc()
+        value = render()
+        self.put(template, key, value)
+        return value
+
+    def get(self, template: str, key: tuple):
+        """Возвращает сохраненное значение по ключу или None, не считая попаданий."""
+        with self._lock:
+            return self._entries.get((template,) + key)
+
+    def put(self, template: str, key: tuple, value):
+        """Сохраняет значение, полученное не рендерингом (например, file_id загруженного
+        в Telegram файла). Оно удаляется вместе с остальными результатами версии данных."""
+        full_key = (template,) + key
+        with self._lock:
+            self._entries[full_key] = value
+            self._entries.move_to_end(full_key)
+            self._by_version.setdefault(key[:2], set()).add(full_key)
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._forget(old_key)
+
+    def discard(self, template: str, key: tuple):
+        """Удаляет значение по ключу, если оно есть."""
+        full_key = (template,) + key
+        with self._lock:
+            if self._entries.pop(full_key, None) is not None:
+                self._forget(full_key)
+
+    def _forget(self, full_key: tuple):
+        version = full_key[1:3]
+        keys = self._by_version.get(version)
+        if keys is not None:
+            keys.discard(full_key)
+            if not keys:
+                del self._by_version[version]
+
+    def invalidate(self, cell: str, fetched_at: float):
+        """Удаляет все результаты, построенные по версии данных ячейки."""
+        with self._lock:
+            for full_key in self._by_version.pop((cell, fetched_at), ()):
+                self._entries.pop(full_key, None)
+
+    def snapshot(self) -> list:
+        """Возвращает готовые тексты для снимка: [[ключ, текст], ...].
+        Сохраняются только строковые результаты с простыми ключами."""
+        with self._lock:
+            items = list(self._entries.items())
+        simple = (str, int, float, type(None))
+        return [
+            [list(full_key), value] for full_key, value in items
+            if isinstance(value, str) and all(isinstance(part, simple) for part in full_key)
+        ]
+
+    def restore(self, entries: list, versions: set) -> int:
+        """Восстанавливает тексты снимка, построенные по версиям данных из versions.
+        Возвращает количество восстановленных текстов."""
+        restored = 0
+        with self._lock:
+            for full_key, value in entries[-self.max_entries:]:
+                full_key = tuple(full_key)
+                if tuple(full_key[1:3]) not in versions:
+                    continue
+                self._entries[full_key] = value
+                self._by_version.setdefault(full_key[1:3], set()).add(full_key)
+                restored += 1
+        return restored
+
+    def stats(self) -> dict:
+        """Возвращает долю попаданий по шаблонам."""
+        hits = metrics.counters('render.hit.')
+        misses = metrics.counters('render.miss.')
+        result = {}
+        templates = {name.split('.', 2)[2] for name in list(hits) + list(misses)}
+        for template in templates:
+            hit = hits.get(f"render.hit.{template}", 0)
+            miss = misses.get(f"render.miss.{template}", 0)
+            result[template] = {'hits': hit, 'misses': miss, 'hit_ratio': hit / (hit + miss) if hit + miss else 0.0}
+        result['entries'] = len(self._entries)
+        return result
+
+
+render_cache = RenderCache(RENDER_CACHE_ENTRIES)
+
+def _on_cache_update(endpoint: str, record, previous):
+    """Тексты предыдущей версии записи больше не понадобятся. Если данные не изменились,
+    запись сохраняет версию предыдущей, и ее тексты остаются действительными."""
+    if previous is not None and previous.fetched_at != record.fetched_at:
+        render_cache.invalidate(previous.cell, previous.fetched_at)
+
+
+def init_render_cache():
+    """Подключает удаление устаревших текстов к обновлениям кэша. Вызывается при запуске бота."""
+    add_cache_listener(_on_cache_update)
+
+
+def cached_render(template: str, key_func):
+    """Декоратор: кэширует результат функции по ключу key_func(*args, **kwargs).
+    Если key_func возвращает None, результат не кэшируется."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = key_func(*args, **kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+            return render_cache.get_or_render(template, key, lambda: func(*args, **kwargs))
+        return wrapper
+    return decorator
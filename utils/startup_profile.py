@@ -0,0 +1,102 @@
+"""Профилирование запуска (python main.py --profile-startup).
+
+Время импорта каждого модуля измеряется так же, как в `python -X importtime`:
+собственное время модуля и время вместе с модулями, которые он импортирует.
+Дополнительно измеряется время от запуска процесса до первого обработанного
+обновления Telegram.
+"""
+
+import sys
+import threading
+import time
+from importlib.abc import MetaPathFinder
+
+
+PROCESS_STARTED = time.perf_counter()
+
+_imports = []  # [(модуль, собственное время, общее время, глубина)]
+_stack = []  # Время вложенных импортов для модулей, которые сейчас выполняются
+_first_update_lock = threading.Lock()
+_first_update_at = None
+
+
+class _TimedLoader:
+    """Обертка загрузчика, измеряющая выполнение модуля."""
+
+    def __init__(self, loader, name: str):
+        self._loader = loader
+        self._name = name
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Модуль должен видеть исходный загрузчик (ресурсы, перезагрузка)
+        module.__loader__ = self._loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self._loader
+        depth = len(_stack)
+        _stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            total = time.perf_counter() - start
+            nested = _stack.pop()
+            if _stack:
+                _stack[-1] += total
+            _imports.append((self._name, total - nested, total, depth))
+
+
+class _ImportTimer(MetaPathFinder):
+    """Находит модули остальными искателями и подменяет загрузчик на измеряющий."""
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = _TimedLoader(spec.loader, name)
+            return spec
+        return None
+
+
+def install_import_timer():
+    """Начинает измерять импорты. Вызывается до импорта модулей бота."""
+    if not any(isinstance(finder, _ImportTimer) for finder in sys.meta_path):
+        sys.meta_path.insert(0, _ImportTimer())
+
+
+def import_report(limit: int = 25) -> str:
+    """Самые долгие импорты по общему времени в формате -X importtime."""
+    lines = ["import time:  self [us] | cumulative | imported package"]
+    for name, self_time, total, depth in sorted(_imports, key=lambda item: item[2], reverse=True)[:limit]:
+        lines.append(f"import time: {self_time * 1e6:9.0f} | {total * 1e6:10.0f} | {'  ' * depth}{name}")
+    total_time = sum(total for _, _, total, depth in _imports if depth == 0)
+    lines.append(f"Импортировано модулей: {len(_imports)}, всего {total_time:.3f} с")
+    return '\n'.join(lines)
+
+
+def mark_first_update():
+    """Печатает время от запуска процесса до первого обработанного обновления."""
+    global _first_update_at
+    if _first_update_at is not None:
+        return
+    with _first_update_lock:
+        if _first_update_at is not None:
+            return
+        _first_update_at = time.perf_counter()
+    print(f"Первое обновление обработано через {_first_update_at - PROCESS_STARTED:.3f} с после запуска")
+
+
+def profile_dispatch(dispatch):
+    """Оборачивает диспетчер обновлений, отмечая первое обработанное обновление."""
+    def wrapper(update):
+        try:
+            return dispatch(update)
+        finally:
+            mark_first_update()
+    return wrapper
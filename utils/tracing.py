@@ -0,0 +1,306 @@
+"""Трассировка обработки обновлений Telegram.
+
+Для каждого обновления создается трасса (trace_update), а внутри нее — отрезки
+(span): обработчик, вызовы get_*, поиск в кэше по уровням, попытки запросов
+к OWM, запись в хранилище, отправка в Telegram. Текущая трасса хранится
+в contextvars, поэтому отрезки не нужно передавать через аргументы; в пулы
+потоков контекст передается через run_in_context.
+
+Трасса сохраняется, если она попала в выборку (доля TRACE_SAMPLE_RATE)
+или обработка длилась дольше TRACE_SLOW_MS. Отрезок — это две отметки
+времени и кортеж в списке трассы; вне трассы span() возвращает общий пустой
+объект. Сохраненные трассы записывает фоновый поток в ротируемые файлы:
+traces.jsonl (трасса на строку) и traces.json в формате Chrome trace events
+(открывается в chrome://tracing или ui.perfetto.dev).
+"""
+
+import contextvars
+import functools
+import itertools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+from config import settings
+from utils.metrics import metrics
+
+
+TRACE_SAMPLE_RATE = settings.trace_sample_rate
+TRACE_SLOW_SECONDS = settings.trace_slow_ms / 1000
+TRACE_DIR = Path(settings.trace_dir)
+TRACE_MAX_BYTES = settings.trace_max_bytes
+TRACE_BACKUPS = 3
+MAX_SPANS = 512  # Отрезки сверх этого числа в трассе не записываются
+EXPORT_QUEUE_SIZE = 1000
+
+ENABLED = TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_SECONDS > 0
+
+_current = contextvars.ContextVar('trace', default=None)
+_trace_ids = itertools.count(1)
+
+
+class Trace:
+    """Трасса одного обновления: отрезки в порядке завершения."""
+
+    __slots__ = ('trace_id', 'name', 'attrs', 'sampled', 'started_at', 'start', 'duration', 'spans')
+
+    def __init__(self, name: str, attrs: dict, sampled: bool):
+        self.trace_id = f"{os.getpid():x}-{next(_trace_ids):x}"
+        self.name = name
+        self.attrs = attrs
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.spans = []  # [(имя, начало, длительность, поток, атрибуты)]
+
+
+class Span:
+    """Отрезок внутри трассы. Атрибуты можно добавить до завершения через set()."""
+
+    __slots__ = ('_trace', '_name', '_attrs', '_start')
+
+    def __init__(self, trace: Trace, name: str, attrs: dict):
+        self._trace = trace
+        self._name = name
+        self._attrs = attrs
+        self._start = 0.0
+
+    def set(self, key: str, value):
+        self._attrs[key] = value
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self._attrs['error'] = exc_type.__name__
+        spans = self._trace.spans
+        if len(spans) < MAX_SPANS:
+            # list.append атомарен, поэтому отрезки можно добавлять из нескольких потоков
+            spans.append((self._name, self._start, end - self._start, threading.get_ident(), self._attrs))
+        return False
+
+
+class _NoopSpan:
+    """Отрезок вне трассы: ничего не записывает."""
+
+    __slots__ = ()
+
+    def set(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str, **attrs):
+    """Отрезок текущей трассы (контекстный менеджер) или пустой объект вне трассы."""
+    trace = _current.get()
+    if trace is None:
+        return _NOOP
+    return Span(trace, name, attrs)
+
+
+def traced(name: str):
+    """Декоратор: вызов функции — отрезок текущей трассы."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            with Span(trace, name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class trace_update:
+    """Трасса обработки одного обновления (контекстный менеджер).
+    Вложенная трасса не создается: отрезки попадают во внешнюю."""
+
+    __slots__ = ('_name', '_attrs', '_trace', '_token')
+
+    def __init__(self, name: str, **attrs):
+        self._name = name
+        self._attrs = attrs
+        self._trace = None
+        self._token = None
+
+    def __enter__(self):
+        if ENABLED and _current.get() is None:
+            self._trace = Trace(self._name, self._attrs, random.random() < TRACE_SAMPLE_RATE)
+            self._token = _current.set(self._trace)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self._trace
+        if trace is None:
+            return False
+        _current.reset(self._token)
+        trace.duration = time.perf_counter() - trace.start
+        if exc_type is not None:
+            trace.attrs['error'] = exc_type.__name__
+        slow = TRACE_SLOW_SECONDS > 0 and trace.duration >= TRACE_SLOW_SECONDS
+        if trace.sampled or slow:
+            _exporter.submit(trace, 'rate' if trace.sampled else 'slow')
+        return False
+
+
+def traced_update(name: str):
+    """Декоратор обработчика обновления, вызываемого telebot напрямую (не через Router):
+    вызов — отдельная трасса."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(update, *args, **kwargs):
+            with trace_update(name, user_id=update.from_user.id):
+                return func(update, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_in_context(func: Callable) -> Callable:
+    """Оборачивает func для выполнения в другом потоке с текущим контекстом трассировки."""
+    if _current.get() is None:
+        return func
+    context = contextvars.copy_context()
+    return functools.partial(context.run, func)
+
+
+def instrument_bot(bot, methods: tuple = (
+        'send_message', 'reply_to', 'edit_message_text', 'send_photo',
+        'answer_callback_query', 'answer_inline_query')):
+    """Оборачивает методы отправки бота: каждый вызов — отрезок telegram.<метод>."""
+    for method in methods:
+        original = getattr(bot, method, None)
+        if original is not None:
+            setattr(bot, method, traced(f"telegram.{method}")(original))
+
+
+# --- Экспорт ---
+
+def _trace_json(trace: Trace, reason: str) -> dict:
+    return {
+        'trace_id': trace.trace_id,
+        'name': trace.name,
+        'started_at': trace.started_at,
+        'duration_ms': round(trace.duration * 1000, 3),
+        'reason': reason,
+        'attrs': trace.attrs,
+        'spans': [
+            {
+                'name': name,
+                'offset_ms': round((start - trace.start) * 1000, 3),
+                'duration_ms': round(duration * 1000, 3),
+                'thread': thread,
+                'attrs': attrs,
+            }
+            for name, start, duration, thread, attrs in sorted(trace.spans, key=lambda s: s[1])
+        ],
+    }
+
+
+def _chrome_events(trace: Trace) -> list:
+    """Отрезки трассы как события "X" (complete) формата Chrome trace events."""
+    pid = os.getpid()
+    # Отметки perf_counter переводятся в микросекунды от начала эпохи через начало трассы
+    origin = trace.started_at * 1e6 - trace.start * 1e6
+    events = [{
+        'name': trace.name, 'cat': 'update', 'ph': 'X', 'pid': pid, 'tid': 0,
+        'ts': round(trace.started_at * 1e6), 'dur': round(trace.duration * 1e6),
+        'args': dict(trace.attrs, trace_id=trace.trace_id),
+    }]
+    for name, start, duration, thread, attrs in trace.spans:
+        events.append({
+            'name': name, 'cat': name.split('.', 1)[0], 'ph': 'X', 'pid': pid, 'tid': thread,
+            'ts': round(origin + start * 1e6), 'dur': round(duration * 1e6),
+            'args': dict(attrs, trace_id=trace.trace_id),
+        })
+    return events
+
+
+class _RotatingFile:
+    """Файл, который при превышении max_bytes переименовывается в .1 (.1 — в .2 и т. д.)."""
+
+    def __init__(self, path: Path, max_bytes: int, backups: int, header: bytes = b''):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.header = header
+        self._file = None
+
+    def write(self, data: bytes):
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, 'ab')
+            if self._file.tell() == 0:
+                self._file.write(self.header)
+        self._file.write(data)
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for index in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{index}")
+            if older.exists():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{index + 1}"))
+        os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+
+
+class TraceExporter:
+    """Фоновая запись сохраненных трасс, чтобы обработчики не ждали диска.
+    При переполнении очереди трассы отбрасываются."""
+
+    def __init__(self, directory: Path, max_bytes: int, backups: int = TRACE_BACKUPS):
+        self._jsonl = _RotatingFile(directory / "traces.jsonl", max_bytes, backups)
+        # Формат JSON Array: закрывающая скобка необязательна, поэтому события можно дописывать
+        self._chrome = _RotatingFile(directory / "traces.json", max_bytes, backups, header=b'[\n')
+        self._queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, trace: Trace, reason: str):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((trace, reason))
+            metrics.counter(f"trace.exported.{reason}").inc()
+        except queue.Full:
+            metrics.counter('trace.dropped').inc()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            trace, reason = self._queue.get()
+            try:
+                self._jsonl.write(json.dumps(_trace_json(trace, reason), ensure_ascii=False, default=str).encode() + b'\n')
+                self._chrome.write(b''.join(
+                    json.dumps(event, ensure_ascii=False, default=str).encode() + b',\n'
+                    for event in _chrome_events(trace)
+                ))
+            except Exception:
+                metrics.counter('trace.failed').inc()
+
+
+_exporter = TraceExporter(TRACE_DIR, TRACE_MAX_BYTES)